@@ -1,104 +1,220 @@
 import os
+import sys
 import json
-from datetime import datetime
 import argparse
-from torchvision import transforms as tf
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import cv2
 
 import torch
 from models.dla.pose_dla_dcn import get_pose_net
-from models.erfnet.erfnet import ERFNet
-from models.enet.ENet import ENet
 from utils.affinity_fields import decodeAFs
-from utils.visualize import tensor2image, create_viz
-import numpy as np
-from matplotlib import pyplot as plt
 import time
 from tqdm import tqdm  # Import tqdm for progress bar
 
-start_time = time.time()
-
-parser = argparse.ArgumentParser('Options for inference with LaneAF models in PyTorch...')
-parser.add_argument('--snapshot', type=str, default=None, help='path to pre-trained model snapshot')
-parser.add_argument('--seed', type=int, default=1, help='set seed to some constant value to reproduce experiments')
-parser.add_argument('--no-cuda', action='store_true', default=False, help='do not use cuda for training')
-parser.add_argument('--save-viz', action='store_true', default=False, help='save visualization depicting intermediate and final results')
-parser.add_argument('--video-path', type=str, default=None, help='path to the input video')
-parser.add_argument('--output-dir', type=str, default='output', help='directory to save the output frames')
-
-args = parser.parse_args()
-
-# Setup args
-args.cuda = not args.no_cuda and torch.cuda.is_available()
-
-# Load the model
-heads = {'hm': 1, 'vaf': 2, 'haf': 1}
-model = get_pose_net(num_layers=34, heads=heads, head_conv=256, down_ratio=4)  # Modify this based on your model architecture
-model.load_state_dict(torch.load(args.snapshot, map_location=torch.device('cpu')))
-
-if args.cuda:
-    model.cuda()
-model.eval()
-
-# Ensure output directory exists
-os.makedirs("masks_of_all_frames", exist_ok=True)
-
-# Open video
-cap = cv2.VideoCapture("/content/drive/MyDrive/TC_00048cropped.MP4")
-frame_idx = 0
-
-# Get total number of frames in video for tqdm
-total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-
-# Initialize tqdm
-pbar = tqdm(total=total_frames, desc='Processing frames')
-
-while cap.isOpened():
-    ret, frame = cap.read()
-    if not ret:
-        break
-    
-    img = frame.astype(np.float32) / 255.
-    img = cv2.resize(img[:, :, :], (1664, 576), interpolation=cv2.INTER_LINEAR)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    img_transforms = tf.Compose([
-        tf.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
-    img_input = img_transforms(torch.from_numpy(img).permute(2, 0, 1).contiguous().float())
-    img_input = img_input.unsqueeze(0)
-
-    img = img_input.cuda() if args.cuda else img_input
-
-    # Do the forward pass
-    outputs = model(img)[-1]
-
-    img = tensor2image(img.detach(), np.array([0.485, 0.456, 0.406]), np.array([0.229, 0.224, 0.225]))
-    mask_out = tensor2image(torch.sigmoid(outputs['hm']).repeat(1, 3, 1, 1).detach(),
-        np.array([0.0 for i in range(3)], dtype='float32'), np.array([1.0 for i in range(3)], dtype='float32'))
-    vaf_out = np.transpose(outputs['vaf'][0, :, :, :].detach().cpu().float().numpy(), (1, 2, 0))
-    haf_out = np.transpose(outputs['haf'][0, :, :, :].detach().cpu().float().numpy(), (1, 2, 0))
-
-    # Decode AFs to get lane instances
-    seg_out = decodeAFs(mask_out[:, :, 0], vaf_out, haf_out, fg_thresh=128, err_thresh=5)
-
-    cv2.imwrite(os.path.join(args.output_dir, f'/content/drive/MyDrive/LaneAF/masks_of_all_frames/frame_{frame_idx:06d}_seg.png'), cv2.resize(seg_out, (1664,576), interpolation=cv2.INTER_NEAREST))
-    
-    frame_idx += 1
-    pbar.update(1)  # Update tqdm progress bar
-
-cap.release()
-pbar.close()  # Close tqdm progress bar
-print('Inference done.')
-end_time = time.time()
-execution_time = end_time - start_time
-print(f'Total execution time: {execution_time} seconds')
-
-
-
-
-
-
-
-
+# mask_store.py lives in 'main codes', it can also be copied next to this script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main codes'))
+from mask_store import MaskStoreWriter
+
+# Input size of the model and the normalization used during training
+input_width, input_height = 1664, 576
+img_mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+img_std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+
+
+def preprocess_batch(frames):
+    """
+    Resize, convert to RGB and normalize a list of BGR video frames as one batch.
+
+    Parameters:
+    - frames: List of BGR frames as read by cv2.VideoCapture.
+
+    Returns:
+    - Tensor of shape (N, 3, 576, 1664) ready for the forward pass.
+    """
+    batch = np.stack([cv2.resize(frame, (input_width, input_height), interpolation=cv2.INTER_LINEAR) for frame in frames])
+    batch = torch.from_numpy(batch[..., ::-1].copy()).permute(0, 3, 1, 2).float().div_(255.)
+    return (batch - img_mean) / img_std
+
+
+def read_batches(cap, batch_size, selected_frames=None):
+    """
+    Read the frames of a video in batches. Frames that are not selected are only grabbed, never retrieved.
+
+    Parameters:
+    - cap: Opened cv2.VideoCapture.
+    - batch_size: Number of frames in each batch.
+    - selected_frames: Set of frame numbers to read, all frames if None.
+
+    Yields:
+    - List of frame numbers and list of the BGR frames of each batch.
+    """
+    last_selected_frame = max(selected_frames, default=-1) if selected_frames is not None else None
+    frame_idx = 0
+    while cap.isOpened():
+        frames = []
+        frame_numbers = []
+        while len(frames) < batch_size:
+            if selected_frames is not None:
+                if frame_idx > last_selected_frame:
+                    break
+                if frame_idx not in selected_frames:
+                    if not cap.grab():
+                        break
+                    frame_idx += 1
+                    continue
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+            frame_numbers.append(frame_idx)
+            frame_idx += 1
+        if not frames:
+            break
+        yield frame_numbers, frames
+
+
+def infer_batch(model, frames, cuda=False):
+    """
+    Run the model on a batch of frames.
+
+    Returns:
+    - Heatmaps (N, H, W) as uint8 and the vertical and horizontal affinity fields (N, H, W, C) at native resolution.
+    """
+    img = preprocess_batch(frames)
+    img = img.cuda() if cuda else img
+
+    # Do the forward pass for the whole batch
+    with torch.no_grad():
+        outputs = model(img)[-1]
+
+    mask_out = (torch.sigmoid(outputs['hm'][:, 0]) * 255.0).byte().cpu().numpy()
+    vaf_out = outputs['vaf'].permute(0, 2, 3, 1).cpu().float().numpy()
+    haf_out = outputs['haf'].permute(0, 2, 3, 1).cpu().float().numpy()
+    return mask_out, vaf_out, haf_out
+
+
+def load_model(snapshot, cuda=False):
+    heads = {'hm': 1, 'vaf': 2, 'haf': 1}
+    model = get_pose_net(num_layers=34, heads=heads, head_conv=256, down_ratio=4)  # Modify this based on your model architecture
+    model.load_state_dict(torch.load(snapshot, map_location=torch.device('cpu')))
+
+    if cuda:
+        model.cuda()
+    model.eval()
+    return model
+
+
+def decode_and_save(mask_out, vaf_out, haf_out, output_path):
+    """
+    Decode the affinity fields of one frame into lane instances and save the mask.
+    Runs in the worker pool, so it only takes numpy arrays.
+    """
+    seg_out = decodeAFs(mask_out, vaf_out, haf_out, fg_thresh=128, err_thresh=5)
+    cv2.imwrite(output_path, cv2.resize(seg_out, (input_width, input_height), interpolation=cv2.INTER_NEAREST))
+
+
+def decode_sparse(mask_out, vaf_out, haf_out):
+    """
+    Decode the affinity fields of one frame and return its labelled pixels (y, x, label) at native resolution.
+    """
+    seg_out = decodeAFs(mask_out, vaf_out, haf_out, fg_thresh=128, err_thresh=5)
+    y, x = np.nonzero(seg_out)
+    return y, x, seg_out[y, x]
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser('Options for inference with LaneAF models in PyTorch...')
+    parser.add_argument('--snapshot', type=str, default=None, help='path to pre-trained model snapshot')
+    parser.add_argument('--seed', type=int, default=1, help='set seed to some constant value to reproduce experiments')
+    parser.add_argument('--no-cuda', action='store_true', default=False, help='do not use cuda for training')
+    parser.add_argument('--save-viz', action='store_true', default=False, help='save visualization depicting intermediate and final results')
+    parser.add_argument('--video-path', type=str, default='/content/drive/MyDrive/TC_00048cropped.MP4', help='path to the input video')
+    parser.add_argument('--output-dir', type=str, default='/content/drive/MyDrive/LaneAF/masks_of_all_frames', help='directory to save the output frames')
+    parser.add_argument('--batch-size', type=int, default=8, help='number of frames in each forward pass')
+    parser.add_argument('--num-workers', type=int, default=2, help='number of processes decoding the affinity fields (0 decodes in the main process)')
+    parser.add_argument('--mask-store', type=str, default=None, help='write all masks to this mask store directory instead of one PNG per frame')
+    parser.add_argument('--frame-list', type=str, default=None, help='JSON list of frame numbers to infer (from select_frames_by_distance.py), all frames if not given')
+
+    args = parser.parse_args()
+
+    # Setup args
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+
+    # Leave the cores used by the decoding workers to them
+    if not args.cuda and args.num_workers > 0:
+        torch.set_num_threads(max(1, os.cpu_count() - args.num_workers))
+
+    # Load the model
+    model = load_model(args.snapshot, args.cuda)
+
+    # Ensure output directory exists
+    if args.mask_store is None:
+        os.makedirs(args.output_dir, exist_ok=True)
+        mask_writer = None
+    else:
+        mask_writer = MaskStoreWriter(args.mask_store, mask_shape=(input_height // 4, input_width // 4), output_shape=(input_height, input_width))
+
+    # Open video
+    cap = cv2.VideoCapture(args.video_path)
+
+    # Get total number of frames in video for tqdm
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    # Frames that are not selected are only grabbed, never retrieved or inferred
+    selected_frames = None
+    if args.frame_list is not None:
+        with open(args.frame_list, 'r') as file:
+            selected_frames = set(json.load(file))
+        total_frames = len(selected_frames)
+
+    # Initialize tqdm, the rate is shown in frames per second
+    pbar = tqdm(total=total_frames, desc='Processing frames', unit='frame')
+
+    inferred_frames = 0
+    pool = ProcessPoolExecutor(max_workers=args.num_workers) if args.num_workers > 0 else None
+    pending = []
+
+    def collect(frame_number, result):
+        if pool is not None:
+            result = result.result()
+        if mask_writer is not None:
+            mask_writer.add_pixels(frame_number, *result)
+        pbar.update(1)
+
+    for frame_numbers, frames in read_batches(cap, args.batch_size, selected_frames):
+        mask_out, vaf_out, haf_out = infer_batch(model, frames, args.cuda)
+
+        # Decode AFs to get lane instances, the workers do it while the next batch is read and inferred
+        for i, frame_number in enumerate(frame_numbers):
+            if mask_writer is None:
+                output_path = os.path.join(args.output_dir, f'frame_{frame_number:06d}_seg.png')
+                job = (decode_and_save, mask_out[i], vaf_out[i], haf_out[i], output_path)
+            else:
+                job = (decode_sparse, mask_out[i], vaf_out[i], haf_out[i])
+            if pool is None:
+                pending.append((frame_number, job[0](*job[1:])))
+            else:
+                pending.append((frame_number, pool.submit(*job)))
+            inferred_frames += 1
+
+        # Do not let more than two batches wait for decoding. Results are collected in frame order.
+        while len(pending) > (2 * args.batch_size if pool is not None else 0):
+            collect(*pending.pop(0))
+
+    for frame_number, result in pending:
+        collect(frame_number, result)
+    if pool is not None:
+        pool.shutdown()
+    if mask_writer is not None:
+        mask_writer.close()
+
+    cap.release()
+    pbar.close()  # Close tqdm progress bar
+    print('Inference done.')
+    end_time = time.time()
+    execution_time = end_time - start_time
+    print(f'Total execution time: {execution_time} seconds ({inferred_frames / execution_time:.2f} frames per second)')
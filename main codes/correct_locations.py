@@ -1,23 +1,32 @@
 # This script corrects the error in mobile location data, specifically the error that occurs across the width of the street.
 # The KML line file contains the true path driven. The erroneous locations are mapped onto the KML line to correct the error across the street width.
-# The script reads a KML file containing points and a line, maps the points to the nearest point on the line using Shapely geometry operations,
-# and saves the mapped points to a new KML file and updates the JSON data with the new coordinates, saving the updated data to a new JSON file.
+# The script reads a KML file containing points and a KML file of lines (a single path or the whole street network driven), and maps the points
+# to the nearest point of the lines. The segments of the lines are indexed once in a Shapely STRtree and all points are snapped in one batched query.
+# It saves the mapped points to a new KML file and updates the JSON data with the new coordinates, saving the updated data to a new JSON file.
 
+import argparse
 import xml.etree.ElementTree as ET
-from shapely.geometry import Point, LineString
+import numpy as np
+import shapely
+from shapely import STRtree
 import simplekml
 import json
 
-def parse_kml_line(kml_file):
+def parse_kml_lines(kml_file):
+    """
+    All LineStrings of a KML file.
+
+    Returns:
+    - list: Arrays of shape (number of points, 2) of (longitude, latitude), one per LineString.
+    """
     tree = ET.parse(kml_file)
     root = tree.getroot()
     namespace = {'kml': 'http://www.opengis.net/kml/2.2'}
-    coordinates = root.find('.//kml:LineString/kml:coordinates', namespace).text.strip()
-    line_coords = []
-    for coord in coordinates.split():
-        lon, lat, _ = map(float, coord.split(','))
-        line_coords.append((lon, lat))  # Use (longitude, latitude) format
-    return LineString(line_coords)
+    lines = []
+    for line_string in root.findall('.//kml:LineString', namespace):
+        coordinates = line_string.find('kml:coordinates', namespace).text.split()
+        lines.append(np.array([[float(value) for value in coord.split(',')[:2]] for coord in coordinates]).reshape(-1, 2))
+    return lines
 
 def parse_kml_points(kml_file):
     tree = ET.parse(kml_file)
@@ -31,37 +40,108 @@ def parse_kml_points(kml_file):
         points.append((lat, lon))  # Use (latitude, longitude) format
     return points
 
-def nearest_point_on_line(line, point):
+
+class ReferenceNetwork:
     """
-    Find the nearest point on a Shapely LineString to a given point.
+    Segments of the reference lines, in local meters, indexed in an STRtree.
 
     Parameters:
-    - line (LineString): Shapely LineString object representing the line.
-    - point (Point): Shapely Point object representing the point.
-
-    Returns:
-    - Point: Shapely Point object representing the nearest point on the line.
+    - lines: Arrays of (longitude, latitude) points, as returned by parse_kml_lines.
     """
-    return line.interpolate(line.project(point))
 
-def map_points_to_line(points, kml_file):
+    def __init__(self, lines):
+        lines = [line for line in lines if len(line) >= 1]
+        if not lines:
+            raise ValueError("The reference KML does not contain any LineString")
+
+        # Local meters (equirectangular around the network), so the nearest segment is the nearest on the ground
+        all_points = np.concatenate(lines)
+        self.origin = all_points.mean(axis=0)
+        self.scale = np.array([111320 * np.cos(np.radians(self.origin[1])), 111320])
+
+        # A line of a single point is a segment of zero length
+        starts = [line[:-1] if len(line) > 1 else line for line in lines]
+        ends = [line[1:] if len(line) > 1 else line for line in lines]
+        self.starts = self.to_meters(np.concatenate(starts))
+        self.ends = self.to_meters(np.concatenate(ends))
+        self.tree = STRtree(shapely.linestrings(np.stack([self.starts, self.ends], axis=1)))
+
+    def to_meters(self, lonlat):
+        return (np.asarray(lonlat, dtype=np.float64) - self.origin) * self.scale
+
+    def to_lonlat(self, xy):
+        return xy / self.scale + self.origin
+
+    def snap(self, latitudes, longitudes, max_distance=None):
+        """
+        Nearest point of the network to each point.
+
+        Parameters:
+        - latitudes, longitudes: Coordinates of the points.
+        - max_distance: Points farther than this from the network (meters) are left where they are. All points
+          are snapped if None.
+
+        Returns:
+        - Arrays of the latitudes and longitudes of the snapped points.
+        """
+        xy = self.to_meters(np.column_stack([longitudes, latitudes]))
+        if len(xy) == 0:
+            return np.asarray(latitudes, dtype=np.float64), np.asarray(longitudes, dtype=np.float64)
+        point_index, segment = self.tree.query_nearest(shapely.points(xy), max_distance=max_distance, all_matches=False)
+        t, projected, _ = self.project(xy[point_index], segment)
+
+        snapped = xy.copy()
+        snapped[point_index] = projected
+        lonlat = self.to_lonlat(snapped)
+        return lonlat[:, 1], lonlat[:, 0]
+
+    def candidates(self, latitudes, longitudes, radius, k):
+        """
+        The k nearest segments within radius meters of each point, for map matching.
+
+        Returns:
+        - Arrays of the point index, segment, position t along the segment, latitude and longitude of the nearest
+          point of the segment and distance (meters) of every candidate, sorted by point and distance.
+        """
+        xy = self.to_meters(np.column_stack([longitudes, latitudes]))
+        point_index, segment = self.tree.query(shapely.points(xy), predicate='dwithin', distance=radius)
+        t, projected, distance = self.project(xy[point_index], segment)
+
+        order = np.lexsort((distance, point_index))
+        point_index, segment, t, projected, distance = point_index[order], segment[order], t[order], projected[order], distance[order]
+        group_starts = np.flatnonzero(np.r_[True, point_index[1:] != point_index[:-1]]) if len(point_index) else np.empty(0, dtype=np.intp)
+        rank = np.arange(len(point_index)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(point_index)]))
+        keep = rank < k
+        lonlat = self.to_lonlat(projected[keep])
+        return point_index[keep], segment[keep], t[keep], lonlat[:, 1], lonlat[:, 0], distance[keep]
+
+    def project(self, xy, segment):
+        """
+        Projection of points (meters) onto segments: position t along each segment, projected points and distances.
+        """
+        starts, ends = self.starts[segment], self.ends[segment]
+        direction = ends - starts
+        squared_length = np.einsum('ij,ij->i', direction, direction)
+        t = np.einsum('ij,ij->i', xy - starts, direction)
+        t = np.clip(np.divide(t, squared_length, out=np.zeros_like(t), where=squared_length > 0), 0, 1)
+        projected = starts + t[:, np.newaxis] * direction
+        return t, projected, np.linalg.norm(xy - projected, axis=1)
+
+def map_points_to_line(points, network, max_distance=None):
     """
-    Map a list of points to the nearest points on a line extracted from a KML file.
+    Map a list of points to the nearest points of the reference network.
 
     Parameters:
     - points (list): List of tuples, each containing (latitude, longitude) of each point.
-    - kml_file (str): Path to the KML file containing the line.
+    - network (ReferenceNetwork): Reference lines.
+    - max_distance: See ReferenceNetwork.snap.
 
     Returns:
     - list: List of tuples, each containing (latitude, longitude) of each mapped point.
     """
-    line = parse_kml_line(kml_file)
-    mapped_points = []
-    for point in points:
-        point_geom = Point(point[1], point[0])  # (longitude, latitude)
-        nearest_point = nearest_point_on_line(line, point_geom)
-        mapped_points.append((nearest_point.y, nearest_point.x))  # (latitude, longitude)
-    return mapped_points
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    latitudes, longitudes = network.snap(points[:, 0], points[:, 1], max_distance)
+    return list(zip(latitudes.tolist(), longitudes.tolist()))
 
 def save_points_to_kml(points, output_file):
     kml = simplekml.Kml()
@@ -78,63 +158,64 @@ def save_json(data, file_path):
     with open(file_path, 'w') as f:
         json.dump(data, f, indent=2)
 
-def map_json_points_to_line(json_data, kml_file):
+def map_json_points_to_line(json_data, network, max_distance=None):
     """
-    Map a list of points from JSON data to the nearest points on a line extracted from a KML file.
+    Map a list of points from JSON data to the nearest points of the reference network.
 
     Parameters:
     - json_data (list): List of dicts with 'latitude' and 'longitude' keys.
-    - kml_file (str): Path to the KML file containing the line.
+    - network (ReferenceNetwork): Reference lines.
+    - max_distance: See ReferenceNetwork.snap.
 
     Returns:
     - list: List of dicts with 'latitude' and 'longitude' of the mapped points.
     """
-    line = parse_kml_line(kml_file)
-    mapped_points = []
-    for point in json_data:
-        point_geom = Point(point['longitude'], point['latitude'])  # (longitude, latitude)
-        nearest_point = nearest_point_on_line(line, point_geom)
-        mapped_point = {
-            'latitude': nearest_point.y,
-            'longitude': nearest_point.x
-        }
-        mapped_points.append(mapped_point)
-    return mapped_points
-
-# Paths to input KML and JSON files
-points_kml_file = 'output_kmls/captured_locations.kml'
-line_kml_file = 'path_to_line_kml_file.kml'
-json_file = 'locations_data/locations_and_magneticHeadings.json'
-
-# Load and parse the KML points
-points = parse_kml_points(points_kml_file)
-
-# Map the points to the nearest points on the line in the KML file
-mapped_points = map_points_to_line(points, line_kml_file)
-
-# Save the mapped points to a new KML file
-output_kml_file = 'path_to_output_kml_file.kml'
-save_points_to_kml(mapped_points, output_kml_file)
-
-# Print the original and mapped points
-for original, mapped in zip(points, mapped_points):
-    print(f"Original: {original} -> Mapped: {mapped}")
-
-print(f"Mapped points have been saved to {output_kml_file}")
-
-# Load the JSON data
-data = load_json(json_file)
-
-# Map the JSON points to the nearest points on the line in the KML file
-mapped_json_points = map_json_points_to_line(data, line_kml_file)
-
-# Update the original JSON data with the mapped points
-for i, item in enumerate(data):
-    item['latitude'] = mapped_json_points[i]['latitude']
-    item['longitude'] = mapped_json_points[i]['longitude']
-
-# Save the updated JSON data to a new JSON file
-output_json_file = 'locations_data/correctedLocation.json'
-save_json(data, output_json_file)
-
-print(f"Updated JSON data has been saved to {output_json_file}")
+    latitudes = np.array([point['latitude'] for point in json_data], dtype=np.float64)
+    longitudes = np.array([point['longitude'] for point in json_data], dtype=np.float64)
+    latitudes, longitudes = network.snap(latitudes, longitudes, max_distance)
+    return [{'latitude': latitude, 'longitude': longitude} for latitude, longitude in zip(latitudes.tolist(), longitudes.tolist())]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Snap recorded locations to the nearest point of the streets actually driven')
+    parser.add_argument('--line-kml', type=str, default='path_to_line_kml_file.kml', help='KML of the driven path: one or many LineStrings')
+    parser.add_argument('--points-kml', type=str, default='output_kmls/captured_locations.kml', help='KML of the captured locations (create_kml_of_captured_locations.py)')
+    parser.add_argument('--json', type=str, default='locations_data/locations_and_magneticHeadings.json', help='locations and magnetic headings recorded by MyApp')
+    parser.add_argument('--output-kml', type=str, default='path_to_output_kml_file.kml', help='KML of the mapped points')
+    parser.add_argument('--output-json', type=str, default='locations_data/correctedLocation.json', help='locations with the corrected coordinates')
+    parser.add_argument('--max-distance', type=float, default=None, help='leave the locations farther than this from the path (meters) unchanged')
+    args = parser.parse_args()
+
+    # Parse the reference lines and index them once, for both the KML points and the JSON points
+    network = ReferenceNetwork(parse_kml_lines(args.line_kml))
+
+    # Load and parse the KML points
+    points = parse_kml_points(args.points_kml)
+
+    # Map the points to the nearest points on the lines in the KML file
+    mapped_points = map_points_to_line(points, network, args.max_distance)
+
+    # Save the mapped points to a new KML file
+    save_points_to_kml(mapped_points, args.output_kml)
+
+    # Print the original and mapped points
+    for original, mapped in zip(points, mapped_points):
+        print(f"Original: {original} -> Mapped: {mapped}")
+
+    print(f"Mapped points have been saved to {args.output_kml}")
+
+    # Load the JSON data
+    data = load_json(args.json)
+
+    # Map the JSON points to the nearest points on the lines in the KML file
+    mapped_json_points = map_json_points_to_line(data, network, args.max_distance)
+
+    # Update the original JSON data with the mapped points
+    for i, item in enumerate(data):
+        item['latitude'] = mapped_json_points[i]['latitude']
+        item['longitude'] = mapped_json_points[i]['longitude']
+
+    # Save the updated JSON data to a new JSON file
+    save_json(data, args.output_json)
+
+    print(f"Updated JSON data has been saved to {args.output_json}")
@@ -1,7 +1,6 @@
 import cv2
 from datetime import datetime, timedelta
 import json
-import os
 
 
 # We have the exact time of the first frame (obtained using a video recording application that records the exact start time 
@@ -31,22 +30,73 @@ def get_frame_timestamps(video_path, start_time):
         frame_datetime = start_datetime + timedelta(seconds=current_frame_time)
         timestamps.append({
             "frame": frame_no,
-            "timestamp": frame_datetime.strftime('%H:%M:%S.%f')
+            "timestamp": frame_datetime.strftime('%H%M%S.%f')
         })
 
         frame_no += 1
 
-        # Clear the terminal screen after printing each frame number
-        os.system('cls' if os.name == 'nt' else 'clear')
-        print("Frame:", frame_no, "of", frame_count)
+        # Overwrite the progress line in place instead of clearing the whole terminal for every frame
+        print("Frame:", frame_no, "of", frame_count, end='\r')
 
+    print()
     cap.release()
     return timestamps
 
-video_file = "your_recorded_video_of_road.mp4" # add your video's address here
-start_time = "09:23:56.224" # You need to change this based on the start time of your recorded video. The Timestamp Camera app records the time of the first frame in milliseconds.
-timestamps = get_frame_timestamps(video_file, start_time)
+def get_frame_timestamps_from_container(video_path, start_time):
+    """
+    Read the presentation timestamp (PTS) of every frame from the container index, without decoding any pixels.
+    Phones record variable frame rate video, so the time of each frame is taken from its own PTS instead of
+    frame_no / fps. Frames are returned in presentation order, which is the order cv2.VideoCapture reads them in.
 
-# Open a json file to write timestamps
-with open('output_jsons/timestamp_of_each_frame.json', 'w') as file:
-    json.dump(timestamps, file, indent=4)
+    Parameters:
+    - video_path: Path to the recorded video.
+    - start_time: Exact time of the first frame ('HH:MM:SS.fff').
+
+    Returns:
+    - List of {"frame", "timestamp"} dicts in the same format as get_frame_timestamps.
+
+    Raises:
+    - ImportError if PyAV is not installed, and the av.error.FFmpegError of PyAV if the video cannot be read.
+    """
+    try:
+        import av  # PyAV is only needed for this mode
+    except ImportError as error:
+        raise ImportError("PyAV is required to read timestamps from the container (pip install av)") from error
+
+    container = av.open(video_path)
+    stream = container.streams.video[0]
+    time_base = stream.time_base
+
+    # Demuxing only reads the packet headers; no frame is decoded
+    pts = [packet.pts for packet in container.demux(stream) if packet.pts is not None]
+    container.close()
+
+    # Packets come in decode order, B-frames make it differ from presentation order
+    pts.sort()
+
+    start_datetime = datetime.strptime(start_time, '%H:%M:%S.%f')
+
+    timestamps = []
+    for frame_no, frame_pts in enumerate(pts):
+        current_frame_time = float((frame_pts - pts[0]) * time_base)
+        frame_datetime = start_datetime + timedelta(seconds=current_frame_time)
+        timestamps.append({
+            "frame": frame_no,
+            "timestamp": frame_datetime.strftime('%H%M%S.%f')
+        })
+
+    return timestamps
+
+if __name__ == '__main__':
+    video_file = "your_recorded_video_of_road.mp4" # add your video's address here
+    start_time = "09:23:56.224" # You need to change this based on the start time of your recorded video. The Timestamp Camera app records the time of the first frame in milliseconds.
+    read_timestamps_from_container = True # Read per-frame timestamps from the container (fast, handles variable frame rate). Set to False to decode every frame with OpenCV.
+
+    if read_timestamps_from_container:
+        timestamps = get_frame_timestamps_from_container(video_file, start_time)
+    else:
+        timestamps = get_frame_timestamps(video_file, start_time)
+
+    # Open a json file to write timestamps
+    with open('output_jsons/timestamp_of_each_frame.json', 'w') as file:
+        json.dump(timestamps, file, indent=4)
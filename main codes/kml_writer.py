@@ -0,0 +1,106 @@
+import io
+import zipfile
+from xml.sax.saxutils import escape, quoteattr
+
+'''
+Writes a KML file incrementally. simplekml builds the whole document in memory and writes it on save, so a
+drive's lines could only be written once all of them are known. KmlWriter writes each placemark to the file as
+soon as it is added, so the lines of a long drive can be written while they are computed, in constant memory.
+Styles are shared: each is written once and referenced by the placemarks using it, instead of one inline style
+per line as simplekml writes. A path ending with .kmz is written as KMZ (zipped KML), compressed on the fly.
+'''
+
+red = 'ff0000ff'  # KML colors are aabbggrr, same as simplekml.Color.red
+yellow = 'ff00ffff'
+coordinate_decimals = 8  # About a millimeter, far below the accuracy of the GPS
+
+
+def format_coordinates(coords):
+    return ' '.join(f'{longitude:.{coordinate_decimals}f},{latitude:.{coordinate_decimals}f},0' for longitude, latitude in coords)
+
+
+def region(bounds, min_lod_pixels=128, max_lod_pixels=-1):
+    """
+    KML Region of a (north, south, east, west) box, active while it covers between min_lod_pixels and
+    max_lod_pixels (-1 for no limit) pixels on screen.
+    """
+    north, south, east, west = bounds
+    return (f'<Region><LatLonAltBox><north>{north!r}</north><south>{south!r}</south><east>{east!r}</east><west>{west!r}</west></LatLonAltBox>'
+            f'<Lod><minLodPixels>{min_lod_pixels}</minLodPixels><maxLodPixels>{max_lod_pixels}</maxLodPixels></Lod></Region>')
+
+
+class KmlWriter:
+    """
+    KML document written to output_file_path (KML, or KMZ if it ends with .kmz) as placemarks are added. Use it
+    as a context manager, or call close() to finish the document.
+    """
+
+    def __init__(self, output_file_path):
+        if output_file_path.lower().endswith('.kmz'):
+            self.archive = zipfile.ZipFile(output_file_path, 'w', compression=zipfile.ZIP_DEFLATED)
+            self.file = io.TextIOWrapper(self.archive.open('doc.kml', 'w', force_zip64=True), encoding='utf-8')
+        else:
+            self.archive = None
+            self.file = open(output_file_path, 'w', encoding='utf-8')
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+                        '<Document>\n')
+
+    def add_line_style(self, style_id, color=red, width=2):
+        self.file.write(f'<Style id={quoteattr(style_id)}><LineStyle><color>{color}</color><width>{width}</width></LineStyle></Style>\n')
+
+    def add_linestring(self, name, coords, style_id=None):
+        """
+        Add a line placemark.
+
+        Parameters:
+        - name: Name of the placemark.
+        - coords: Points of the line as (longitude, latitude).
+        - style_id: Id of a style added with add_line_style.
+        """
+        style = f'<styleUrl>#{escape(style_id)}</styleUrl>' if style_id is not None else ''
+        self.file.write(f'<Placemark><name>{escape(name)}</name>{style}<LineString><coordinates>{format_coordinates(coords)}</coordinates></LineString></Placemark>\n')
+
+    def add_multilinestring(self, name, lines, style_id=None):
+        """
+        Add a placemark of several lines (e.g. all lines of a frame) as one MultiGeometry.
+
+        Parameters:
+        - name: Name of the placemark.
+        - lines: Lines, each a list of (longitude, latitude) points.
+        - style_id: Id of a style added with add_line_style.
+        """
+        style = f'<styleUrl>#{escape(style_id)}</styleUrl>' if style_id is not None else ''
+        geometry = ''.join(f'<LineString><coordinates>{format_coordinates(coords)}</coordinates></LineString>' for coords in lines)
+        self.file.write(f'<Placemark><name>{escape(name)}</name>{style}<MultiGeometry>{geometry}</MultiGeometry></Placemark>\n')
+
+    def begin_folder(self, name=None, folder_region=None):
+        """
+        Start a folder, shown only while folder_region (see region) is active if given. Placemarks added until
+        end_folder are in the folder.
+        """
+        name = f'<name>{escape(name)}</name>' if name is not None else ''
+        self.file.write(f'<Folder>{name}{folder_region or ""}\n')
+
+    def end_folder(self):
+        self.file.write('</Folder>\n')
+
+    def add_network_link(self, name, href, link_region=None):
+        """
+        Add a link to another KML file, loaded when link_region (see region) becomes active if given.
+        """
+        refresh = '<viewRefreshMode>onRegion</viewRefreshMode>' if link_region is not None else ''
+        self.file.write(f'<NetworkLink><name>{escape(name)}</name>{link_region or ""}<Link><href>{escape(href)}</href>{refresh}</Link></NetworkLink>\n')
+
+    def close(self):
+        if not self.file.closed:
+            self.file.write('</Document>\n</kml>\n')
+            self.file.close()
+            if self.archive is not None:
+                self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,119 @@
+import numpy as np
+
+'''
+Fits a line to the pixels of every lane instance of a mask at once.
+The per-instance moments (count, sums of x, y, x*x, y*y and x*y) are accumulated in a single pass over the
+labelled pixels with np.bincount, and every instance's line is then solved in closed form as the principal axis
+of its pixels (total least squares). Unlike regressing y on x, this is well conditioned for near-vertical lines,
+which lane lines in front of the camera usually are. The cost only depends on the number of labelled pixels,
+not on the number of lanes.
+'''
+
+
+def mask_pixels_from_image(label_image, crop_top=0):
+    """
+    Labelled pixels of a mask image (one label channel, 0 for background).
+
+    Parameters:
+    - label_image: Label image of the frame.
+    - crop_top: Rows above this are ignored; the returned y is relative to it.
+
+    Returns:
+    - Arrays y, x and label of the labelled pixels.
+    """
+    label_image = label_image[crop_top:]
+    y, x = np.nonzero(label_image)
+    return y, x, label_image[y, x]
+
+def mask_pixels_from_store(mask_store, frame_number, crop_top=0):
+    """
+    Labelled pixels of a frame in a mask store, mapped from the native mask resolution to the model input
+    resolution (see native_pixels_to_input_resolution).
+
+    Parameters:
+    - mask_store: MaskStore to read from.
+    - frame_number: Frame to read.
+    - crop_top: Rows (at model input resolution) above this are ignored; the returned y is relative to it.
+
+    Returns:
+    - Arrays y, x and label of the labelled pixels.
+    """
+    y, x, labels = mask_store.read(frame_number)
+    return native_pixels_to_input_resolution(y, x, labels, mask_store.mask_shape, mask_store.output_shape, crop_top)
+
+def native_pixels_to_input_resolution(y, x, labels, mask_shape, output_shape, crop_top=0):
+    """
+    Map labelled pixels at the native mask resolution to the centre of the block each of them is upsampled to
+    at the model input resolution, ignoring the rows above crop_top.
+    """
+    scale_y = output_shape[0] / mask_shape[0]
+    scale_x = output_shape[1] / mask_shape[1]
+    y = (y + 0.5) * scale_y - 0.5
+    x = (x + 0.5) * scale_x - 0.5
+    keep = y >= crop_top
+    return y[keep] - crop_top, x[keep], labels[keep]
+
+def fit_lines(y, x, labels):
+    """
+    Fit a line to the pixels of each lane instance and find its start and end points.
+    The start point is the end of the line closer to the camera (bottom of the image). Points above the
+    top of the image (y < 0) are moved back along the line onto y = 0.
+
+    Parameters:
+    - y, x: Pixel coordinates of the labelled pixels.
+    - labels: Instance label of each pixel (1, 2, ...).
+
+    Returns:
+    - Array of the instance labels, in ascending order.
+    - Start points, shape (number of instances, 2) as (x, y).
+    - End points, shape (number of instances, 2) as (x, y).
+    """
+    labels = np.asarray(labels, dtype=np.intp)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # Moments of every instance in one pass over the pixels
+    count = np.bincount(labels)
+    line_labels = np.flatnonzero(count)
+    line_labels = line_labels[line_labels > 0]
+    n = count[line_labels]
+    sum_x = np.bincount(labels, x)[line_labels]
+    sum_y = np.bincount(labels, y)[line_labels]
+    sum_xx = np.bincount(labels, x * x)[line_labels]
+    sum_yy = np.bincount(labels, y * y)[line_labels]
+    sum_xy = np.bincount(labels, x * y)[line_labels]
+
+    mean_x = sum_x / n
+    mean_y = sum_y / n
+    cov_xx = sum_xx / n - mean_x**2
+    cov_yy = sum_yy / n - mean_y**2
+    cov_xy = sum_xy / n - mean_x * mean_y
+
+    # Direction of the principal axis of each instance's pixels
+    theta = 0.5 * np.arctan2(2 * cov_xy, cov_xx - cov_yy)
+    direction = np.column_stack([np.cos(theta), np.sin(theta)])
+
+    # Extent of each instance along its line
+    position = np.zeros(len(count), dtype=np.intp)
+    position[line_labels] = np.arange(len(line_labels))
+    pixel_line = position[labels]
+    t = (x - mean_x[pixel_line]) * direction[pixel_line, 0] + (y - mean_y[pixel_line]) * direction[pixel_line, 1]
+    t_min = np.full(len(line_labels), np.inf)
+    t_max = np.full(len(line_labels), -np.inf)
+    np.minimum.at(t_min, pixel_line, t)
+    np.maximum.at(t_max, pixel_line, t)
+
+    mean = np.column_stack([mean_x, mean_y])
+    first = mean + t_min[:, np.newaxis] * direction
+    second = mean + t_max[:, np.newaxis] * direction
+
+    # Clip the points above the image back onto its top row
+    for point in (first, second):
+        above = (point[:, 1] < 0) & (direction[:, 1] != 0)
+        shift = point[above, 1] / direction[above, 1]
+        point[above] -= shift[:, np.newaxis] * direction[above]
+
+    first_is_start = first[:, 1] >= second[:, 1]
+    start_points = np.where(first_is_start[:, np.newaxis], first, second)
+    end_points = np.where(first_is_start[:, np.newaxis], second, first)
+    return line_labels, start_points, end_points
@@ -0,0 +1,313 @@
+import argparse
+import hashlib
+import json
+import os
+import warnings
+import numpy as np
+from scipy.spatial import cKDTree
+from smooth_lines import (aggregate_lines_streaming, combine_points_with_variance, line_length, lines_merge_distance_threshold,
+                          look_ahead_distance, to_cartesian, write_smoothed_lines_kml)
+from line_store import load_lines, iter_frames
+
+'''
+A persistent road line map, built up drive after drive. The smoothed lines of a new drive are merged into the map:
+- A vertex of the map close to a line of the drive is fused with the closest point of that line, with the same
+  variance-weighted fusion as smooth_lines.py (combine_points_with_variance), so its variance shrinks with every
+  drive that sees it.
+- The parts of a line of the drive that are not close to the map extend the map line they continue, or become
+  new map lines.
+
+The map is cut into square tiles of tile_size degrees, and only the tiles covered by the new drive and the tiles
+around them are read and written, so merging a drive costs the same however large the map is:
+- tiles/<x>_<y>.npy: Vertices in the tile (line id, index of the vertex along its line, latitude, longitude and
+  variance). A line crossing tiles has its vertices in each of them; the index orders them along the line.
+- meta.json: Tile size, next free line id, index of the first and last vertex of every line (a line may continue
+  in tiles that are not read) and digest of every drive merged (a drive merged again would count its evidence twice).
+The vertices of a line are assumed to be less than a tile apart, so every neighbour of a vertex close to the drive
+is in the tiles that are read.
+'''
+
+vertex_dtype = np.dtype([('line_id', '<i8'), ('vertex', '<i8'), ('latitude', '<f8'), ('longitude', '<f8'), ('variance', '<f8')])
+default_variance = 1.0  # Variance of the points without one (start points of aggregated lines) when no point of their line has one
+
+
+def closest_segments(points, starts, ends, max_distance):
+    """
+    Closest segment to each point, among the segments closer than max_distance.
+
+    Parameters:
+    - points: Points, shape (N, D).
+    - starts, ends: End points of the segments, shape (M, D). A segment may have equal end points.
+    - max_distance: Segments farther than this from a point are ignored.
+
+    Returns:
+    - Index of the closest segment of each point (-1 if none), position t in [0, 1] of the closest point along
+      it and its distance to the point.
+    """
+    segment = np.full(len(points), -1, dtype=np.intp)
+    position = np.zeros(len(points))
+    distance = np.full(len(points), np.inf)
+    if len(points) == 0 or len(starts) == 0:
+        return segment, position, distance
+
+    # Any point of a segment is within half its length of its middle
+    lengths = np.linalg.norm(ends - starts, axis=1)
+    pairs = cKDTree((starts + ends) / 2).query_ball_point(points, r=max_distance + lengths.max() / 2)
+    counts = np.array([len(pair) for pair in pairs], dtype=np.intp)
+    if counts.sum() == 0:
+        return segment, position, distance
+    point_index = np.repeat(np.arange(len(points)), counts)
+    segment_index = np.concatenate([pair for pair in pairs if len(pair) > 0]).astype(np.intp)
+
+    direction = ends[segment_index] - starts[segment_index]
+    squared_length = np.einsum('ij,ij->i', direction, direction)
+    t = np.einsum('ij,ij->i', points[point_index] - starts[segment_index], direction)
+    t = np.clip(np.divide(t, squared_length, out=np.zeros_like(t), where=squared_length > 0), 0, 1)
+    pair_distance = np.linalg.norm(starts[segment_index] + t[:, np.newaxis] * direction - points[point_index], axis=1)
+
+    # Closest pair of each point
+    order = np.lexsort((pair_distance, point_index))
+    first = order[np.r_[True, point_index[order][1:] != point_index[order][:-1]]]
+    close = pair_distance[first] <= max_distance
+    first = first[close]
+    segment[point_index[first]] = segment_index[first]
+    position[point_index[first]] = t[first]
+    distance[point_index[first]] = pair_distance[first]
+    return segment, position, distance
+
+def line_points_with_variance(points):
+    """
+    Array (number of points, 3) of latitude, longitude and variance of a smoothed line, giving the points without
+    variance (the start point) the smallest variance of the line.
+    """
+    variances = [point[2] for point in points if len(point) > 2]
+    variance = min(variances) if variances else default_variance
+    return np.array([[point[0], point[1], point[2] if len(point) > 2 else variance] for point in points], dtype=np.float64).reshape(-1, 3)
+
+
+def drive_digest(lines):
+    """
+    Digest of the smoothed lines of a drive (arrays of latitude, longitude and variance), the same for the same drive
+    however many times it is smoothed.
+    """
+    digest = hashlib.sha256()
+    for points in lines:
+        digest.update(np.int64(len(points)).tobytes())
+        digest.update(np.ascontiguousarray(points, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+class LineMap:
+    """
+    Line map stored in map_path, created if it does not exist.
+    """
+
+    def __init__(self, map_path, tile_size=0.01):
+        self.map_path = map_path
+        self.tiles_path = os.path.join(map_path, 'tiles')
+        self.meta_path = os.path.join(map_path, 'meta.json')
+        os.makedirs(self.tiles_path, exist_ok=True)
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as file:
+                self.meta = json.load(file)
+        else:
+            self.meta = {'tile_size': tile_size, 'next_line_id': 0}
+        self.meta.setdefault('line_ends', {})
+        self.meta.setdefault('merged_drives', [])
+        self.tile_size = self.meta['tile_size']
+
+    def tiles_of(self, latitudes, longitudes):
+        """
+        Tile (x, y) of each point, shape (number of points, 2).
+        """
+        return np.column_stack([np.floor(np.asarray(longitudes) / self.tile_size), np.floor(np.asarray(latitudes) / self.tile_size)]).astype(np.int64)
+
+    def tile_path(self, tile):
+        return os.path.join(self.tiles_path, f'{tile[0]}_{tile[1]}.npy')
+
+    def read_tile(self, tile):
+        path = self.tile_path(tile)
+        return np.load(path) if os.path.exists(path) else np.empty(0, dtype=vertex_dtype)
+
+    def write_tile(self, tile, vertices):
+        path = self.tile_path(tile)
+        if len(vertices) == 0:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        with open(path + '.tmp', 'wb') as file:
+            np.save(file, vertices)
+        os.replace(path + '.tmp', path)
+
+    def lines(self):
+        """
+        All lines of the map, as a dictionary of line id to array of (latitude, longitude, variance) points.
+        """
+        tiles = [np.load(os.path.join(self.tiles_path, name)) for name in sorted(os.listdir(self.tiles_path)) if name.endswith('.npy')]
+        vertices = np.concatenate(tiles) if tiles else np.empty(0, dtype=vertex_dtype)
+        vertices = vertices[np.lexsort((vertices['vertex'], vertices['line_id']))]
+        line_starts = np.flatnonzero(np.r_[True, vertices['line_id'][1:] != vertices['line_id'][:-1]]) if len(vertices) else np.empty(0, dtype=np.intp)
+        line_ends = np.r_[line_starts[1:], len(vertices)]
+        points = np.column_stack([vertices['latitude'], vertices['longitude'], vertices['variance']])
+        return {int(vertices['line_id'][first]): points[first:last] for first, last in zip(line_starts, line_ends)}
+
+    def merge(self, aggregated_lines, merge_distance=lines_merge_distance_threshold, min_length=15):
+        """
+        Merge the smoothed lines of a drive into the map and save the tiles it changes.
+
+        Parameters:
+        - aggregated_lines: Iterable of (line id, points) of the drive, as returned by aggregate_lines(...).items() or
+          aggregate_lines_streaming. The line ids are not kept.
+        - merge_distance: Points of the map and of the drive closer than this (meters) are fused.
+        - min_length: Lines of the drive shorter than this (meters) are ignored, as in save_smoothed_lines_kml.
+
+        Returns:
+        - Number of map vertices fused and of vertices added. A drive already merged is not merged again (0, 0).
+        """
+        new_lines = [line_points_with_variance(points) for _, points in aggregated_lines if line_length(points) >= min_length]
+        new_lines = [points for points in new_lines if len(points) >= 2]
+        if not new_lines:
+            return 0, 0
+        digest = drive_digest(new_lines)
+        if digest in self.meta['merged_drives']:
+            warnings.warn(f"The drive {digest[:12]} is already merged into {self.map_path}, it is not merged again")
+            return 0, 0
+
+        # Read the tiles of the drive and the tiles around them
+        new_points = np.concatenate(new_lines)
+        drive_tiles = np.unique(self.tiles_of(new_points[:, 0], new_points[:, 1]), axis=0)
+        ring = np.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+        tiles = [tuple(tile) for tile in np.unique((drive_tiles[:, np.newaxis] + ring).reshape(-1, 2), axis=0).tolist()]
+        loaded = [self.read_tile(tile) for tile in tiles]
+        vertices = np.concatenate(loaded) if loaded else np.empty(0, dtype=vertex_dtype)
+        vertices = vertices[np.lexsort((vertices['vertex'], vertices['line_id']))]
+
+        # Segments between consecutive vertices of the map lines, and every vertex as a segment of its own
+        same_line = vertices['line_id'][1:] == vertices['line_id'][:-1]
+        segment_starts = np.r_[np.flatnonzero(same_line), np.arange(len(vertices))].astype(np.intp)
+        segment_ends = np.r_[np.flatnonzero(same_line) + 1, np.arange(len(vertices))].astype(np.intp)
+        map_xyz = to_cartesian(vertices['latitude'], vertices['longitude'])
+
+        # Segments of the lines of the drive
+        new_line_index = np.repeat(np.arange(len(new_lines)), [len(points) for points in new_lines])
+        new_xyz = to_cartesian(new_points[:, 0], new_points[:, 1])
+        new_segment_starts = np.flatnonzero(new_line_index[1:] == new_line_index[:-1])
+        new_segment_ends = new_segment_starts + 1
+
+        # The map vertices are matched before any of them moves: fuse each with the closest point of the drive
+        segment, t, _ = closest_segments(map_xyz, new_xyz[new_segment_starts], new_xyz[new_segment_ends], merge_distance)
+        fused = np.flatnonzero(segment >= 0)
+        start_points = new_points[new_segment_starts[segment[fused]]]
+        end_points = new_points[new_segment_ends[segment[fused]]]
+        drive_points = start_points + t[fused, np.newaxis] * (end_points - start_points)
+
+        # Drive points close to the map are represented by the fused map vertices, the others are added
+        covered_segment, covered_t, _ = closest_segments(new_xyz, map_xyz[segment_starts], map_xyz[segment_ends], merge_distance)
+        for vertex, drive_point in zip(fused, drive_points):
+            point = (vertices['latitude'][vertex], vertices['longitude'][vertex], vertices['variance'][vertex])
+            vertices['latitude'][vertex], vertices['longitude'][vertex], vertices['variance'][vertex] = combine_points_with_variance([point, drive_point])
+
+        added = self.add_uncovered_points(vertices, new_lines, covered_segment, covered_t, segment_starts, segment_ends)
+
+        # Write the tiles back, each vertex to the tile it is in now
+        vertices = np.concatenate([vertices, added])
+        vertex_tiles = self.tiles_of(vertices['latitude'], vertices['longitude'])
+        for tile in tiles:
+            self.write_tile(tile, vertices[(vertex_tiles[:, 0] == tile[0]) & (vertex_tiles[:, 1] == tile[1])])
+        self.meta['merged_drives'].append(digest)
+        with open(self.meta_path + '.tmp', 'w') as file:
+            json.dump(self.meta, file)
+        os.replace(self.meta_path + '.tmp', self.meta_path)
+        return len(fused), len(added)
+
+    def add_uncovered_points(self, vertices, new_lines, covered_segment, covered_t, segment_starts, segment_ends):
+        """
+        Vertices for the runs of drive points that are not close to the map. A run continuing a map line past
+        one of its ends extends it, the other runs of at least two points become new lines.
+        """
+        line_ids = vertices['line_id']
+        line_ends = self.meta['line_ends']  # First and last vertex of each line, by line id (a string in JSON)
+        for line_id, vertex in zip(line_ids.tolist(), vertices['vertex'].tolist()):
+            # The recorded ends contain every vertex, this only fills in the lines of maps written without them
+            ends = line_ends.setdefault(str(line_id), [vertex, vertex])
+            ends[0], ends[1] = min(ends[0], vertex), max(ends[1], vertex)
+        extended = set()
+
+        def map_end(point_number):
+            """
+            Map line end (line id, 'first' or 'last') closest to a covered drive point, None if the closest
+            point of the map is not the end of a line.
+            """
+            segment = covered_segment[point_number]
+            if covered_t[point_number] == 0:
+                vertex = segment_starts[segment]
+            elif covered_t[point_number] == 1:
+                vertex = segment_ends[segment]
+            else:
+                return None
+            line_id = int(line_ids[vertex])
+            if vertices['vertex'][vertex] == line_ends[str(line_id)][1]:
+                return line_id, 'last'
+            if vertices['vertex'][vertex] == line_ends[str(line_id)][0]:
+                return line_id, 'first'
+            return None
+
+        added = []
+        offset = 0
+        for points in new_lines:
+            covered = covered_segment[offset:offset + len(points)] >= 0
+            run_starts = np.flatnonzero(~covered & np.r_[True, covered[:-1]])
+            run_ends = np.flatnonzero(~covered & np.r_[covered[1:], True]) + 1
+            for first, last in zip(run_starts.tolist(), run_ends.tolist()):
+                # Extend the map line ending next to the run, with the run ordered away from it
+                end = None
+                if first > 0:
+                    end, run = map_end(offset + first - 1), points[first:last]
+                if end is None and last < len(points):
+                    end, run = map_end(offset + last), points[first:last][::-1]
+                if end is not None and end not in extended:
+                    extended.add(end)
+                    line_id, side = end
+                    if side == 'last':
+                        indices = line_ends[str(line_id)][1] + 1 + np.arange(len(run))
+                        line_ends[str(line_id)][1] = int(indices[-1])
+                    else:
+                        indices = line_ends[str(line_id)][0] - 1 - np.arange(len(run))
+                        line_ends[str(line_id)][0] = int(indices[-1])
+                elif last - first >= 2:
+                    line_id, run = self.meta['next_line_id'], points[first:last]
+                    self.meta['next_line_id'] += 1
+                    indices = np.arange(len(run))
+                    line_ends[str(line_id)] = [0, len(run) - 1]
+                else:
+                    continue
+
+                run_vertices = np.empty(len(run), dtype=vertex_dtype)
+                run_vertices['line_id'] = line_id
+                run_vertices['vertex'] = indices
+                run_vertices['latitude'], run_vertices['longitude'], run_vertices['variance'] = run.T
+                added.append(run_vertices)
+            offset += len(points)
+
+        return np.concatenate(added) if added else np.empty(0, dtype=vertex_dtype)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Merge drives into a persistent line map, or export it to KML')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    merge_parser = subparsers.add_parser('merge', help='smooth the lines of a drive and merge them into the map')
+    merge_parser.add_argument('map', type=str, help='line map directory, created if it does not exist')
+    merge_parser.add_argument('--lines', type=str, default='output_jsons/lines_coords.lines', help='georeferenced lines of the drive (line store)')
+    merge_parser.add_argument('--look-ahead', type=float, default=look_ahead_distance, help='look-ahead of the streaming smoothing (meters)')
+    export_parser = subparsers.add_parser('export', help='write all lines of the map to a KML file')
+    export_parser.add_argument('map', type=str, help='line map directory')
+    export_parser.add_argument('kml', type=str, help='output KML file')
+    args = parser.parse_args()
+
+    line_map = LineMap(args.map)
+    if args.command == 'merge':
+        fused, added = line_map.merge(aggregate_lines_streaming(iter_frames(load_lines(args.lines)), args.look_ahead))
+        print(f"{fused} map vertices fused and {added} vertices added.")
+    else:
+        write_smoothed_lines_kml(line_map.lines().items(), args.kml)
+        print(f"KML file has been saved to {args.kml}")
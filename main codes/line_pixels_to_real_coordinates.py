@@ -1,147 +1,195 @@
-import cv2
 import numpy as np
-import math
-from simplekml import Kml, Color
 import json
 import os
-from datetime import datetime
-from tqdm import tqdm  
+from line_store import load_lines, save_lines, select_lines, export_json, iter_frames
+import kml_writer
+from kml_writer import KmlWriter
+from sensor_ingest import recording_time_base, load_location_json
+from pose_track import build_pose_index, interpolated_pose_track, magnetic_deviation
 
 '''
-This script processes each frame containing lines that are stored in 'filtered_lines_by_length_and_slope_and_yaw.json'.
-It finds the timestamp for each frame and then finds the closest location and magnetic heading data for that timestamp.
-Finally, it calculates the GPS coordinates of the start and end points of each line and writes them into a KML file.
+This script processes each frame containing lines that are stored in the line store of the noise filter output
+('3_filtered_lines_by_length_and_slope_and_yaw_and_closeLines.lines').
+It looks up the location and heading of the vehicle at each frame in the pose track written by pose_track.py, or
+interpolates the location and magnetic heading data at the timestamp of each frame if there is none.
+Finally, it calculates the GPS coordinates of the start and end points of all lines at once, and saves them to a line
+store ('lines_coords.lines') and optionally to a KML file.
+The points on the top view are offsets (east, north) in the local tangent plane (ENU) of the vehicle, which are
+converted to latitude and longitude with the radii of curvature of the WGS84 ellipsoid at the vehicle's latitude.
 '''
 
-# Helper function to convert location timestamp to seconds from start of the day
-def location_timestamp_to_seconds(timestamp_str):
-    dt = datetime.strptime(timestamp_str, '%Y%m%d.%H%M%S.%f')
-    seconds = (dt - dt.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
-    return seconds
-
-# Helper function to convert frame timestamp to seconds
-def frame_timestamp_to_seconds(timestamp_str):
-    dt = datetime.strptime(timestamp_str, '%H%M%S.%f')
-    seconds = dt.hour * 3600 + dt.minute * 60 + dt.second + dt.microsecond / 1e6
-    return seconds
-
-# Helper function to find the closest timestamp in location data
-def find_closest_timestamp(target_timestamp, data):
-    target_seconds = frame_timestamp_to_seconds(target_timestamp)
-    min_diff = float('inf')
-    closest_entry = None
-    for entry in data:
-        entry_timestamp = entry['time']
-        entry_seconds = location_timestamp_to_seconds(entry_timestamp)
-        diff = abs(entry_seconds - target_seconds)
-        if diff < min_diff:
-            min_diff = diff
-            closest_entry = entry
-    return closest_entry
-
-
-# Initialize KML
-kml = Kml()
-
-motion_data_file_path = "locations_data/locations_and_magneticHeadings.json"
-timestamp_file_path = 'output_jsons/timestamp_of_each_frame.json'
-lines_data_path = 'output_jsons/3_filtered_lines_by_length_and_slope_and_yaw_and_closeLines.json'
-
-with open(motion_data_file_path, 'r') as file:
-    location_data = json.load(file)
-
-with open(timestamp_file_path, 'r') as timestamp_file:
-    timestamp_data = json.load(timestamp_file)
-
-with open(lines_data_path, 'r') as lines_file:
-    lines_data = json.load(lines_file)
-
 ref_pixel = (115, 170)  # Reference pixel coordinates in the image. we have the GPS coordinates of this pixel
 pixel_scale_cm = 10  # GPS coordinates scale (1 pixel = 10 cm)
-lines_geo_data = []
-
-# Process each frame in lines_data
-for frame_data in tqdm(lines_data):
-    frame_number = frame_data['framenumber']
-    
-    # Find the corresponding timestamp for the frame number
-    frame_timestamp = next((item['timestamp'] for item in timestamp_data if item['frame'] == frame_number), None)
-    if not frame_timestamp:
-        continue
-    
-    # Find the closest timestamp entry in location data
-    closest_entry = find_closest_timestamp(frame_timestamp, location_data)
-    if not closest_entry:
-        continue
-
-    # Extract location and heading data from the closest entry
+
+# WGS84 ellipsoid
+wgs84_a = 6378137.0  # Semi-major axis (meters)
+wgs84_f = 1 / 298.257223563  # Flattening
+wgs84_e2 = wgs84_f * (2 - wgs84_f)  # First eccentricity squared
+
+
+def camera_direction(magnetic_headings):
+    """
+    Direction (degrees from true north) from the reference pixel to the top of the image, for the magnetic heading
+    of the mobile phone (the phone is mounted at 270 degrees to the camera).
+    """
+    return np.mod(np.asarray(magnetic_headings, dtype=np.float64) - 270 + magnetic_deviation, 360)
+
+def top_view_to_geodetic(x, y, latitudes, longitudes, magnetic_headings):
+    """
+    GPS coordinates of points on the top view, all points in one call.
+
+    Parameters:
+    - x, y: Pixel coordinates of the points on the top view.
+    - latitudes, longitudes, magnetic_headings: Pose of the vehicle when each point was seen.
+
+    Returns:
+    - Arrays of latitudes and longitudes of the points.
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    direction = np.radians(camera_direction(magnetic_headings))
+
+    # Offsets from the reference pixel (meters): forward is up in the image, left is towards smaller x
+    forward = (ref_pixel[1] - np.asarray(y, dtype=np.float64)) * pixel_scale_cm / 100
+    left = (ref_pixel[0] - np.asarray(x, dtype=np.float64)) * pixel_scale_cm / 100
+
+    # Rotate to east and north in the local tangent plane
+    north = forward * np.cos(direction) + left * np.sin(direction)
+    east = forward * np.sin(direction) - left * np.cos(direction)
+
+    # Meridional and prime vertical radii of curvature at the vehicle's latitude
+    sin_latitude = np.sin(np.radians(latitudes))
+    w = np.sqrt(1 - wgs84_e2 * sin_latitude**2)
+    meridional_radius = wgs84_a * (1 - wgs84_e2) / w**3
+    prime_vertical_radius = wgs84_a / w
+
+    point_latitudes = latitudes + np.degrees(north / meridional_radius)
+    point_longitudes = np.asarray(longitudes, dtype=np.float64) + np.degrees(east / (prime_vertical_radius * np.cos(np.radians(latitudes))))
+    return point_latitudes, point_longitudes
+
+def georeference_lines(lines, pose_track):
+    """
+    Calculate the GPS coordinates of the start and end points of all lines of a line table at once.
+    Lines of frames without a pose are dropped.
+
+    Parameters:
+    - lines: Line table with the lines on the top view (see line_store.py).
+    - pose_track: Pose of the vehicle at every frame, indexed by frame number (see pose_track.py).
+
+    Returns:
+    - Line table with the GPS coordinates of the lines and of the vehicle.
+    """
+    frame_numbers, frame_of_line = np.unique(lines['frame'], return_inverse=True)
+    has_pose = (frame_numbers >= 0) & (frame_numbers < len(pose_track))
+    poses = pose_track[frame_numbers[has_pose]]
+    has_pose[has_pose] = ~np.isnan(poses['latitude'])
+    poses = poses[~np.isnan(poses['latitude'])]
+    lines = select_lines(lines, has_pose[frame_of_line])
+    frame_of_line = (np.cumsum(has_pose) - 1)[frame_of_line[has_pose[frame_of_line]]]
+
+    latitudes, longitudes, headings = poses['latitude'][frame_of_line], poses['longitude'][frame_of_line], poses['magnetic_heading'][frame_of_line]
+
+    start_latitudes, start_longitudes = top_view_to_geodetic(lines['start_x'], lines['start_y'], latitudes, longitudes, headings)
+    end_latitudes, end_longitudes = top_view_to_geodetic(lines['end_x'], lines['end_y'], latitudes, longitudes, headings)
+    return {
+        'frame': lines['frame'],
+        'line_id': lines['line_id'],
+        'start_latitude': start_latitudes,
+        'start_longitude': start_longitudes,
+        'end_latitude': end_latitudes,
+        'end_longitude': end_longitudes,
+        'latitude': latitudes,
+        'longitude': longitudes,
+    }
+
+def georeference_frame(frame_data, closest_entry):
+    """
+    Calculate the GPS coordinates of the start and end points of the lines of one frame.
+
+    Parameters:
+    - frame_data: Frame with lines on the top view.
+    - closest_entry: Location and magnetic heading of the vehicle at the frame's timestamp (see pose_track.pose_at).
+
+    Returns:
+    - Frame with its location ('coords') and the GPS coordinates of its lines.
+    """
     latitude_ref = closest_entry['latitude']
     longitude_ref = closest_entry['longitude']
-    mobile_magnetic_heading = closest_entry['magneticHeading']
-
-    camera_heading = mobile_magnetic_heading - 270
-    magnetic_deviation = 5.08
-    # Direction angle from the reference pixel to the top of the image
-    direction_angle_deg = camera_heading +  magnetic_deviation
-    if direction_angle_deg < 0:
-        direction_angle_deg += 360 
 
-    # Convert direction angle to radians
-    direction_angle_rad = math.radians(direction_angle_deg)
-
-    # Calculate distance between pixels in GPS coordinates (assuming a flat Earth approximation)
-    gps_distance_per_pixel = pixel_scale_cm / 11132000  ## 100000km = 1cm , each 111.32 km = 1 degree
+    lines_pixel_on_top_view = frame_data.get('lines_pixel_on_top_view', {})
+    points = np.array([line_coords[end] for line_coords in lines_pixel_on_top_view.values() for end in ('start', 'end')], dtype=np.float64).reshape(-1, 2)
+    point_latitudes, point_longitudes = top_view_to_geodetic(points[:, 0], points[:, 1], latitude_ref, longitude_ref, closest_entry['magneticHeading'])
+    point_latitudes, point_longitudes = point_latitudes.tolist(), point_longitudes.tolist()
 
-    # Prepare a dictionary for the current frame's lines with geographic coordinates
     frame_lines_geo = {
-        'framenumber': frame_number,
+        'framenumber': frame_data['framenumber'],
         'coords': [latitude_ref, longitude_ref],
         'lines_pixel_on_top_view': {}
-    }  
-    
-    # Process each line in the current frame data
-    lines_pixel_on_top_view = frame_data.get('lines_pixel_on_top_view', {})
-    for line_id, line_coords in lines_pixel_on_top_view.items():
-        start_pixel = line_coords['start']
-        end_pixel = line_coords['end']
-
-        # Calculate offsets from reference pixel for start point
-        dx_start =  ref_pixel[0] - start_pixel[0] 
-        dy_start =  ref_pixel[1] - start_pixel[1]
-        distance_start_pixels = math.sqrt(dx_start**2 + dy_start**2)
-        angle_start_rad = math.atan2(dx_start, dy_start)
-        angle_start_true_north_rad = direction_angle_rad - angle_start_rad
-        delta_start_latitude = gps_distance_per_pixel * distance_start_pixels * math.cos(angle_start_true_north_rad)
-        delta_start_longitude = gps_distance_per_pixel * distance_start_pixels * math.sin(angle_start_true_north_rad)
-        start_latitude = latitude_ref + delta_start_latitude
-        start_longitude = longitude_ref + delta_start_longitude
-
-        # Calculate offsets from reference pixel for end point
-        dx_end = ref_pixel[0] - end_pixel[0]
-        dy_end = ref_pixel[1] - end_pixel[1]
-        distance_end_pixels = math.sqrt(dx_end**2 + dy_end**2)
-        angle_end_rad = math.atan2(dx_end, dy_end)
-        angle_end_true_north_rad = direction_angle_rad - angle_end_rad
-        delta_end_latitude = gps_distance_per_pixel * distance_end_pixels * math.cos(angle_end_true_north_rad)
-        delta_end_longitude = gps_distance_per_pixel * distance_end_pixels * math.sin(angle_end_true_north_rad)
-        end_latitude = latitude_ref + delta_end_latitude
-        end_longitude = longitude_ref + delta_end_longitude
-
-        # Add line to KML with yellow dashed style
-        line = kml.newlinestring(coords=[(start_longitude, start_latitude), (end_longitude, end_latitude)])
-        line.style.linestyle.color = Color.yellow
-        line.style.linestyle.width = 1 
-
+    }
+    for i, line_id in enumerate(lines_pixel_on_top_view):
         frame_lines_geo['lines_pixel_on_top_view'][line_id] = {
-            'start': [start_latitude, start_longitude],
-            'end': [end_latitude, end_longitude]
+            'start': [point_latitudes[2 * i], point_longitudes[2 * i]],
+            'end': [point_latitudes[2 * i + 1], point_longitudes[2 * i + 1]]
         }
 
-    # Append the frame's line data to the list
-    lines_geo_data.append(frame_lines_geo)
-
-with open('output_jsons/lines_coords.json', 'w') as lines_coord_file:
-    json.dump(lines_geo_data, lines_coord_file, indent=4)
-
-# Save KML file
-kml.save("output_kmls/filtered_lines(initial_output)/3_length_slope_closeLines_filter.kml")
+    return frame_lines_geo
+
+def open_lines_kml(output_file_path):
+    """
+    KmlWriter for the georeferenced lines of the frames, with their shared yellow line style.
+    """
+    kml = KmlWriter(output_file_path)
+    kml.add_line_style('frame_lines', color=kml_writer.yellow, width=1)
+    return kml
+
+def add_frame_lines_to_kml(kml, frame_lines_geo):
+    """
+    Add the lines of a georeferenced frame to a KmlWriter opened with open_lines_kml, as one placemark.
+    """
+    lines = [[(start_longitude, start_latitude), (end_longitude, end_latitude)]
+             for (start_latitude, start_longitude), (end_latitude, end_longitude) in
+             ((line_coords['start'], line_coords['end']) for line_coords in frame_lines_geo['lines_pixel_on_top_view'].values())]
+    if lines:
+        kml.add_multilinestring(f"Frame {frame_lines_geo['framenumber']}", lines, 'frame_lines')
+
+def save_lines_kml(lines, output_file_path):
+    """
+    Write the georeferenced lines of a line table to a KML (or KMZ) file, one yellow placemark per frame.
+    """
+    with open_lines_kml(output_file_path) as kml:
+        for frame_lines_geo in iter_frames(lines):
+            add_frame_lines_to_kml(kml, frame_lines_geo)
+
+
+if __name__ == '__main__':
+    motion_data_file_path = "locations_data/locations_and_magneticHeadings.json"
+    metadata_file_path = "motion_data/Metadata.csv"  # timezone and start of the recording, if recorded with Sensor Logger
+    timestamp_file_path = 'output_jsons/timestamp_of_each_frame.json'
+    lines_data_path = 'output_jsons/3_filtered_lines_by_length_and_slope_and_yaw_and_closeLines.lines'
+    pose_track_path = 'output_jsons/pose_track.npy'  # written by pose_track.py
+    output_lines_path = 'output_jsons/lines_coords.lines'
+    write_json = False  # also write the georeferenced lines to output_jsons/lines_coords.json
+    write_kml = True  # also write the georeferenced lines to output_kml_path
+    output_kml_path = "output_kmls/filtered_lines(initial_output)/3_length_slope_closeLines_filter.kml"
+
+    base = recording_time_base(metadata_file_path, motion_data_file_path)
+    locations = load_location_json(motion_data_file_path, base)
+
+    with open(timestamp_file_path, 'r') as timestamp_file:
+        timestamp_data = json.load(timestamp_file)
+    frame_timestamps = {item['frame']: item['timestamp'] for item in timestamp_data}
+
+    # Georeference all lines at once, with the pose of each frame looked up in the pose track written by
+    # pose_track.py, or with the location and heading interpolated at the timestamp of each frame without one
+    if os.path.exists(pose_track_path):
+        pose_track = np.load(pose_track_path, mmap_mode='r')
+    else:
+        pose_track = interpolated_pose_track(frame_timestamps, build_pose_index(locations, base))
+    lines_geo = georeference_lines(load_lines(lines_data_path), pose_track)
+
+    save_lines(output_lines_path, lines_geo)
+    if write_json:
+        export_json(output_lines_path, 'output_jsons/lines_coords.json')
+
+    # Save KML file
+    if write_kml:
+        save_lines_kml(lines_geo, output_kml_path)
@@ -0,0 +1,148 @@
+import argparse
+import json
+import os
+import numpy as np
+
+'''
+A columnar store for the lines of a drive, replacing the nested per-frame JSON files written by each step.
+Every column is a .npy file in the store directory and is memory-mapped when the store is read, so a step can
+work on all lines of a drive without parsing anything:
+
+- frame, line_id: Frame number, and id of the line within its frame.
+- start_x, start_y, end_x, end_y: Start and end points of the line on the top view (pixels).
+- start_latitude, start_longitude, end_latitude, end_longitude, latitude, longitude: GPS coordinates of the
+  start and end points of the line and of the vehicle, for georeferenced lines (lines_coords).
+- meta.json: The columns of the store.
+
+The lines of a frame are stored next to each other, in the same order as in the JSON files, and the frames are
+sorted by frame number. Frames without any line are not stored. The JSON format is still available with export_json (or by running this file).
+'''
+
+pixel_columns = ('frame', 'line_id', 'start_x', 'start_y', 'end_x', 'end_y')
+geo_columns = ('frame', 'line_id', 'start_latitude', 'start_longitude', 'end_latitude', 'end_longitude', 'latitude', 'longitude')
+column_dtypes = {'frame': np.dtype('<i8'), 'line_id': np.dtype('<i4')}
+
+
+def save_lines(store_path, lines):
+    """
+    Write a line table (dictionary of equally long column arrays) to a store directory.
+    """
+    os.makedirs(store_path, exist_ok=True)
+    for column, values in lines.items():
+        np.save(os.path.join(store_path, column + '.npy'), np.asarray(values, dtype=column_dtypes.get(column, np.dtype('<f8'))))
+    with open(os.path.join(store_path, 'meta.json'), 'w') as file:
+        json.dump({'columns': list(lines.keys())}, file)
+
+def load_lines(store_path):
+    """
+    Memory-map the columns of a store.
+
+    Returns:
+    - Dictionary of column name to (read-only) array.
+    """
+    with open(os.path.join(store_path, 'meta.json'), 'r') as file:
+        columns = json.load(file)['columns']
+    return {column: np.load(os.path.join(store_path, column + '.npy'), mmap_mode='r') for column in columns}
+
+def select_lines(lines, index):
+    """
+    Rows of a line table selected by a boolean mask or an array of row indices, in that order.
+    """
+    return {column: np.asarray(values)[index] for column, values in lines.items()}
+
+def is_georeferenced(lines):
+    return 'latitude' in lines
+
+def frames_to_lines(frames):
+    """
+    Convert a list of frames in the JSON format ({"framenumber", "lines_pixel_on_top_view", ["coords"]}) to a
+    line table. Frames with "coords" are georeferenced, their points are (latitude, longitude).
+    """
+    georeferenced = len(frames) > 0 and 'coords' in frames[0]
+    rows = []
+    for frame in frames:
+        for line_id, line_coords in frame['lines_pixel_on_top_view'].items():
+            row = [frame['framenumber'], int(line_id), *line_coords['start'], *line_coords['end']]
+            if georeferenced:
+                row += frame['coords']
+            rows.append(row)
+
+    columns = geo_columns if georeferenced else pixel_columns
+    table = np.array(rows, dtype=np.float64).reshape(-1, len(columns))
+    lines = {column: table[:, i] for i, column in enumerate(columns)}
+    lines['frame'] = np.array([row[0] for row in rows], dtype=column_dtypes['frame'])
+    lines['line_id'] = np.array([row[1] for row in rows], dtype=column_dtypes['line_id'])
+    return lines
+
+def lines_to_frames(lines):
+    """
+    Convert a line table back to a list of frames in the JSON format.
+    """
+    return list(iter_frames(lines))
+
+def iter_frames(lines, chunk_size=100000):
+    """
+    Frames of a line table in the JSON format, one after the other. The columns are read chunk_size lines at a
+    time, so frames can be streamed from a memory-mapped store of any size.
+    """
+    frame_numbers = lines['frame']
+    georeferenced = is_georeferenced(lines)
+    first = 0
+    while first < len(frame_numbers):
+        # Read whole frames only: the chunk ends before the first line of the last frame it reaches, unless that
+        # frame alone is longer than a chunk (the frames are sorted, so the binary search only reads a few pages)
+        last = min(first + chunk_size, len(frame_numbers))
+        if last < len(frame_numbers):
+            last_frame = frame_numbers[last]
+            last = first + int(np.searchsorted(frame_numbers[first:], last_frame, side='left'))
+            if last == first:
+                last = first + int(np.searchsorted(frame_numbers[first:], last_frame, side='right'))
+        yield from _chunk_to_frames({column: np.asarray(values[first:last]) for column, values in lines.items()}, georeferenced)
+        first = last
+
+def _chunk_to_frames(lines, georeferenced):
+    frames = []
+    frame_numbers = lines['frame']
+    if len(frame_numbers) == 0:
+        return frames
+    if georeferenced:
+        start = np.column_stack([lines['start_latitude'], lines['start_longitude']]).tolist()
+        end = np.column_stack([lines['end_latitude'], lines['end_longitude']]).tolist()
+        coords = np.column_stack([lines['latitude'], lines['longitude']]).tolist()
+    else:
+        start = np.column_stack([lines['start_x'], lines['start_y']]).tolist()
+        end = np.column_stack([lines['end_x'], lines['end_y']]).tolist()
+        coords = None
+    line_ids = lines['line_id'].tolist()
+
+    frame_starts = np.flatnonzero(np.r_[True, frame_numbers[1:] != frame_numbers[:-1]])
+    frame_ends = np.r_[frame_starts[1:], len(frame_numbers)]
+    for first, last in zip(frame_starts.tolist(), frame_ends.tolist()):
+        frame = {"framenumber": int(frame_numbers[first])}
+        if coords is not None:
+            frame["coords"] = coords[first]
+        frame["lines_pixel_on_top_view"] = {str(line_ids[i]): {"start": start[i], "end": end[i]} for i in range(first, last)}
+        frames.append(frame)
+    return frames
+
+def export_json(store_path, output_file_path):
+    with open(output_file_path, 'w') as file:
+        json.dump(lines_to_frames(load_lines(store_path)), file, indent=4)
+
+def import_json(input_file_path, store_path):
+    with open(input_file_path, 'r') as file:
+        save_lines(store_path, frames_to_lines(json.load(file)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Convert between line stores and the JSON files in output_jsons')
+    parser.add_argument('command', choices=['export', 'import'], help='export a store to JSON, or import a JSON file into a store')
+    parser.add_argument('store', type=str, help='line store directory')
+    parser.add_argument('json', type=str, help='JSON file')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_json(args.store, args.json)
+    else:
+        import_json(args.json, args.store)
+    print("Done!")
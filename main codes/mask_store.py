@@ -0,0 +1,140 @@
+import json
+import os
+import numpy as np
+
+'''
+A single store for the lane instance masks of a whole drive, replacing one PNG per frame.
+LaneAF decodes the lane instances at a quarter of the input resolution (144x416 for a 576x1664 input) and
+only a few hundred pixels of each frame belong to a lane, so only the labelled pixels are kept, at the model's
+native resolution:
+
+- pixels.bin: (y, x, label) of every labelled pixel of every frame, appended in chunks of frames.
+- index.npy: frame number, offset and pixel count of each frame in pixels.bin, sorted by frame number.
+- meta.json: native size of the masks and the size of the model input they are upsampled to.
+
+pixels.bin and index.npy are memory-mapped when reading, so a frame can be read without loading the drive.
+'''
+
+pixel_dtype = np.dtype([('y', '<u2'), ('x', '<u2'), ('label', 'u1')])
+index_dtype = np.dtype([('frame', '<i8'), ('offset', '<i8'), ('count', '<i8')])
+
+
+class MaskStoreWriter:
+    """
+    Append the lane instance masks of a drive to a mask store, in chunks of chunk_frames frames.
+
+    Parameters:
+    - store_path: Directory of the store, created if it does not exist. An existing store is overwritten.
+    - mask_shape: (height, width) of the masks at native resolution.
+    - output_shape: (height, width) the masks are upsampled to for the line fitting (the model input size).
+    - chunk_frames: Number of frames buffered before they are written to disk.
+    """
+
+    def __init__(self, store_path, mask_shape, output_shape=(576, 1664), chunk_frames=256):
+        os.makedirs(store_path, exist_ok=True)
+        self.store_path = store_path
+        self.chunk_frames = chunk_frames
+        self.pixels_file = open(os.path.join(store_path, 'pixels.bin'), 'wb')
+        self.index = []
+        self.chunk = []
+        self.offset = 0
+
+        with open(os.path.join(store_path, 'meta.json'), 'w') as file:
+            json.dump({'mask_shape': list(mask_shape), 'output_shape': list(output_shape)}, file)
+
+    def add(self, frame_number, seg_out):
+        """
+        Add the decoded lane instances (label image, 0 for background) of one frame.
+        """
+        y, x = np.nonzero(seg_out)
+        self.add_pixels(frame_number, y, x, seg_out[y, x])
+
+    def add_pixels(self, frame_number, y, x, labels):
+        """
+        Add the labelled pixels of one frame, already in sparse form.
+        """
+        pixels = np.empty(len(y), dtype=pixel_dtype)
+        pixels['y'] = y
+        pixels['x'] = x
+        pixels['label'] = labels
+        self.index.append((frame_number, self.offset, len(pixels)))
+        self.offset += len(pixels)
+        self.chunk.append(pixels)
+        if len(self.chunk) >= self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        if self.chunk:
+            np.concatenate(self.chunk).tofile(self.pixels_file)
+            self.chunk = []
+        self.pixels_file.flush()
+
+        index = np.array(self.index, dtype=index_dtype)
+        np.save(os.path.join(self.store_path, 'index.npy'), index[np.argsort(index['frame'], kind='stable')])
+
+    def close(self):
+        self.flush()
+        self.pixels_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MaskStore:
+    """
+    Read-only, memory-mapped access to a mask store written by MaskStoreWriter.
+    """
+
+    def __init__(self, store_path):
+        with open(os.path.join(store_path, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+        self.mask_shape = tuple(meta['mask_shape'])
+        self.output_shape = tuple(meta['output_shape'])
+        self.index = np.load(os.path.join(store_path, 'index.npy'), mmap_mode='r')
+        pixels_path = os.path.join(store_path, 'pixels.bin')
+        if os.path.getsize(pixels_path) > 0:
+            self.pixels = np.memmap(pixels_path, dtype=pixel_dtype, mode='r')
+        else:
+            self.pixels = np.empty(0, dtype=pixel_dtype)
+
+    @property
+    def frames(self):
+        return np.asarray(self.index['frame'])
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, frame_number):
+        i = np.searchsorted(self.index['frame'], frame_number)
+        return i < len(self.index) and self.index['frame'][i] == frame_number
+
+    def read(self, frame_number):
+        """
+        Labelled pixels of one frame at native resolution.
+
+        Returns:
+        - Arrays y, x and label of the frame's pixels.
+        """
+        i = np.searchsorted(self.index['frame'], frame_number)
+        if i == len(self.index) or self.index['frame'][i] != frame_number:
+            raise KeyError(f"Frame {frame_number} is not in the mask store")
+        offset, count = int(self.index['offset'][i]), int(self.index['count'][i])
+        pixels = self.pixels[offset:offset + count]
+        return pixels['y'], pixels['x'], pixels['label']
+
+    def read_dense(self, frame_number, full_resolution=False):
+        """
+        Label image of one frame (0 for background), at native resolution or upsampled to the model
+        input size the same way as cv2.resize(..., interpolation=cv2.INTER_NEAREST).
+        """
+        y, x, labels = self.read(frame_number)
+        seg_out = np.zeros(self.mask_shape, dtype=np.uint8)
+        seg_out[y, x] = labels
+        if full_resolution:
+            rows = np.arange(self.output_shape[0]) * self.mask_shape[0] // self.output_shape[0]
+            cols = np.arange(self.output_shape[1]) * self.mask_shape[1] // self.output_shape[1]
+            seg_out = seg_out[rows[:, None], cols]
+        return seg_out
@@ -3,16 +3,21 @@ import numpy as np
 import glob
 import os
 import json
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm 
+from mask_store import MaskStore
+from line_fitting import fit_lines, mask_pixels_from_image, mask_pixels_from_store
+from line_store import frames_to_lines, save_lines
 
 '''
 This script processes predicted masks from a deep learning model (LaneAF) to identify and map lane lines.
 Each non-zero pixel in the predicted mask corresponds to a detected line, and each line is 
 clustered with a unique color value (e.g., (1,1,1), (2,2,2), etc.).
-The script fits a linear equation to the pixels of each line using linear regression. 
-It then determines the start and end points of each line. These start and end points are 
+The script fits a line to the pixels of each line using total least squares, for all lines of a mask at once
+(see line_fitting.py). It then determines the start and end points of each line. These start and end points are 
 transformed to a top-view (bird's eye view) perspective to obtain their real-world coordinates 
-relative to the camera coordinates. Finally, the positions of the lines for each frame are saved to a JSON file.
+relative to the camera coordinates. Finally, the positions of the lines for each frame are saved to a line store
+(see line_store.py), and optionally to a JSON file.
 '''
 
 
@@ -27,88 +32,67 @@ object_points = np.array([[40, 0],[40,110],[40,113],
                           [100,125],[160,125]], dtype=np.float32)
 
 input_folder = "selected_frames/every_60th_mask/"  # masks folder
+mask_store_path = None  # mask store written by mask_of_all_frames.py --mask-store, read instead of the PNGs in input_folder when set
 output_folder_fitted = "selected_frames/every_60th_fitted_lines/" # visualized fitted lines
 output_folder_birdseye = "every_60th_bird's_eye_view/"  # visualized top views
-output_json_path = "output_jsons/lines_data.json"  # position of each line (by line's startpoint and endpoint)
+output_lines_path = "output_jsons/lines_data.lines"  # position of each line (by line's startpoint and endpoint)
+output_json_path = "output_jsons/lines_data.json"  # the same, as JSON
+write_json = False  # also write output_json_path
+save_visualizations = False  # also write the fitted lines and top-view images of every frame (for debugging)
+num_workers = os.cpu_count()  # masks are processed in this many processes, 1 processes them in this process
+
+# Colors (BGR) of the visualized fitted lines for labels 1, 2, 3, 4, 5 and 6 or more
+line_colors = [(0, 0, 255), (0, 255, 0), (255, 0, 0), (255, 255, 0), (255, 0, 255), (255, 165, 0)]
 
 # Compute the homography matrix
 h, status = cv2.findHomography(image_points, object_points)
 
-frame_data = []
-
-image_paths = glob.glob(input_folder + "*.png")
+# Opened in every worker process, reading it is only memory-mapping
+mask_store = MaskStore(mask_store_path) if mask_store_path is not None else None
 
-for img_path in tqdm(image_paths, desc="Processing images"):
-    image = cv2.imread(img_path)
-    image = image[185:, :]
-    black_image = np.zeros_like(image)
 
+def mask_frame_number(img_path):
     base_name = os.path.splitext(os.path.basename(img_path))[0]
-    frame_number = int(base_name.split('_')[1])  # assuming the frame number is the second part
-
-    lines_pixel_on_top_view = {}
-
-    # Get unique colors in the image, excluding black (no line predicted)
-    unique_colors = np.unique(image.reshape(-1, image.shape[2]), axis=0)
-    unique_colors = unique_colors[~np.all(unique_colors == [0, 0, 0], axis=1)]
-    
-    for i, color in enumerate(unique_colors):
-        line_pixels = np.column_stack(np.where(np.all(image == color, axis=-1)))
-        
-        if line_pixels.size == 0: # black pixels (no line predicted)
-            continue
-        
-        # Fit a line to the pixels using linear regression
-        A = np.vstack([line_pixels[:, 1], np.ones(len(line_pixels))]).T
-        m, c = np.linalg.lstsq(A, line_pixels[:, 0], rcond=None)[0]
-        max_x = max(line_pixels[:, 1])
-        min_x = min(line_pixels[:, 1])
-
-        if int(m * max_x + c) < 0:
-            max_x = int((0 - c) / m)
-
-        if int(m * min_x + c) < 0:
-            min_x = int((0 - c) / m)
-
-        # Draw the fitted line on a black image
-        for x in range(min_x, max_x):
-            y = int(m * x + c)
-            if 0 <= y < black_image.shape[0]:
-                if (color == [1, 1, 1]).all():
-                    black_image[y, x] = [0, 0, 255]  
-                elif (color == [2, 2, 2]).all():
-                    black_image[y, x] = [0, 255, 0]  
-                elif (color == [3, 3, 3]).all():
-                    black_image[y, x] = [255, 0, 0]  
-                elif (color == [4, 4, 4]).all():
-                    black_image[y, x] = [255, 255, 0]  
-                elif (color == [5, 5, 5]).all():
-                    black_image[y, x] = [255, 0, 255]  
-                elif (color >= [6, 6, 6]).all():
-                    black_image[y, x] = [255, 165, 0]  
-
- 
-            # Determine the start and end points of the line
-            start_point = np.array([max_x, int(m * max_x + c)]) if int(m * max_x + c) > int(m * min_x + c) else np.array([min_x, int(m * min_x + c)])
-            end_point = np.array([min_x, int(m * min_x + c)]) if int(m * max_x + c) > int(m * min_x + c) else np.array([max_x, int(m * max_x + c)])
-            
-            # Transform start and end points to top-view coordinates
-            start_point_birdseye = cv2.perspectiveTransform(np.array([[start_point]], dtype=np.float32), h)
-            end_point_birdseye = cv2.perspectiveTransform(np.array([[end_point]], dtype=np.float32), h)
-            lines_pixel_on_top_view[i] = {
-                "start": start_point_birdseye[0][0].tolist(),
-                "end": end_point_birdseye[0][0].tolist()
-            }
-
-    frame_data.append({
-        "framenumber": frame_number,
-        "lines_pixel_on_top_view": lines_pixel_on_top_view
-    })
-
-    # Save the visualized fitted lines image 
-    output_path_fitted = os.path.join(output_folder_fitted, os.path.basename(img_path))
-    cv2.imwrite(output_path_fitted, black_image)
-
+    return int(base_name.split('_')[1])  # assuming the frame number is the second part
+
+def process_mask(img_path):
+    """
+    Fit the lines of one mask and optionally save the visualized fitted lines. Runs in the worker processes.
+
+    Parameters:
+    - img_path: Path of the mask PNG (or its name, when reading from the mask store).
+
+    Returns:
+    - Frame number, and the start and end points of the frame's lines in the (cropped) image.
+    """
+    frame_number = mask_frame_number(img_path)
+
+    # Labelled pixels of the frame, from a single label channel
+    if mask_store is None:
+        label_image = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
+        image_shape = label_image.shape
+        y, x, labels = mask_pixels_from_image(label_image, crop_top=185)
+    else:
+        image_shape = mask_store.output_shape
+        y, x, labels = mask_pixels_from_store(mask_store, frame_number, crop_top=185)
+
+    # Fit a line to the pixels of every lane instance at once
+    line_labels, start_points, end_points = fit_lines(y, x, labels)
+
+    if save_visualizations:
+        # Draw the fitted lines on a black image
+        black_image = np.zeros((image_shape[0] - 185, image_shape[1], 3), dtype=np.uint8)
+        for label, start_point, end_point in zip(line_labels, start_points, end_points):
+            color = line_colors[min(label, len(line_colors)) - 1]
+            cv2.line(black_image, tuple(map(int, start_point)), tuple(map(int, end_point)), color, thickness=1)
+
+        # Save the visualized fitted lines image 
+        output_path_fitted = os.path.join(output_folder_fitted, os.path.basename(img_path))
+        cv2.imwrite(output_path_fitted, black_image)
+
+    return frame_number, start_points, end_points
+
+def save_birdseye_view(img_path, lines_pixel_on_top_view):
     birdseye_view = np.zeros((170, 200, 3), dtype=np.uint8)
 
     for line_number, line_data in lines_pixel_on_top_view.items():
@@ -121,7 +105,50 @@ for img_path in tqdm(image_paths, desc="Processing images"):
     output_path_birdseye = os.path.join(output_folder_birdseye, os.path.basename(img_path))
     cv2.imwrite(output_path_birdseye, birdseye_view)
 
-with open(output_json_path, 'w') as json_file:
-    json.dump(frame_data, json_file, indent=4)
 
-print("Done!")
+if __name__ == '__main__':
+    if mask_store is None:
+        image_paths = glob.glob(input_folder + "*.png")
+    else:
+        image_paths = [f"frame_{frame_number:06d}_seg.png" for frame_number in mask_store.frames]
+
+    # Process the masks in frame order, so the output does not depend on the file system or the number of workers
+    image_paths.sort(key=mask_frame_number)
+
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            chunksize = max(1, len(image_paths) // (num_workers * 8))
+            results = list(tqdm(pool.map(process_mask, image_paths, chunksize=chunksize), total=len(image_paths), desc="Processing images"))
+    else:
+        results = [process_mask(img_path) for img_path in tqdm(image_paths, desc="Processing images")]
+
+    # Transform the start and end points of all lines of all frames to top-view coordinates at once
+    points = np.concatenate([np.concatenate([start_points, end_points]) for _, start_points, end_points in results] + [np.empty((0, 2))])
+    points_birdseye = cv2.perspectiveTransform(points.astype(np.float32)[:, np.newaxis, :], h)[:, 0, :] if len(points) > 0 else points
+
+    frame_data = []
+    offset = 0
+    for (frame_number, start_points, _), img_path in zip(results, image_paths):
+        line_count = len(start_points)
+        lines_pixel_on_top_view = {}
+        for i in range(line_count):
+            lines_pixel_on_top_view[i] = {
+                "start": points_birdseye[offset + i].tolist(),
+                "end": points_birdseye[offset + line_count + i].tolist()
+            }
+        offset += 2 * line_count
+
+        frame_data.append({
+            "framenumber": frame_number,
+            "lines_pixel_on_top_view": lines_pixel_on_top_view
+        })
+
+        if save_visualizations:
+            save_birdseye_view(img_path, lines_pixel_on_top_view)
+
+    save_lines(output_lines_path, frames_to_lines(frame_data))
+    if write_json:
+        with open(output_json_path, 'w') as json_file:
+            json.dump(frame_data, json_file, indent=4)
+
+    print("Done!")
@@ -1,11 +1,11 @@
 import json
 import numpy as np
-import matplotlib.pyplot as plt
 import csv
-from datetime import datetime
+from line_store import load_lines, save_lines, select_lines, export_json
+from sensor_ingest import time_base, recording_time_base, load_yaw_rate, frame_times_ns, seconds_between
 
 '''
-This script processes line data from a JSON file, filtering out lines based on their length and slope.
+This script processes line data from a line store (see line_store.py), filtering out lines based on their length and slope.
 We first plot the distribution of line lengths to help decide which lines may be considered noise 
 based on their length. Lines with lengths deemed non-standard or outliers can be filtered out.
 After that, we filter lines based on their slope. The aim is to remove lines with small slopes that might
@@ -14,6 +14,9 @@ lines with small slopes should not be removed as these lines are expected in suc
 Finally, we apply a distance-based filter to ensure lines are not too close to each other in a single frame.
 The distance filter works by sorting lines from left to right and keeping lines that are farther apart
 than a specified threshold distance.
+Setting 'sweep' to True instead evaluates every combination of a grid of the four thresholds in one run. The lines
+are loaded into arrays once and all combinations are filtered together, and the number of lines and frames kept
+and removed by each filter is saved to a CSV file for each combination (nothing is plotted).
 '''
 
 
@@ -21,6 +24,8 @@ def euclidean_distance(point1, point2):
     return np.sqrt(np.sum((np.array(point1) - np.array(point2)) ** 2))
 
 def plot_line_length_distribution(line_lengths):
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(10, 6))
     plt.hist(line_lengths, bins=50, color='purple', edgecolor='white')
     plt.xlabel('Line Length (meters)')
@@ -29,72 +34,34 @@ def plot_line_length_distribution(line_lengths):
     plt.grid(True)
     plt.show()
 
-def filter_lines_by_length(data, length_threshold):
+def filter_frame_by_length(frame, length_threshold):
     """
-    Filter out lines shorter than the given threshold.
-    
+    Filter out the lines of one frame shorter than the given threshold.
+
     Parameters:
-    - data: List of frames with lines information.
+    - frame: Frame with lines information.
     - length_threshold: Minimum length of lines to keep (in meters).
-    
+
     Returns:
-    - List of frames with filtered lines.
-    """
-    filtered_data = []
-    
-    for frame in data:
-        lines = frame["lines_pixel_on_top_view"]
-        filtered_lines = {}
-        
-        for line_id, line_coords in lines.items():
-            start_point = line_coords["start"]
-            end_point = line_coords["end"]
-            length = euclidean_distance(start_point, end_point) / 10  # Convert length to meters
-            
-            if length >= length_threshold:
-                filtered_lines[line_id] = line_coords
-        
-        if filtered_lines:  # Only add frame if it has lines remaining
-            filtered_data.append({
-                "framenumber": frame["framenumber"],
-                "lines_pixel_on_top_view": filtered_lines
-            })
-    
-    return filtered_data
-
-def length_filter(data, output_file_path, length_threshold=3.5, plot_histogram_before_filter=False):
-    """
-    Process lines data: optionally plot distribution and filter lines based on length.
-    
-    Parameters:
-    - data: List of frames with lines information.
-    - output_file_path: Path to the output JSON file.
-    - length_threshold: Minimum length of lines to keep (in meters).
-    - plot_histogram_before_filter: Whether to plot the histogram of line lengths before filtering.
+    - The frame with filtered lines, or None if no line remains.
     """
-    line_lengths = []
-    count = 0
-    
-    for frame in data:
-        lines = frame["lines_pixel_on_top_view"]
-        for line_id, line_coords in lines.items():
-            count += 1
-            start_point = line_coords["start"]
-            end_point = line_coords["end"]
-            length = euclidean_distance(start_point, end_point) / 10  # Convert length to meters
-            line_lengths.append(length)
-    
-    if plot_histogram_before_filter:
-        plot_line_length_distribution(line_lengths)
-    
-    filtered_data = filter_lines_by_length(data, length_threshold)
-    
-    with open(output_file_path, 'w') as file:
-        json.dump(filtered_data, file, indent=4)
-    
-    print(f"Filtered data by length saved to {output_file_path}")
-
-    return filtered_data
+    lines = frame["lines_pixel_on_top_view"]
+    filtered_lines = {}
+
+    for line_id, line_coords in lines.items():
+        start_point = line_coords["start"]
+        end_point = line_coords["end"]
+        length = euclidean_distance(start_point, end_point) / 10  # Convert length to meters
+
+        if length >= length_threshold:
+            filtered_lines[line_id] = line_coords
+
+    if not filtered_lines:
+        return None
+    return {
+        "framenumber": frame["framenumber"],
+        "lines_pixel_on_top_view": filtered_lines
+    }
 
 def calculate_slope(start_point, end_point):
     x1, y1 = start_point
@@ -103,178 +70,333 @@ def calculate_slope(start_point, end_point):
         return np.inf
     return (y2 - y1) / (x2 - x1)
 
-def read_yaw_derivative_csv(file_path):
-    yaw_derivative_data = {}
-    with open(file_path, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            yaw_derivative_data[row['exact_time']] = float(row['yaw_derivative'])
-    return yaw_derivative_data
-
-def convert_json_timestamp_to_csv_time(json_timestamp):
+def read_yaw_derivative_index(file_path, base=None):
     """
-    Convert JSON timestamp to CSV time format (HH:MM:SS).
-    
+    Read the yaw derivatives written by vehicle_angular_velocity.py (Angular_Velocity.npy, or the older
+    Angular_Velocity.csv, see sensor_ingest.load_yaw_rate_csv for how each of its samples gets its own time) into
+    a numeric time index.
+
     Parameters:
-    - json_timestamp: Timestamp string in JSON format (HHMMSS).
-    
+    - file_path: Path of Angular_Velocity.npy or Angular_Velocity.csv.
+    - base: Time base of the recording (see sensor_ingest.recording_time_base). The frame timestamps are converted
+      with the same time base. Any time base works for the CSV, which only has times of day, but the .npy has
+      epoch times, so it needs the time base of the recording.
+
     Returns:
-    - Time string in CSV format (HH:MM:SS).
+    - Dictionary with the sorted time of each sample ('times', epoch nanoseconds), the yaw derivative at that time
+      ('yaw_derivatives') and the time base.
     """
-    json_time = datetime.strptime(json_timestamp[:6], '%H%M%S').time()
-    return json_time.strftime('%H:%M:%S')
+    base = base or time_base()
+    yaw_rates = load_yaw_rate(file_path, base)
+    return {'times': yaw_rates['time'], 'yaw_derivatives': yaw_rates['yaw_derivative'], 'time_base': base}
 
-def filter_lines_based_on_slope_and_yaw(data, slope_threshold, yaw_derivative_data, yaw_derivative_threshold, timestamp_data):
+def yaw_derivatives_at(times, yaw_derivative_index):
     """
-    Filter lines based on absolute slope and yaw_derivative.
-    
+    Yaw derivative interpolated at each of the given times (epoch nanoseconds), 0 outside of the recording.
+    """
+    index_times = yaw_derivative_index['times']
+    if len(index_times) == 0:
+        return np.zeros(len(times))
+    origin = index_times[0]
+    return np.interp(seconds_between(times, origin), seconds_between(index_times, origin), yaw_derivative_index['yaw_derivatives'], left=0, right=0)
+
+def frame_yaw_derivatives(frame_numbers, frame_timestamps, yaw_derivative_index):
+    """
+    Yaw derivative of the vehicle at the exact time of each frame, for all frames in one call.
+
     Parameters:
-    - data: List of frames with lines information.
-    - slope_threshold: Minimum absolute slope of lines to keep.
-    - yaw_derivative_data: Dictionary of yaw derivatives with time as key.
-    - yaw_derivative_threshold: Minimum yaw derivative value to keep lines.
-    - timestamp_data: List of timestamp data.
-    
+    - frame_numbers: Frame numbers.
+    - frame_timestamps: Dictionary of frame timestamps with frame number as key.
+    - yaw_derivative_index: Time index returned by read_yaw_derivative_index.
+
     Returns:
-    - List of frames with filtered lines.
+    - Array of the yaw derivative of each frame.
     """
-    filtered_data_by_length = []
-    
-    for frame in data:
-        framenumber = frame["framenumber"]
-        lines = frame["lines_pixel_on_top_view"]
-        filtered_lines = {}
-        
-        json_timestamp = next(item for item in timestamp_data if item["frame"] == framenumber)["timestamp"]
-        exact_time = convert_json_timestamp_to_csv_time(json_timestamp)
-        
-        yaw_derivative = yaw_derivative_data.get(exact_time, 0)
-        
-        for line_id, line_coords in lines.items():
-            start_point = line_coords["start"]
-            end_point = line_coords["end"]
-            slope = calculate_slope(start_point, end_point)
-            abs_slope = abs(slope)
-            
-            if abs_slope >= slope_threshold or abs(yaw_derivative) > yaw_derivative_threshold:
-                filtered_lines[line_id] = {
-                    "start": start_point,
-                    "end": end_point
-                }
-
-        if filtered_lines:
-            filtered_data_by_length.append({
-                "framenumber": framenumber,
-                "lines_pixel_on_top_view": filtered_lines
-            })
-    return filtered_data_by_length
-
-def slope_filter(data, timestamp_data, yaw_derivative_data, output_file_path, slope_threshold, yaw_derivative_threshold):
+    times = frame_times_ns([frame_timestamps[frame_number] for frame_number in frame_numbers], yaw_derivative_index['time_base'])
+    return yaw_derivatives_at(times, yaw_derivative_index)
+
+def filter_frame_by_slope_and_yaw(frame, slope_threshold, yaw_derivative, yaw_derivative_threshold):
     """
-    Filter lines based on slope and yaw derivative, and save the results.
-    
+    Filter the lines of one frame based on absolute slope and the yaw derivative at the frame's time.
+
     Parameters:
-    - data: List of frames with lines information.
-    - timestamp_data: List of timestamp data.
-    - yaw_derivative_data: Dictionary of yaw derivatives with time as key.
-    - output_file_path: Path to the output JSON file.
+    - frame: Frame with lines information.
     - slope_threshold: Minimum absolute slope of lines to keep.
+    - yaw_derivative: Yaw derivative of the vehicle when the frame was recorded.
     - yaw_derivative_threshold: Minimum yaw derivative value to keep lines.
-    """
-    filtered_data = filter_lines_based_on_slope_and_yaw(data, slope_threshold, yaw_derivative_data, yaw_derivative_threshold, timestamp_data)
 
-    with open(output_file_path, 'w') as file:
-        json.dump(filtered_data, file, indent=4)
+    Returns:
+    - The frame with filtered lines, or None if no line remains.
+    """
+    lines = frame["lines_pixel_on_top_view"]
+    filtered_lines = {}
+
+    for line_id, line_coords in lines.items():
+        start_point = line_coords["start"]
+        end_point = line_coords["end"]
+        slope = calculate_slope(start_point, end_point)
+        abs_slope = abs(slope)
+
+        if abs_slope >= slope_threshold or abs(yaw_derivative) > yaw_derivative_threshold:
+            filtered_lines[line_id] = {
+                "start": start_point,
+                "end": end_point
+            }
+
+    if not filtered_lines:
+        return None
+    return {
+        "framenumber": frame["framenumber"],
+        "lines_pixel_on_top_view": filtered_lines
+    }
+
+def filter_too_close_lines_of_frame(frame, distance_threshold=2):
+    """
+    Filter the lines of one frame based on the distance to the previous line.
+    Starting from the left-most line, a line is kept if both its start and end points are farther than the
+    threshold (in meters) from those of the previous kept line.
 
-    print(f"Filtered data by length and slope saved to {output_file_path}")
+    Returns:
+    - The frame with filtered lines, or None if no line remains.
+    """
+    lines = frame["lines_pixel_on_top_view"]
+    frame_lines = list(lines.items())
+
+    # Sort lines from left-most to right-most based on the x-coordinate of the start point
+    frame_lines.sort(key=lambda line: line[1]["start"][0])
+
+    filtered_lines = {}
+    previous_line = None
+
+    for line_id, line_coords in frame_lines:
+        if previous_line is None or (
+            abs(line_coords["start"][0]- previous_line["start"][0])/10 > distance_threshold and
+            abs(line_coords["end"][0]- previous_line["end"][0])/10 > distance_threshold
+        ):
+            filtered_lines[line_id] = line_coords
+            previous_line = line_coords
+
+    if not filtered_lines:
+        return None
+    return {
+        "framenumber": frame["framenumber"],
+        "lines_pixel_on_top_view": filtered_lines
+    }
+
+def line_lengths(lines):
+    """
+    Length (in meters) of every line of a line table (see line_store.py).
+    """
+    start = np.column_stack([lines["start_x"], lines["start_y"]])
+    end = np.column_stack([lines["end_x"], lines["end_y"]])
+    return np.sqrt(np.sum((start - end) ** 2, axis=1)) / 10  # Convert length to meters
 
-    return filtered_data
+def line_abs_slopes(lines):
+    """
+    Absolute slope of every line of a line table, infinite for vertical lines.
+    """
+    dx = np.asarray(lines["end_x"]) - np.asarray(lines["start_x"])
+    dy = np.asarray(lines["end_y"]) - np.asarray(lines["start_y"])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(dx == 0, np.inf, np.abs(dy / dx))
 
+def line_yaw_derivatives(lines, frame_timestamps, yaw_derivative_index):
+    """
+    Yaw derivative of the vehicle when the frame of each line of a line table was recorded.
+    """
+    frame_numbers, frame_of_line = np.unique(lines["frame"], return_inverse=True)
+    return frame_yaw_derivatives(frame_numbers.tolist(), frame_timestamps, yaw_derivative_index)[frame_of_line]
 
-def filter_too_close_lines_in_a_frame(data,output_file_path, distance_threshold=2):
+def keep_far_apart_lines(lines, keep, distance_threshold):
     """
-    Filter lines in each frame based on the distance to the previous line.
-    Starting from the left-most line, if the distance between the current line
-    and the previous line is greater than the threshold, add it to the new dictionary.
+    The too close lines filter of filter_too_close_lines_of_frame, for all frames of a line table at once.
+    The filter depends on the previously kept line of the frame, so it steps through the lines of all frames by
+    their left to right rank.
 
     Parameters:
-    - data: List of frames with lines information.
+    - lines: Line table, the lines of a frame next to each other.
+    - keep: Lines left by the previous filters. Either one boolean per line, or one row of booleans per
+      combination of thresholds, with distance_threshold then a column of one threshold per row.
     - distance_threshold: Minimum distance between lines to keep (in meters).
 
     Returns:
-    - List of frames with filtered lines based on the distance to the previous line.
+    - Lines kept, in the shape of keep.
+    - Order of the lines sorted from left-most to right-most within each frame.
+    """
+    frame_numbers = np.asarray(lines["frame"])
+    start_x = np.asarray(lines["start_x"])
+    end_x = np.asarray(lines["end_x"])
+
+    # Lines sorted by frame and, within a frame, from left-most to right-most (stable, like list.sort)
+    order = np.lexsort((start_x, frame_numbers))
+    sorted_frames = frame_numbers[order]
+    frame_of_line = np.empty(len(order), dtype=np.intp)
+    frame_of_line[order] = np.cumsum(np.r_[False, sorted_frames[1:] != sorted_frames[:-1]])
+    rank = np.arange(len(order)) - np.searchsorted(sorted_frames, sorted_frames)
+
+    keep = np.asarray(keep)
+    state_shape = keep.shape[:-1] + (int(frame_of_line.max()) + 1 if len(order) else 0,)
+    keep_far = np.zeros_like(keep)
+    previous_start_x = np.full(state_shape, np.nan)
+    previous_end_x = np.full(state_shape, np.nan)
+    for r in range(rank.max() + 1 if len(rank) else 0):
+        rank_lines = order[rank == r]  # At most one line of each frame
+        frames = frame_of_line[rank_lines]
+        previous_start = previous_start_x[..., frames]
+        previous_end = previous_end_x[..., frames]
+        far = np.isnan(previous_start) | (
+            (np.abs(start_x[rank_lines] - previous_start) / 10 > distance_threshold) &
+            (np.abs(end_x[rank_lines] - previous_end) / 10 > distance_threshold)
+        )
+        accept = keep[..., rank_lines] & far
+        keep_far[..., rank_lines] = accept
+        previous_start_x[..., frames] = np.where(accept, start_x[rank_lines], previous_start)
+        previous_end_x[..., frames] = np.where(accept, end_x[rank_lines], previous_end)
+    return keep_far, order
+
+def select_lines_by_length(lines, length_threshold):
+    """
+    Lines of a line table at least length_threshold meters long.
+    """
+    return select_lines(lines, line_lengths(lines) >= length_threshold)
+
+def select_lines_by_slope_and_yaw(lines, frame_timestamps, yaw_derivative_index, slope_threshold, yaw_derivative_threshold):
+    """
+    Lines of a line table with an absolute slope of at least slope_threshold, or recorded while the vehicle was
+    turning faster than yaw_derivative_threshold.
+    """
+    abs_yaw_derivatives = np.abs(line_yaw_derivatives(lines, frame_timestamps, yaw_derivative_index))
+    return select_lines(lines, (line_abs_slopes(lines) >= slope_threshold) | (abs_yaw_derivatives > yaw_derivative_threshold))
+
+def select_far_apart_lines(lines, distance_threshold):
+    """
+    Lines of a line table that are not too close to the previous line of their frame, sorted from left-most to
+    right-most within each frame like filter_too_close_lines_of_frame.
+    """
+    keep, order = keep_far_apart_lines(lines, np.ones(len(lines["frame"]), dtype=bool), distance_threshold)
+    return select_lines(lines, order[keep[order]])
+
+def sweep_thresholds(lines, frame_timestamps, yaw_derivative_index, length_thresholds, slope_thresholds, yaw_derivative_thresholds, distance_thresholds):
+    """
+    Apply the three filters with every combination of the given thresholds, the same way as
+    select_lines_by_length, select_lines_by_slope_and_yaw and select_far_apart_lines, and count what each filter
+    keeps.
+    The line table is filtered with every combination at once, one row of kept lines per combination.
+
+    Parameters:
+    - lines: Line table of the lines to filter (see line_store.py).
+    - frame_timestamps: Dictionary of frame timestamps with frame number as key.
+    - yaw_derivative_index: Time index of the yaw derivatives (see read_yaw_derivative_index).
+    - length_thresholds, slope_thresholds, yaw_derivative_thresholds, distance_thresholds: Values of each threshold to try.
+
+    Returns:
+    - List of one dictionary per combination with the thresholds, and the number of lines kept and removed and
+      frames kept by each filter.
     """
-    filtered_data = []
-
-    for frame in data:
-        lines = frame["lines_pixel_on_top_view"]
-        frame_lines = list(lines.items())
-        
-        # Sort lines from left-most to right-most based on the x-coordinate of the start point
-        frame_lines.sort(key=lambda line: line[1]["start"][0])
-
-        filtered_lines = {}
-        previous_line = None
-        
-        for line_id, line_coords in frame_lines:
-            if previous_line is None or (
-                abs(line_coords["start"][0]- previous_line["start"][0])/10 > distance_threshold and
-                abs(line_coords["end"][0]- previous_line["end"][0])/10 > distance_threshold
-            ):
-                filtered_lines[line_id] = line_coords
-                previous_line = line_coords
-
-        if filtered_lines:  
-            filtered_data.append({
-                "framenumber": frame["framenumber"],
-                "lines_pixel_on_top_view": filtered_lines
-            })
-    with open(output_file_path, 'w') as file:
-        json.dump(filtered_data, file, indent=4)
-
-    print(f"Final filtered data saved to {output_file_path}")
-
-    return filtered_data
-
-# File paths
-input_file_path = "output_jsons/lines_data.json"
-timestamp_file_path = "output_jsons/timestamp_of_each_frame.json"
-yaw_derivative_file_path = "IMU_data/Angular_Velocity.csv"
-
-# Load the original data
-with open(input_file_path, 'r') as file:
-    original_data = json.load(file)
-
-# Read the timestamp JSON file
-with open(timestamp_file_path, 'r') as file:
-    timestamp_data = json.load(file)
-
-# Read the Angular_Velocity.csv file
-# The `Angular_Velocity` used for filtering is obtained from the `vehicle_angular_velocity.py` script and includes 
-# fields for time, yaw, and yaw_derivative. The `yaw_derivative` represents the angular velocity of the vehicle,
-# which gives us an indication of how fast the vehicle is turning.
-yaw_derivative_data = read_yaw_derivative_csv(yaw_derivative_file_path)
-
-# Filter noises by length
-filtered_lines_by_length = length_filter(
-    original_data, 
-    output_file_path="output_jsons/1_filtered_lines_by_length.json", 
-    length_threshold=3.5, 
-    plot_histogram_before_filter=True
-)
-
-# Filter noises by slope
-filtered_lines_by_slope = slope_filter(
-    filtered_lines_by_length,
-    timestamp_data,
-    yaw_derivative_data,
-    output_file_path="output_jsons/2_filtered_lines_by_length_and_slope_and_yaw.json",
-    slope_threshold=7,
-    yaw_derivative_threshold=0.045
-)
-
-# Filter noises by too close lines
-final_filtered_data= filter_too_close_lines_in_a_frame(
-    filtered_lines_by_slope,
-    output_file_path = "output_jsons/3_filtered_lines_by_length_and_slope_and_yaw_and_closeLines.json",
-    distance_threshold=2)
+    lengths = line_lengths(lines)
+    abs_slopes = line_abs_slopes(lines)
+    abs_yaw_derivatives = np.abs(line_yaw_derivatives(lines, frame_timestamps, yaw_derivative_index))
+
+    # One row per combination of thresholds
+    grid = np.meshgrid(length_thresholds, slope_thresholds, yaw_derivative_thresholds, distance_thresholds, indexing='ij')
+    length_threshold, slope_threshold, yaw_derivative_threshold, distance_threshold = (np.ravel(values).astype(np.float64)[:, np.newaxis] for values in grid)
+
+    keep_length = lengths >= length_threshold
+    keep_slope = keep_length & ((abs_slopes >= slope_threshold) | (abs_yaw_derivatives > yaw_derivative_threshold))
+    keep_close, _ = keep_far_apart_lines(lines, keep_slope, distance_threshold)
+
+    # Frames with at least one line left after each filter
+    frame_numbers = np.asarray(lines["frame"])
+    frame_first_line = np.flatnonzero(np.r_[True, frame_numbers[1:] != frame_numbers[:-1]]) if len(frame_numbers) else np.array([], dtype=np.intp)
+
+    def frames_kept(keep):
+        if len(frame_numbers) == 0:
+            return np.zeros(len(keep), dtype=np.intp)
+        return np.count_nonzero(np.add.reduceat(keep, frame_first_line, axis=1), axis=1)
+
+    results = []
+    counts = [(name, keep.sum(axis=1), frames_kept(keep)) for name, keep in (("length", keep_length), ("slope", keep_slope), ("close_lines", keep_close))]
+    for k in range(len(keep_slope)):
+        row = {
+            "length_threshold": float(length_threshold[k, 0]),
+            "slope_threshold": float(slope_threshold[k, 0]),
+            "yaw_derivative_threshold": float(yaw_derivative_threshold[k, 0]),
+            "distance_threshold": float(distance_threshold[k, 0]),
+        }
+        lines_before = len(frame_numbers)
+        for name, lines_kept, frames in counts:
+            row[f"{name}_lines_kept"] = int(lines_kept[k])
+            row[f"{name}_lines_removed"] = lines_before - int(lines_kept[k])
+            row[f"{name}_frames_kept"] = int(frames[k])
+            lines_before = int(lines_kept[k])
+        results.append(row)
+    return results
+
+def save_sweep_results(results, output_file_path):
+    with open(output_file_path, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+
+    print(f"{len(results)} threshold combinations evaluated, results saved to {output_file_path}")
+
+
+if __name__ == '__main__':
+    # File paths
+    input_lines_path = "output_jsons/lines_data.lines"  # line store written by masks_to_line_equation.py
+    timestamp_file_path = "output_jsons/timestamp_of_each_frame.json"
+    yaw_derivative_file_path = "IMU_data/Angular_Velocity.npy"  # or the Angular_Velocity.csv of older runs
+    metadata_file_path = "motion_data/Metadata.csv"  # timezone of the recording
+    locations_file_path = "locations_data/locations_and_magneticHeadings.json"  # date of the recording
+    output_lines_paths = ["output_jsons/1_filtered_lines_by_length.lines",
+                          "output_jsons/2_filtered_lines_by_length_and_slope_and_yaw.lines",
+                          "output_jsons/3_filtered_lines_by_length_and_slope_and_yaw_and_closeLines.lines"]
+    write_json = False  # also write the output of each filter as JSON, next to its line store
+    sweep_output_file_path = "output_jsons/noise_filter_sweep.csv"
+
+    length_threshold = 3.5
+    slope_threshold = 7
+    yaw_derivative_threshold = 0.045
+    distance_threshold = 2
+    plot_histogram_before_filter = True
+
+    # Evaluate a grid of thresholds instead of filtering with the ones above
+    sweep = False
+    sweep_length_thresholds = [2.5, 3, 3.5, 4, 4.5]
+    sweep_slope_thresholds = [3, 5, 7, 9, 11]
+    sweep_yaw_derivative_thresholds = [0.03, 0.045, 0.06]
+    sweep_distance_thresholds = [1, 1.5, 2, 2.5, 3]
+
+    # Load the original lines
+    original_lines = load_lines(input_lines_path)
+
+    # Read the timestamp JSON file
+    with open(timestamp_file_path, 'r') as file:
+        timestamp_data = json.load(file)
+    frame_timestamps = {item["frame"]: item["timestamp"] for item in timestamp_data}
+
+    # Read the Angular_Velocity file
+    # The `Angular_Velocity` used for filtering is obtained from the `vehicle_angular_velocity.py` script and includes 
+    # fields for time, yaw, and yaw_derivative. The `yaw_derivative` represents the angular velocity of the vehicle,
+    # which gives us an indication of how fast the vehicle is turning.
+    yaw_derivative_index = read_yaw_derivative_index(yaw_derivative_file_path, recording_time_base(metadata_file_path, locations_file_path))
+
+    if sweep:
+        results = sweep_thresholds(original_lines, frame_timestamps, yaw_derivative_index,
+                                   sweep_length_thresholds, sweep_slope_thresholds, sweep_yaw_derivative_thresholds, sweep_distance_thresholds)
+        save_sweep_results(results, sweep_output_file_path)
+
+    else:
+        if plot_histogram_before_filter:
+            plot_line_length_distribution(line_lengths(original_lines))
+
+        # Filter noises by length, then by slope, then by too close lines
+        filtered_lines_by_length = select_lines_by_length(original_lines, length_threshold)
+        filtered_lines_by_slope = select_lines_by_slope_and_yaw(filtered_lines_by_length, frame_timestamps, yaw_derivative_index, slope_threshold, yaw_derivative_threshold)
+        final_filtered_lines = select_far_apart_lines(filtered_lines_by_slope, distance_threshold)
+
+        for lines, output_lines_path in zip([filtered_lines_by_length, filtered_lines_by_slope, final_filtered_lines], output_lines_paths):
+            save_lines(output_lines_path, lines)
+            if write_json:
+                export_json(output_lines_path, output_lines_path[:-len(".lines")] + ".json")
+            print(f"{len(lines['frame'])} lines saved to {output_lines_path}")
@@ -0,0 +1,272 @@
+import argparse
+import heapq
+import xml.etree.ElementTree as ET
+import numpy as np
+from correct_locations import ReferenceNetwork, load_json, save_json, save_points_to_kml
+
+'''
+Corrects the recorded locations by matching the whole track to the road network of an OpenStreetMap extract,
+instead of snapping each location to the nearest point of a hand-drawn path (correct_locations.py). Snapping each
+location on its own jumps between parallel or crossing roads at junctions; matching the track as a sequence
+(hidden Markov model, as in Newson and Krumm, "Hidden Markov Map Matching Through Noise and Sparseness") picks the
+roads that explain both the locations and the distances driven between them:
+- Candidates: the k nearest road segments within search_radius meters of each location, from the STRtree of
+  ReferenceNetwork. A candidate is more likely the closer it is to the location (Gaussian GPS error, gps_sigma).
+- Transitions: between the candidates of consecutive locations, the route driven along the roads (respecting
+  one-way streets) should be about as long as the straight distance between the locations (exponential in their
+  difference, with scale beta). Routes are searched with a Dijkstra bounded to a few times the straight distance.
+- The most likely sequence of candidates is found with the Viterbi algorithm.
+With k candidates per location and bounded route searches, the cost is linear in the length of the track. A
+location without any road nearby is left where it is and the matching starts again after it.
+
+The output is the same as correct_locations.py: the JSON with the corrected coordinates, and a KML of the points.
+'''
+
+# Values of the highway tag of the roads a car can drive on
+drivable_highways = {
+    'motorway', 'trunk', 'primary', 'secondary', 'tertiary', 'unclassified', 'residential', 'service', 'living_street', 'road',
+    'motorway_link', 'trunk_link', 'primary_link', 'secondary_link', 'tertiary_link'
+}
+
+
+def parse_osm(osm_file):
+    """
+    Drivable roads of an OSM XML extract.
+
+    Returns:
+    - list: Ways, each a tuple of its node ids (in the direction of travel for one-way roads), its points as an
+      array of (longitude, latitude) and whether it is one-way.
+    """
+    nodes = {}
+    ways = []
+    for _, element in ET.iterparse(osm_file, events=('end',)):
+        if element.tag == 'node':
+            nodes[element.get('id')] = (float(element.get('lon')), float(element.get('lat')))
+            element.clear()
+        elif element.tag == 'way':
+            tags = {tag.get('k'): tag.get('v') for tag in element.findall('tag')}
+            node_ids = [node.get('ref') for node in element.findall('nd')]
+            element.clear()
+            if tags.get('highway') not in drivable_highways or len(node_ids) < 2:
+                continue
+            oneway = tags.get('oneway', 'no')
+            if oneway == '-1':
+                node_ids = node_ids[::-1]
+            is_oneway = oneway in ('yes', 'true', '1', '-1') or tags.get('junction') == 'roundabout'
+            ways.append((node_ids, is_oneway))
+        elif element.tag == 'relation':
+            element.clear()
+
+    roads = []
+    for node_ids, is_oneway in ways:
+        node_ids = [node_id for node_id in node_ids if node_id in nodes]
+        if len(node_ids) >= 2:
+            roads.append((node_ids, np.array([nodes[node_id] for node_id in node_ids]), is_oneway))
+    return roads
+
+
+class RoadGraph:
+    """
+    Road segments of OSM ways, indexed for the candidate search (ReferenceNetwork), and the graph of the roads.
+    Segment i of the ReferenceNetwork goes from node segment_from[i] to node segment_to[i].
+    """
+
+    def __init__(self, roads):
+        if not roads:
+            raise ValueError("The OSM extract does not contain any drivable road")
+        self.network = ReferenceNetwork([points for _, points, _ in roads])
+        self.segment_from = np.concatenate([node_ids[:-1] for node_ids, _, _ in roads])
+        self.segment_to = np.concatenate([node_ids[1:] for node_ids, _, _ in roads])
+        self.segment_oneway = np.concatenate([np.full(len(node_ids) - 1, is_oneway) for node_ids, _, is_oneway in roads])
+        self.segment_length = np.linalg.norm(self.network.ends - self.network.starts, axis=1)
+
+        self.adjacency = {}
+        for u, v, length, oneway in zip(self.segment_from.tolist(), self.segment_to.tolist(), self.segment_length.tolist(), self.segment_oneway.tolist()):
+            self.adjacency.setdefault(u, []).append((v, length))
+            if not oneway:
+                self.adjacency.setdefault(v, []).append((u, length))
+
+    def shortest_distances(self, source, targets, max_distance):
+        """
+        Dijkstra from source, stopped once all targets are reached or max_distance meters is exceeded.
+
+        Returns:
+        - Dictionary of the reached targets to their distance.
+        """
+        targets = set(targets)
+        distances = {source: 0.0}
+        reached = {}
+        heap = [(0.0, source)]
+        while heap and len(reached) < len(targets):
+            distance, node = heapq.heappop(heap)
+            if distance > distances.get(node, np.inf):
+                continue
+            if node in targets:
+                reached[node] = distance
+            for neighbor, length in self.adjacency.get(node, ()):
+                new_distance = distance + length
+                if new_distance <= max_distance and new_distance < distances.get(neighbor, np.inf):
+                    distances[neighbor] = new_distance
+                    heapq.heappush(heap, (new_distance, neighbor))
+        return reached
+
+    def exits(self, segment, t):
+        """
+        Nodes a vehicle at position t along a segment can drive to, with the distance to each.
+        """
+        length = self.segment_length[segment]
+        exits = [(self.segment_to[segment], (1 - t) * length)]
+        if not self.segment_oneway[segment]:
+            exits.append((self.segment_from[segment], t * length))
+        return exits
+
+    def entries(self, segment, t):
+        """
+        Nodes a vehicle can come from to reach position t along a segment, with the distance from each.
+        """
+        length = self.segment_length[segment]
+        entries = [(self.segment_from[segment], t * length)]
+        if not self.segment_oneway[segment]:
+            entries.append((self.segment_to[segment], (1 - t) * length))
+        return entries
+
+    def route_distances(self, from_candidates, to_candidates, max_distance):
+        """
+        Length of the shortest route (meters) from each candidate (segment, t) to each other, inf if longer than
+        max_distance.
+        """
+        routes = np.full((len(from_candidates), len(to_candidates)), np.inf)
+        entry_nodes = {node for segment, t in to_candidates for node, _ in self.entries(segment, t)}
+        node_distances = {}
+        for i, (from_segment, from_t) in enumerate(from_candidates):
+            for j, (to_segment, to_t) in enumerate(to_candidates):
+                # Along the same segment
+                if from_segment == to_segment and (to_t >= from_t or not self.segment_oneway[from_segment]):
+                    routes[i, j] = abs(to_t - from_t) * self.segment_length[from_segment]
+            for exit_node, exit_distance in self.exits(from_segment, from_t):
+                if exit_node not in node_distances:
+                    node_distances[exit_node] = self.shortest_distances(exit_node, entry_nodes, max_distance)
+                for j, (to_segment, to_t) in enumerate(to_candidates):
+                    for entry_node, entry_distance in self.entries(to_segment, to_t):
+                        distance = node_distances[exit_node].get(entry_node)
+                        if distance is not None:
+                            routes[i, j] = min(routes[i, j], exit_distance + distance + entry_distance)
+        routes[routes > max_distance] = np.inf
+        return routes
+
+
+def match_track(graph, latitudes, longitudes, search_radius=50, k=5, gps_sigma=5, beta=5, max_route_factor=2):
+    """
+    Map-match a track of locations to the road graph.
+
+    Parameters:
+    - graph: RoadGraph.
+    - latitudes, longitudes: Locations of the track, in the order they were recorded.
+    - search_radius: Only roads closer than this (meters) to a location are candidates.
+    - k: Number of candidate segments kept for each location.
+    - gps_sigma: Standard deviation of the GPS error (meters).
+    - beta: Scale (meters) of the difference between the route and straight distances of a transition.
+    - max_route_factor: Routes longer than this times the straight distance (plus twice search_radius) are not searched.
+
+    Returns:
+    - Arrays of the matched latitudes and longitudes (the recorded ones where no road was found).
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    matched_latitudes, matched_longitudes = latitudes.copy(), longitudes.copy()
+    if len(latitudes) == 0:
+        return matched_latitudes, matched_longitudes
+
+    # Repeated locations (the phone reports the same fix until a new one is available) are matched once
+    distinct = np.r_[True, (latitudes[1:] != latitudes[:-1]) | (longitudes[1:] != longitudes[:-1])]
+    fix_of_location = np.cumsum(distinct) - 1
+    fix_latitudes, fix_longitudes = latitudes[distinct], longitudes[distinct]
+    fix_xy = graph.network.to_meters(np.column_stack([fix_longitudes, fix_latitudes]))
+
+    point_index, segment, t, candidate_latitudes, candidate_longitudes, distance = graph.network.candidates(fix_latitudes, fix_longitudes, search_radius, k)
+    candidate_starts = np.searchsorted(point_index, np.arange(len(fix_latitudes) + 1))
+
+    fix_matches = np.full(len(fix_latitudes), -1, dtype=np.intp)  # Index of the matched candidate of each fix
+
+    def backtrack(chain, scores):
+        candidate = int(np.argmax(scores))
+        for fix, back_pointers in reversed(chain):
+            fix_matches[fix] = candidate_starts[fix] + candidate
+            candidate = back_pointers[candidate] if back_pointers is not None else candidate
+
+    chain = []  # (fix, back pointers to the candidates of the previous fix) of the current chain
+    scores = None
+    previous = None
+    for fix in range(len(fix_latitudes)):
+        first, last = candidate_starts[fix], candidate_starts[fix + 1]
+        if first == last:
+            # No road near this location: end the chain before it
+            if chain:
+                backtrack(chain, scores)
+            chain, scores, previous = [], None, None
+            continue
+
+        emission = -0.5 * (distance[first:last] / gps_sigma) ** 2
+        if previous is not None:
+            previous_first, previous_last = candidate_starts[previous], candidate_starts[previous + 1]
+            straight = float(np.linalg.norm(fix_xy[fix] - fix_xy[previous]))
+            routes = graph.route_distances(list(zip(segment[previous_first:previous_last], t[previous_first:previous_last])),
+                                           list(zip(segment[first:last], t[first:last])),
+                                           max_route_factor * straight + 2 * search_radius)
+            transition = -np.abs(routes - straight) / beta
+            total = scores[:, np.newaxis] + transition
+            back_pointers = np.argmax(total, axis=0)
+            new_scores = total[back_pointers, np.arange(last - first)] + emission
+            if np.isfinite(new_scores).any():
+                chain.append((fix, back_pointers))
+                scores, previous = new_scores, fix
+                continue
+            # No route from the previous candidates: end the chain before this location
+            backtrack(chain, scores)
+            chain = []
+
+        chain.append((fix, None))
+        scores, previous = emission, fix
+
+    if chain:
+        backtrack(chain, scores)
+
+    matched = fix_matches[fix_of_location]
+    has_match = matched >= 0
+    matched_latitudes[has_match] = candidate_latitudes[matched[has_match]]
+    matched_longitudes[has_match] = candidate_longitudes[matched[has_match]]
+    return matched_latitudes, matched_longitudes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Correct the recorded locations by matching the track to the roads of an OpenStreetMap extract')
+    parser.add_argument('--osm', type=str, required=True, help='OpenStreetMap XML extract (.osm) of the area driven')
+    parser.add_argument('--json', type=str, default='locations_data/locations_and_magneticHeadings.json', help='locations and magnetic headings recorded by MyApp')
+    parser.add_argument('--output-kml', type=str, default='path_to_output_kml_file.kml', help='KML of the matched points')
+    parser.add_argument('--output-json', type=str, default='locations_data/correctedLocation.json', help='locations with the corrected coordinates')
+    parser.add_argument('--search-radius', type=float, default=50, help='roads farther than this from a location (meters) are not candidates')
+    parser.add_argument('--candidates', type=int, default=5, help='number of candidate road segments of each location')
+    parser.add_argument('--gps-sigma', type=float, default=5, help='standard deviation of the GPS error (meters)')
+    args = parser.parse_args()
+
+    graph = RoadGraph(parse_osm(args.osm))
+
+    # Load the JSON data, in the order the locations were recorded
+    data = load_json(args.json)
+    latitudes = np.array([item['latitude'] for item in data], dtype=np.float64)
+    longitudes = np.array([item['longitude'] for item in data], dtype=np.float64)
+
+    matched_latitudes, matched_longitudes = match_track(graph, latitudes, longitudes, args.search_radius, args.candidates, args.gps_sigma)
+
+    # Save the matched points to a new KML file
+    save_points_to_kml(list(zip(matched_latitudes.tolist(), matched_longitudes.tolist())), args.output_kml)
+    print(f"Mapped points have been saved to {args.output_kml}")
+
+    # Update the original JSON data with the matched points
+    for item, latitude, longitude in zip(data, matched_latitudes.tolist(), matched_longitudes.tolist()):
+        item['latitude'] = latitude
+        item['longitude'] = longitude
+
+    # Save the updated JSON data to a new JSON file
+    save_json(data, args.output_json)
+    print(f"Updated JSON data has been saved to {args.output_json}")
@@ -0,0 +1,354 @@
+import argparse
+import collections
+import glob
+import importlib.util
+import json
+import os
+import sys
+import textwrap
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+from extract_timestamp_of_each_frame import get_frame_timestamps_from_container
+from mask_store import MaskStore, MaskStoreWriter
+from line_fitting import fit_lines, mask_pixels_from_image, mask_pixels_from_store, native_pixels_to_input_resolution
+from masks_to_line_equation import h, mask_frame_number
+from noise_filter import read_yaw_derivative_index, frame_yaw_derivatives, filter_frame_by_length, filter_frame_by_slope_and_yaw, filter_too_close_lines_of_frame
+from line_pixels_to_real_coordinates import georeference_frame, open_lines_kml, add_frame_lines_to_kml
+from pose_track import build_pose_index, interpolated_pose_track, fused_pose_track, gps_course, pose_at
+from smooth_lines import aggregate_lines, aggregate_lines_streaming, write_smoothed_lines_kml
+from line_map import LineMap
+from stage_cache import StageCache, stage_key
+from sensor_ingest import recording_time_base, load_location_json, load_location_csv, load_yaw_rate, seconds_between
+import mask_store
+import line_fitting
+import masks_to_line_equation
+import noise_filter
+import line_pixels_to_real_coordinates
+import smooth_lines
+import sensor_ingest
+import pose_track
+
+'''
+This script runs the whole processing chain, from the video (or the masks predicted by LaneAF) to the smoothed
+lines KML, in a single process. Every stage is a generator over per-frame records in the same format as the
+JSON files written by the individual scripts ({"framenumber", "lines_pixel_on_top_view", ...}), so frames flow
+through line fitting, the three noise filters and georeferencing one at a time and nothing is written to
+'output_jsons' unless --debug-dir is given.
+With --cache-dir, the output of every stage is cached under a hash of its inputs, parameters and code (see
+stage_cache.py), and a re-run only recomputes the stages after the first one whose key changed.
+The masks come from one of:
+- a mask store (--mask-store) or a folder of mask PNGs (--mask-folder), or
+- LaneAF itself (--snapshot), run on the video. This needs the LaneAF repository (models/, utils/) on the path.
+'''
+
+crop_top = 185  # Rows of the masks above this are not used, as in masks_to_line_equation.py
+laneaf_inference_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'laneaf_inference')
+
+
+def mask_stage(mask_store_path=None, mask_folder=None, video_path=None, snapshot=None, selected_frames=None, batch_size=8, cuda=False, output_mask_store=None):
+    """
+    Labelled pixels of the masks of the drive, in frame order.
+    Masks inferred by LaneAF are also written to a new mask store at output_mask_store when it is given.
+
+    Yields:
+    - Frame number and arrays y, x and label of its labelled pixels (model input resolution, cropped).
+    """
+    if mask_store_path is not None:
+        store = MaskStore(mask_store_path)
+        for frame_number in store.frames:
+            if selected_frames is None or frame_number in selected_frames:
+                yield int(frame_number), *mask_pixels_from_store(store, frame_number, crop_top=crop_top)
+
+    elif mask_folder is not None:
+        for img_path in sorted(glob.glob(os.path.join(mask_folder, "*.png")), key=mask_frame_number):
+            frame_number = mask_frame_number(img_path)
+            if selected_frames is None or frame_number in selected_frames:
+                label_image = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
+                yield frame_number, *mask_pixels_from_image(label_image, crop_top=crop_top)
+
+    else:
+        sys.path.append(laneaf_inference_dir)
+        from mask_of_all_frames import load_model, read_batches, infer_batch, decode_sparse, input_width, input_height
+        import torch
+
+        cuda = cuda and torch.cuda.is_available()
+        model = load_model(snapshot, cuda)
+        mask_writer = None
+        if output_mask_store is not None:
+            mask_writer = MaskStoreWriter(output_mask_store, mask_shape=(input_height // 4, input_width // 4), output_shape=(input_height, input_width))
+        cap = cv2.VideoCapture(video_path)
+        for frame_numbers, frames in read_batches(cap, batch_size, selected_frames):
+            mask_out, vaf_out, haf_out = infer_batch(model, frames, cuda)
+            for i, frame_number in enumerate(frame_numbers):
+                y, x, labels = decode_sparse(mask_out[i], vaf_out[i], haf_out[i])
+                if mask_writer is not None:
+                    mask_writer.add_pixels(frame_number, y, x, labels)
+                yield frame_number, *native_pixels_to_input_resolution(y, x, labels, mask_out.shape[1:], (input_height, input_width), crop_top)
+        cap.release()
+        if mask_writer is not None:
+            mask_writer.close()
+
+def laneaf_sources():
+    """
+    Source files the LaneAF masks are inferred with: mask_of_all_frames.py, the affinity field decoder
+    (utils/affinity_fields.py) and the Python files of the DLA model (models/dla/, with its DCN layers) of the
+    LaneAF repository, found on the path without importing them.
+    """
+    if laneaf_inference_dir not in sys.path:
+        sys.path.append(laneaf_inference_dir)
+    specs = [importlib.util.find_spec(name) for name in ('mask_of_all_frames', 'utils.affinity_fields', 'models.dla.pose_dla_dcn')]
+    model_files = sorted(glob.glob(os.path.join(os.path.dirname(specs[2].origin), '**', '*.py'), recursive=True))
+    return [specs[0].origin, specs[1].origin, *model_files]
+
+def line_fitting_stage(masks):
+    """
+    Fit the lines of each mask and transform their start and end points to the top view.
+    """
+    for frame_number, y, x, labels in masks:
+        line_labels, start_points, end_points = fit_lines(y, x, labels)
+
+        lines_pixel_on_top_view = {}
+        if len(line_labels) > 0:
+            points = np.concatenate([start_points, end_points]).astype(np.float32)
+            points_birdseye = cv2.perspectiveTransform(points[:, np.newaxis, :], h)[:, 0, :]
+            for i in range(len(line_labels)):
+                lines_pixel_on_top_view[str(i)] = {
+                    "start": points_birdseye[i].tolist(),
+                    "end": points_birdseye[len(line_labels) + i].tolist()
+                }
+
+        yield {
+            "framenumber": frame_number,
+            "lines_pixel_on_top_view": lines_pixel_on_top_view
+        }
+
+def length_filter_stage(frames, length_threshold):
+    for frame in frames:
+        filtered_frame = filter_frame_by_length(frame, length_threshold)
+        if filtered_frame:
+            yield filtered_frame
+
+def slope_filter_stage(frames, frame_timestamps, yaw_derivative_index, slope_threshold, yaw_derivative_threshold):
+    # Yaw derivative at the exact time of every frame of the video, interpolated in one call
+    frame_numbers = list(frame_timestamps)
+    yaw_derivatives = dict(zip(frame_numbers, frame_yaw_derivatives(frame_numbers, frame_timestamps, yaw_derivative_index).tolist()))
+    for frame in frames:
+        yaw_derivative = yaw_derivatives[frame["framenumber"]]
+        filtered_frame = filter_frame_by_slope_and_yaw(frame, slope_threshold, yaw_derivative, yaw_derivative_threshold)
+        if filtered_frame:
+            yield filtered_frame
+
+def close_lines_filter_stage(frames, distance_threshold):
+    for frame in frames:
+        filtered_frame = filter_too_close_lines_of_frame(frame, distance_threshold)
+        if filtered_frame:
+            yield filtered_frame
+
+def pose_track_stage(frame_timestamps, locations, base, yaw_rates=None, gps_locations=None):
+    """
+    Pose of the vehicle at every frame of the video, indexed by frame number (see pose_track.py). Without yaw rates
+    the location and magnetic heading are interpolated at the timestamp of each frame, and with them the heading
+    is fused from the magnetic heading, the yaw rate and the GPS course (of gps_locations, the Sensor Logger
+    locations, if given).
+    """
+    pose_index = build_pose_index(locations, base)
+    if yaw_rates is None:
+        return interpolated_pose_track(frame_timestamps, pose_index)
+    gps = None
+    if gps_locations is not None:
+        course_times, courses, speeds = gps_course(gps_locations)
+        gps = (seconds_between(course_times, pose_index['origin']), courses, speeds)
+    return fused_pose_track(frame_timestamps, pose_index, yaw_rates, gps)
+
+def georeference_stage(frames, poses):
+    # The pose of each frame is looked up in the pose track computed once for the whole drive
+    for frame in frames:
+        closest_entry = pose_at(poses, frame["framenumber"])
+        if not closest_entry:
+            continue
+
+        yield georeference_frame(frame, closest_entry)
+
+def kml_stage(frames, output_file_path):
+    """
+    Pass the georeferenced frames through unchanged, adding their lines to a KML file. The file is only opened
+    once the first frame is read, so a stage that is never read leaves the previous file as it is.
+    """
+    with open_lines_kml(output_file_path) as kml:
+        for frame_lines_geo in frames:
+            add_frame_lines_to_kml(kml, frame_lines_geo)
+            yield frame_lines_geo
+
+def dump_stage(frames, output_file_path):
+    """
+    Pass the frames through unchanged, writing them to a JSON file as they go (same format as json.dump(..., indent=4)).
+    """
+    with open(output_file_path, 'w') as file:
+        separator = "[\n"
+        for frame in frames:
+            file.write(separator + textwrap.indent(json.dumps(frame, indent=4), "    "))
+            separator = ",\n"
+            yield frame
+        file.write("[]" if separator == "[\n" else "\n]")
+
+def cache_mask_store(masks, cache, key):
+    """
+    Pass the masks through unchanged, and move the mask store they are written to into the cache once the
+    last frame has been inferred.
+    """
+    yield from masks
+    cache.commit_directory("masks", key)
+
+def smoothing_stage(frames, look_ahead_distance=None):
+    """
+    Smooth the georeferenced lines. Yields one {"line_id", "points"} record per aggregated line.
+    With look_ahead_distance, the lines are smoothed in a sliding window (aggregate_lines_streaming) and yielded
+    as soon as they are finished.
+    """
+    if look_ahead_distance is not None:
+        aggregated_lines = aggregate_lines_streaming(frames, look_ahead_distance)
+    else:
+        # Smoothing merges each line with the lines of the following frames, so it needs all georeferenced frames
+        sorted_data = list(tqdm(frames, desc="Processing frames"))
+        aggregated_lines = aggregate_lines(sorted_data).items()
+    for line_id, points in aggregated_lines:
+        yield {"line_id": line_id, "points": [list(point) for point in points]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Run the whole pipeline, from the video to the smoothed lines KML, in one process')
+    parser.add_argument('--video-path', type=str, default=None, help='recorded video of the road')
+    parser.add_argument('--start-time', type=str, default=None, help='exact time of the first frame of the video (HH:MM:SS.fff)')
+    parser.add_argument('--timestamps', type=str, default=None, help='timestamp_of_each_frame.json, read instead of the video container when given')
+    parser.add_argument('--snapshot', type=str, default=None, help='LaneAF model snapshot, to run inference on the video')
+    parser.add_argument('--mask-store', type=str, default=None, help='mask store written by mask_of_all_frames.py --mask-store')
+    parser.add_argument('--mask-folder', type=str, default=None, help='folder of mask PNGs written by mask_of_all_frames.py')
+    parser.add_argument('--frame-list', type=str, default=None, help='JSON list of frame numbers to process (from select_frames_by_distance.py)')
+    parser.add_argument('--batch-size', type=int, default=8, help='number of frames in each forward pass of LaneAF')
+    parser.add_argument('--no-cuda', action='store_true', default=False, help='do not use cuda for inference')
+    parser.add_argument('--yaw-derivative', type=str, default='IMU_data/Angular_Velocity.npy', help='output of vehicle_angular_velocity.py (.npy, or .csv of older runs)')
+    parser.add_argument('--locations', type=str, default='locations_data/locations_and_magneticHeadings.json', help='locations and magnetic headings recorded by MyApp')
+    parser.add_argument('--fuse-heading', action='store_true', default=False, help='fuse the magnetic heading with the yaw rate of --yaw-derivative and the GPS course (see pose_track.py) instead of only interpolating it')
+    parser.add_argument('--gps-locations', type=str, default=None, help='Sensor Logger Location.csv, for the GPS course of --fuse-heading (computed from --locations if not given)')
+    parser.add_argument('--metadata', type=str, default='motion_data/Metadata.csv', help='Sensor Logger Metadata.csv, for the timezone of the recording (UTC if it does not exist)')
+    parser.add_argument('--length-threshold', type=float, default=3.5, help='minimum length of lines to keep (meters)')
+    parser.add_argument('--slope-threshold', type=float, default=7, help='minimum absolute slope of lines to keep')
+    parser.add_argument('--yaw-derivative-threshold', type=float, default=0.045, help='lines of frames turning faster than this are kept regardless of their slope')
+    parser.add_argument('--distance-threshold', type=float, default=2, help='minimum distance between lines of a frame (meters)')
+    parser.add_argument('--smoothing-look-ahead', type=float, default=None, help='smooth the lines in a sliding window reaching this far ahead (meters) and write them as they are finished, in constant memory')
+    parser.add_argument('--line-map', type=str, default=None, help='also merge the smoothed lines into this line map directory (see line_map.py)')
+    parser.add_argument('--output-kml', type=str, default='output_kmls/smoothed_lines(final_output)/final_smoothed_lines.kml', help='smoothed lines KML (or KMZ if it ends with .kmz)')
+    parser.add_argument('--debug-dir', type=str, default=None, help='also write the intermediate JSON files and the initial output KML to this directory')
+    parser.add_argument('--cache-dir', type=str, default=None, help='cache the output of every stage in this directory and reuse it while its inputs, parameters and code do not change')
+    args = parser.parse_args()
+
+    if args.mask_store is None and args.mask_folder is None and (args.snapshot is None or args.video_path is None):
+        parser.error('the masks are read from --mask-store or --mask-folder, or inferred with --snapshot and --video-path')
+
+    if args.timestamps is not None:
+        with open(args.timestamps, 'r') as file:
+            timestamp_data = json.load(file)
+    elif args.video_path is not None and args.start_time is not None:
+        timestamp_data = get_frame_timestamps_from_container(args.video_path, args.start_time)
+    else:
+        parser.error('the frame timestamps are read from --timestamps, or from --video-path and --start-time')
+    frame_timestamps = {item['frame']: item['timestamp'] for item in timestamp_data}
+
+    selected_frames = None
+    if args.frame_list is not None:
+        with open(args.frame_list, 'r') as file:
+            selected_frames = set(json.load(file))
+
+    # The logs are parsed once into arrays cached next to them (see sensor_ingest.py), on one time base
+    base = recording_time_base(args.metadata, args.locations)
+    yaw_derivative_index = read_yaw_derivative_index(args.yaw_derivative, base)
+    locations = load_location_json(args.locations, base)
+    yaw_rates = load_yaw_rate(args.yaw_derivative, base) if args.fuse_heading else None
+    gps_locations = load_location_csv(args.gps_locations) if args.fuse_heading and args.gps_locations is not None else None
+
+    # The debug outputs are written while the stages are read. Stages skipped because a later stage is a cache hit
+    # are read until they are used up at the end, so every debug output is written on every run.
+    debug_outputs = []
+
+    def debug(frames, file_name):
+        if args.debug_dir is None:
+            return frames
+        frames = dump_stage(frames, os.path.join(args.debug_dir, file_name))
+        debug_outputs.append(frames)
+        return frames
+
+    if args.debug_dir is not None:
+        os.makedirs(args.debug_dir, exist_ok=True)
+
+    # Without a cache directory every stage is computed. With one, each stage is keyed by the key of the stage it
+    # reads from, its parameters and its code, and a stage found in the cache is read back without running the
+    # stages before it (the generators are lazy).
+    cache = StageCache(args.cache_dir) if args.cache_dir is not None else None
+
+    def cached(stage, compute, params=None, inputs=(), modules=()):
+        key = stage_key(stage, params, inputs, modules)
+        if cache is None:
+            return compute(), key
+        return cache.records(stage, key, compute), key
+
+    infer = args.mask_store is None and args.mask_folder is None
+    frame_list = sorted(selected_frames) if selected_frames is not None else None
+    masks_key = None
+    if cache is not None:
+        if infer:
+            # The checkpoint and the LaneAF code are hashed by content, so editing the decoder or the model, or
+            # changing the weights, infers the masks again
+            laneaf_digests = [cache.file_digest(path) for path in laneaf_sources()]
+            masks_key = stage_key("masks", {"frame_list": frame_list}, [cache.file_digest(args.video_path), cache.file_digest(args.snapshot), *laneaf_digests], [mask_store, mask_stage])
+        else:
+            masks_key = cache.file_digest(args.mask_store if args.mask_store is not None else args.mask_folder)
+        timestamps_digest = stage_key("timestamps", frame_timestamps)
+        yaw_derivative_digest = cache.file_digest(args.yaw_derivative)
+        locations_digest = cache.file_digest(args.locations)
+    else:
+        timestamps_digest = yaw_derivative_digest = locations_digest = None
+
+    def masks():
+        if infer and cache is not None:
+            if ("masks", masks_key) in cache:
+                return mask_stage(mask_store_path=cache.path("masks", masks_key))
+            temporary_path, _ = cache.directory("masks", masks_key)
+            frames = mask_stage(None, None, args.video_path, args.snapshot, selected_frames, args.batch_size, not args.no_cuda, temporary_path)
+            return cache_mask_store(frames, cache, masks_key)
+        return mask_stage(args.mask_store, args.mask_folder, args.video_path, args.snapshot, selected_frames, args.batch_size, cuda=not args.no_cuda)
+
+    frames, key = cached("lines", lambda: line_fitting_stage(masks()),
+                         {"crop_top": crop_top, "frame_list": None if infer else frame_list}, [masks_key], [line_fitting, masks_to_line_equation, mask_store, mask_stage, line_fitting_stage])
+    frames = debug(frames, "lines_data.json")
+    frames, key = cached("length_filter", lambda frames=frames: length_filter_stage(frames, args.length_threshold),
+                         {"length_threshold": args.length_threshold}, [key], [noise_filter, length_filter_stage])
+    frames = debug(frames, "1_filtered_lines_by_length.json")
+    frames, key = cached("slope_filter", lambda frames=frames: slope_filter_stage(frames, frame_timestamps, yaw_derivative_index, args.slope_threshold, args.yaw_derivative_threshold),
+                         {"slope_threshold": args.slope_threshold, "yaw_derivative_threshold": args.yaw_derivative_threshold, "time_base": base}, [key, timestamps_digest, yaw_derivative_digest], [noise_filter, sensor_ingest, slope_filter_stage])
+    frames = debug(frames, "2_filtered_lines_by_length_and_slope_and_yaw.json")
+    frames, key = cached("close_lines_filter", lambda frames=frames: close_lines_filter_stage(frames, args.distance_threshold),
+                         {"distance_threshold": args.distance_threshold}, [key], [noise_filter, close_lines_filter_stage])
+    frames = debug(frames, "3_filtered_lines_by_length_and_slope_and_yaw_and_closeLines.json")
+    frames, key = cached("georeference", lambda frames=frames: georeference_stage(frames, pose_track_stage(frame_timestamps, locations, base, yaw_rates, gps_locations)),
+                         {"time_base": base, "fuse_heading": args.fuse_heading}, [key, timestamps_digest, locations_digest, yaw_derivative_digest if args.fuse_heading else None, cache.file_digest(args.gps_locations) if cache is not None and gps_locations is not None else None],
+                         [line_pixels_to_real_coordinates, sensor_ingest, pose_track, georeference_stage, pose_track_stage])
+    frames = debug(frames, "lines_coords.json")
+    if args.debug_dir is not None:
+        frames = kml_stage(frames, os.path.join(args.debug_dir, "3_length_slope_closeLines_filter.kml"))
+        debug_outputs.append(frames)
+    smoothed_lines, key = cached("smoothing", lambda frames=frames: smoothing_stage(frames, args.smoothing_look_ahead),
+                                 {"look_ahead_distance": args.smoothing_look_ahead}, [key], [smooth_lines, smoothing_stage])
+
+    if args.line_map is not None:
+        # Merging needs all lines of the drive to know which tiles of the map it covers
+        smoothed_lines = list(smoothed_lines)
+        fused, added = LineMap(args.line_map).merge((record["line_id"], record["points"]) for record in smoothed_lines)
+        print(f"{fused} vertices of the line map fused and {added} vertices added")
+
+    write_smoothed_lines_kml(((record["line_id"], record["points"]) for record in smoothed_lines), args.output_kml)
+
+    for frames in reversed(debug_outputs):
+        collections.deque(frames, maxlen=0)
+    print(f"KML file has been saved to {args.output_kml}")
@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+import warnings
+import numpy as np
+from scipy.signal import lfilter
+from sensor_ingest import recording_time_base, load_location_json, load_location_csv, load_yaw_rate, frame_times_ns, seconds_between
+
+'''
+The pose (location and heading) of the vehicle at every frame of the video, computed once for the whole drive into
+one array indexed by frame number, so georeferencing a frame is a direct lookup instead of a search in the location
+data.
+The magnetic heading of the phone is noisy near other vehicles and only changes at the rate of the location
+entries. fused_pose_track combines it with the yaw rate of the gyroscope (or of the orientation, see
+vehicle_angular_velocity.py) and the course of the GPS with a complementary filter: the heading follows the
+integrated yaw rate over short periods, and is pulled towards the magnetic heading and, while the vehicle is
+moving, the GPS course over longer periods. The filter runs over the whole drive at once, as an IIR filter on a
+regular time grid at the frame rate of the video.
+The heading of the track is in the convention of the magnetic heading of the phone, so the track can be used
+wherever a magnetic heading is (see camera_direction in line_pixels_to_real_coordinates.py).
+'''
+
+pose_dtype = np.dtype([('time', '<i8'), ('latitude', '<f8'), ('longitude', '<f8'), ('magnetic_heading', '<f8')])
+
+magnetic_deviation = 5.08  # Magnetic declination (degrees) added to the magnetic heading to get the true heading
+
+time_constant = 2  # Seconds over which the filter trusts the yaw rate more than the magnetic heading and GPS course
+gps_course_weight = 4  # Weight of the GPS course relative to the magnetic heading, while the vehicle is moving
+min_course_speed = 3  # Below this speed (m/s) the GPS course is GPS jitter and is not used
+min_yaw_rate_correlation = 0.5  # Minimum correlation between the turns of the yaw rate and of the reference heading
+
+
+def build_pose_index(locations, base):
+    """
+    Index the location and magnetic heading data by time.
+    The app records the magnetic heading with every entry, but the location only changes about once per second and
+    is repeated in between, so the location is indexed at the entries where it changes (the time of each new fix).
+    The heading is unwrapped, so interpolating between 359 and 1 degrees goes through 0 and not through 180.
+
+    Parameters:
+    - locations: Locations and magnetic headings sorted by time (see sensor_ingest.load_location_json).
+    - base: Time base of the recording, used to convert the frame timestamps (see sensor_ingest.recording_time_base).
+
+    Returns:
+    - Dictionary of arrays: 'fix_times', 'latitudes' and 'longitudes' of the location fixes, and 'heading_times'
+      and 'headings' (unwrapped, degrees) of all entries, with the times in seconds from 'origin' (epoch
+      nanoseconds), and the 'time_base'.
+    """
+    origin = int(locations['time'][0]) if len(locations) else 0
+    times = seconds_between(locations['time'], origin)
+    latitudes = np.asarray(locations['latitude'], dtype=np.float64)
+    longitudes = np.asarray(locations['longitude'], dtype=np.float64)
+    headings = np.asarray(locations['magnetic_heading'], dtype=np.float64)
+
+    new_fix = np.r_[True, (latitudes[1:] != latitudes[:-1]) | (longitudes[1:] != longitudes[:-1])] if len(times) else np.zeros(0, dtype=bool)
+    return {
+        'fix_times': times[new_fix],
+        'latitudes': latitudes[new_fix],
+        'longitudes': longitudes[new_fix],
+        'heading_times': times,
+        'headings': np.unwrap(headings, period=360),
+        'origin': origin,
+        'time_base': base,
+    }
+
+def frame_pose_times(timestamps, pose_index):
+    """
+    Times of frame timestamps ('HHMMSS.ffffff') in seconds from the origin of a pose index.
+    """
+    return seconds_between(frame_times_ns(timestamps, pose_index['time_base']), pose_index['origin'])
+
+def interpolate_poses(times, pose_index):
+    """
+    Latitude, longitude and magnetic heading interpolated at each of the given times (seconds from the origin of
+    the pose index, see frame_pose_times), all in one batched query. Times outside of the recording get the first or last pose.
+
+    Returns:
+    - Arrays of latitudes, longitudes and magnetic headings (degrees, in [0, 360)).
+    """
+    latitudes = np.interp(times, pose_index['fix_times'], pose_index['latitudes'])
+    longitudes = np.interp(times, pose_index['fix_times'], pose_index['longitudes'])
+    headings = np.mod(np.interp(times, pose_index['heading_times'], pose_index['headings']), 360)
+    return latitudes, longitudes, headings
+
+def empty_pose_track(frame_timestamps):
+    """
+    Pose track with a row for every frame number up to the last frame with a timestamp, all without a pose (NaN).
+    """
+    track = np.zeros(max(frame_timestamps, default=-1) + 1, dtype=pose_dtype)
+    track['latitude'] = track['longitude'] = track['magnetic_heading'] = np.nan
+    return track
+
+def interpolated_pose_track(frame_timestamps, pose_index):
+    """
+    Pose track with the location and magnetic heading of the phone interpolated at the timestamp of each frame.
+
+    Parameters:
+    - frame_timestamps: Dictionary of frame timestamps with frame number as key.
+    - pose_index: Pose index returned by build_pose_index.
+
+    Returns:
+    - Array of pose_dtype indexed by frame number (see pose_at).
+    """
+    track = empty_pose_track(frame_timestamps)
+    if len(pose_index['heading_times']) == 0:
+        return track
+    frame_numbers = np.fromiter(frame_timestamps, dtype=np.int64, count=len(frame_timestamps))
+    timestamps = [frame_timestamps[frame_number] for frame_number in frame_numbers.tolist()]
+    track['time'][frame_numbers] = frame_times_ns(timestamps, pose_index['time_base'])
+    track['latitude'][frame_numbers], track['longitude'][frame_numbers], track['magnetic_heading'][frame_numbers] = interpolate_poses(frame_pose_times(timestamps, pose_index), pose_index)
+    return track
+
+def course_from_fixes(pose_index):
+    """
+    GPS course (degrees from true north) and speed (m/s) between consecutive location fixes, at the midpoint of
+    each pair of fixes, for location data without a recorded course.
+
+    Returns:
+    - Arrays of times (seconds from the origin of the pose index), courses and speeds.
+    """
+    times, latitudes, longitudes = pose_index['fix_times'], pose_index['latitudes'], pose_index['longitudes']
+    north = np.diff(latitudes) * 111320
+    east = np.diff(longitudes) * 111320 * np.cos(np.radians(latitudes[1:]))
+    durations = np.maximum(np.diff(times), 1e-3)
+    return (times[1:] + times[:-1]) / 2, np.mod(np.degrees(np.arctan2(east, north)), 360), np.hypot(east, north) / durations
+
+def reference_headings(grid, pose_index, gps):
+    """
+    Absolute heading of the vehicle on the time grid, in the convention of the magnetic heading: the magnetic
+    heading, averaged with the GPS course (on the unit circle) where the vehicle moves fast enough for it.
+
+    Parameters:
+    - grid: Times (seconds from the origin of the pose index).
+    - pose_index: Pose index returned by build_pose_index.
+    - gps: GPS course as (times, courses in degrees from true north, speeds), see course_from_fixes.
+
+    Returns:
+    - Unwrapped headings (degrees).
+    """
+    headings = np.radians(np.interp(grid, pose_index['heading_times'], pose_index['headings']))
+    sin, cos = np.sin(headings), np.cos(headings)
+    course_times, courses, speeds = gps
+    valid = speeds >= min_course_speed
+    if np.count_nonzero(valid) >= 2:
+        # The camera looks along the course, and its direction is the magnetic heading - 270 + magnetic_deviation
+        courses = np.radians(np.unwrap(courses[valid] + 270 - magnetic_deviation, period=360))
+        weights = gps_course_weight * (np.interp(grid, course_times, speeds) >= min_course_speed)
+        weights *= (grid >= course_times[valid][0]) & (grid <= course_times[valid][-1])
+        sin += weights * np.sin(np.interp(grid, course_times[valid], courses))
+        cos += weights * np.cos(np.interp(grid, course_times[valid], courses))
+    return np.degrees(np.unwrap(np.arctan2(sin, cos)))
+
+def fused_pose_track(frame_timestamps, pose_index, yaw_rates=None, gps=None, filter_time_constant=time_constant):
+    """
+    Pose track with the heading fused from the magnetic heading, the yaw rate and the GPS course with a
+    complementary filter, and the location interpolated between the fixes.
+
+    Parameters:
+    - frame_timestamps: Dictionary of frame timestamps with frame number as key.
+    - pose_index: Pose index returned by build_pose_index.
+    - yaw_rates: Yaw rates of the vehicle (sensor_ingest.yaw_rate_dtype), or None to only smooth the magnetic
+      heading and GPS course.
+    - gps: GPS course as (times, courses, speeds) (see course_from_fixes, which is used if None).
+    - filter_time_constant: Time constant of the filter (seconds).
+
+    Returns:
+    - Array of pose_dtype indexed by frame number (see pose_at).
+    """
+    track = interpolated_pose_track(frame_timestamps, pose_index)
+    has_pose = ~np.isnan(track['latitude'])
+    if np.count_nonzero(has_pose) < 2:
+        return track
+    frame_times = seconds_between(track['time'][has_pose], pose_index['origin'])
+
+    # Regular time grid at the frame rate of the video, over the whole drive
+    frame_interval = np.median(np.diff(np.sort(frame_times)))
+    frame_interval = frame_interval if frame_interval > 0 else 1 / 30
+    grid = np.arange(frame_times.min(), frame_times.max() + frame_interval, frame_interval)
+
+    references = reference_headings(grid, pose_index, gps if gps is not None else course_from_fixes(pose_index))
+    integrated = np.zeros(len(grid))
+    if yaw_rates is not None and len(yaw_rates) >= 2:
+        rates = np.degrees(np.interp(grid, seconds_between(yaw_rates['time'], pose_index['origin']), yaw_rates['yaw_derivative'], left=0, right=0))
+        turns = np.concatenate([[0.0], np.cumsum((rates[1:] + rates[:-1]) / 2 * frame_interval)])
+        # The yaw rate may turn the other way than the heading (e.g. the sign of the gyroscope axis is arbitrary),
+        # and is not used if it does not follow the turns of the reference heading (e.g. recorded on another drive).
+        # The turns are compared over the time constant, as the reference heading is too noisy from frame to frame.
+        window = max(int(round(filter_time_constant / frame_interval)), 1)
+        correlation = np.corrcoef(turns[window:] - turns[:-window], references[window:] - references[:-window])[0, 1] if len(grid) > window + 1 and np.std(rates) > 0 else 0
+        if abs(correlation) >= min_yaw_rate_correlation:
+            integrated = np.sign(correlation) * turns
+        else:
+            warnings.warn(f"The yaw rate does not follow the heading (correlation {correlation:.2f}), the heading is only smoothed")
+
+    # Complementary filter: the heading is the integrated yaw rate plus the low-passed difference between the
+    # reference heading and the integrated yaw rate (a first order IIR filter, started at the first difference)
+    alpha = np.exp(-frame_interval / filter_time_constant)
+    differences = references - integrated
+    smoothed, _ = lfilter([1 - alpha], [1, -alpha], differences, zi=[alpha * differences[0]])
+    headings = integrated + smoothed
+
+    track['magnetic_heading'][has_pose] = np.mod(np.interp(frame_times, grid, headings), 360)
+    return track
+
+def pose_at(pose_track, frame_number):
+    """
+    Pose of one frame in the format of the location entries ({"latitude", "longitude", "magneticHeading"}), or None
+    if the frame has no pose.
+    """
+    if not 0 <= frame_number < len(pose_track) or np.isnan(pose_track['latitude'][frame_number]):
+        return None
+    pose = pose_track[frame_number]
+    return {'latitude': float(pose['latitude']), 'longitude': float(pose['longitude']), 'magneticHeading': float(pose['magnetic_heading'])}
+
+def gps_course(locations):
+    """
+    GPS course and speed of the Sensor Logger locations (see sensor_ingest.load_location_csv), without the fixes
+    where the course is unknown (negative), as (times in epoch nanoseconds, courses, speeds).
+    """
+    known = locations['bearing'] >= 0
+    return locations['time'][known], locations['bearing'][known], locations['speed'][known]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Compute the pose of the vehicle at every frame of the video')
+    parser.add_argument('--locations', type=str, default='locations_data/locations_and_magneticHeadings.json', help='locations and magnetic headings recorded by MyApp')
+    parser.add_argument('--timestamps', type=str, default='output_jsons/timestamp_of_each_frame.json', help='timestamp_of_each_frame.json')
+    parser.add_argument('--yaw-rate', type=str, default='IMU_data/Angular_Velocity.npy', help='output of vehicle_angular_velocity.py (the heading is only smoothed if it does not exist)')
+    parser.add_argument('--gps', type=str, default=None, help='Sensor Logger Location.csv, for the GPS course (computed from the locations if not given)')
+    parser.add_argument('--metadata', type=str, default='motion_data/Metadata.csv', help='Sensor Logger Metadata.csv, for the timezone of the recording')
+    parser.add_argument('--time-constant', type=float, default=time_constant, help='time constant of the heading filter (seconds)')
+    parser.add_argument('--no-fusion', action='store_true', default=False, help='only interpolate the magnetic heading, as before')
+    parser.add_argument('--output', type=str, default='output_jsons/pose_track.npy', help='pose track, indexed by frame number')
+    args = parser.parse_args()
+
+    with open(args.timestamps, 'r') as file:
+        frame_timestamps = {item['frame']: item['timestamp'] for item in json.load(file)}
+    base = recording_time_base(args.metadata, args.locations)
+    pose_index = build_pose_index(load_location_json(args.locations, base), base)
+
+    if args.no_fusion:
+        pose_track = interpolated_pose_track(frame_timestamps, pose_index)
+    else:
+        yaw_rates = load_yaw_rate(args.yaw_rate, base) if os.path.exists(args.yaw_rate) else None
+        gps = None
+        if args.gps is not None:
+            course_times, courses, speeds = gps_course(load_location_csv(args.gps))
+            gps = (seconds_between(course_times, pose_index['origin']), courses, speeds)
+        pose_track = fused_pose_track(frame_timestamps, pose_index, yaw_rates, gps, args.time_constant)
+
+    np.save(args.output, pose_track)
+    print(f"Poses of {np.count_nonzero(~np.isnan(pose_track['latitude']))} frames saved to {args.output}")
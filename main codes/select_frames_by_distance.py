@@ -0,0 +1,75 @@
+import json
+import numpy as np
+from sensor_ingest import recording_time_base, load_location_csv, frame_times_ns, seconds_between
+
+'''
+This script selects the video frames that LaneAF should run on, so that consecutive selected frames are a fixed
+ground distance apart instead of a fixed number of frames apart. With a fixed stride, frames are wasted while the
+vehicle is stopped at traffic lights and the coverage gets sparse on fast stretches.
+The travelled distance is computed from the locations in the Sensor Logger 'Location.csv' file (read through
+sensor_ingest.py) and interpolated at the timestamp of each frame. Frames recorded while the vehicle is stationary are skipped entirely.
+The selected frame numbers are saved to a JSON file which is passed to mask_of_all_frames.py with --frame-list.
+'''
+
+
+def cumulative_distance(latitudes, longitudes, speeds, min_speed):
+    """
+    Distance travelled (meters) at each location fix. Movements between fixes recorded while the vehicle is
+    stationary are GPS jitter and are not counted.
+    """
+    lat_distance = np.diff(latitudes) * 111320  # Convert latitude distance to meters
+    lon_distance = np.diff(longitudes) * 111320 * np.cos(np.radians(latitudes[1:]))  # Convert longitude distance to meters
+    steps = np.sqrt(lat_distance**2 + lon_distance**2)
+    steps[speeds[1:] < min_speed] = 0
+    return np.concatenate([[0.0], np.cumsum(steps)])
+
+def select_frames_by_distance(frame_numbers, frame_times, location_times, distances, speeds, frame_spacing, min_speed):
+    """
+    Select the first moving frame of every frame_spacing meters of travelled distance.
+
+    Parameters:
+    - frame_numbers, frame_times: Frame numbers and their times (epoch nanoseconds).
+    - location_times, distances, speeds: Time (epoch nanoseconds), cumulative distance and speed of each location fix.
+    - frame_spacing: Ground distance between consecutive selected frames (meters).
+    - min_speed: Frames where the vehicle is slower than this (m/s) are skipped.
+
+    Returns:
+    - List of selected frame numbers.
+    """
+    in_range = (frame_times >= location_times[0]) & (frame_times <= location_times[-1])
+    frame_seconds = seconds_between(frame_times, location_times[0])
+    location_seconds = seconds_between(location_times, location_times[0])
+    frame_distances = np.interp(frame_seconds, location_seconds, distances)
+    frame_speeds = np.interp(frame_seconds, location_seconds, speeds)
+    moving = in_range & (frame_speeds >= min_speed)
+
+    distance_bins = np.floor(frame_distances[moving] / frame_spacing)
+    _, first_in_bin = np.unique(distance_bins, return_index=True)
+    return frame_numbers[moving][first_in_bin].tolist()
+
+
+if __name__ == '__main__':
+    location_file_path = "motion_data/Location.csv"
+    metadata_file_path = "motion_data/Metadata.csv"
+    timestamp_file_path = "output_jsons/timestamp_of_each_frame.json"
+    output_file_path = "output_jsons/selected_frames.json"
+
+    frame_spacing = 10  # Ground distance between consecutive inferred frames (meters). The top view covers about 17 meters ahead of the camera.
+    min_speed = 1  # Frames recorded below this speed (m/s) are considered stationary and skipped
+
+    # The frame times of day are dated with the start of the recording, in the timezone it was recorded in
+    base = recording_time_base(metadata_file_path)
+    locations = load_location_csv(location_file_path)
+
+    with open(timestamp_file_path, 'r') as file:
+        timestamp_data = json.load(file)
+
+    frame_numbers = np.array([item['frame'] for item in timestamp_data])
+    frame_times = frame_times_ns([item['timestamp'] for item in timestamp_data], base)
+    distances = cumulative_distance(locations['latitude'], locations['longitude'], locations['speed'], min_speed)
+    selected_frames = select_frames_by_distance(frame_numbers, frame_times, locations['time'], distances, locations['speed'], frame_spacing, min_speed)
+
+    with open(output_file_path, 'w') as file:
+        json.dump(selected_frames, file)
+
+    print(f"{len(selected_frames)} of {len(frame_numbers)} frames selected ({distances[-1]:.0f} meters driven), saved to {output_file_path}")
@@ -0,0 +1,231 @@
+import csv
+import json
+import os
+from datetime import date, datetime, time
+from zoneinfo import ZoneInfo
+import numpy as np
+import pandas as pd
+
+'''
+One place where the sensor logs are read. Each log is parsed once into a typed NumPy array (one field per column)
+with the time of every sample as int64 nanoseconds since the epoch, and cached as a .npy file next to the log
+(<log>.ingest.npy, with <log>.ingest.json recording what it was parsed from). Later loads memory-map the cached
+array, so they are near-instant, and every script sees the same times and values.
+
+The logs and the format of their times:
+- Sensor Logger (motion_data/): Location.csv, Orientation.csv, Gyroscope.csv have a 'time' column in epoch
+  nanoseconds. Metadata.csv has the recording start (epoch milliseconds) and the timezone. The IMU logs
+  (Orientation.csv, Gyroscope.csv) are only read by vehicle_angular_velocity.py, which streams them in chunks with
+  iter_csv_columns instead of caching them, as they can be larger than memory.
+- MyApp (locations_data/locations_and_magneticHeadings.json): local time 'YYYYMMDD.HHMMSS.ffffff'.
+- vehicle_angular_velocity.py (IMU_data/Angular_Velocity.npy): yaw_rate_dtype, already in epoch nanoseconds. Its
+  older CSV output (Angular_Velocity.csv) has the local time of day 'HH:MM:SS' and the seconds elapsed.
+- extract_timestamp_of_each_frame.py (output_jsons/timestamp_of_each_frame.json): local time of day 'HHMMSS.ffffff'.
+Local times are converted with a time base: the timezone of the recording and its local start. A time of day
+without a date belongs to the day of the start, or to the next day if it is more than 12 hours before the start
+(a drive over midnight).
+'''
+
+ns_per_second = 1_000_000_000
+ns_per_day = 86400 * ns_per_second
+ingest_version = 1  # Bump when a parser changes, so the cached arrays are parsed again
+
+location_dtype = np.dtype([('time', '<i8'), ('latitude', '<f8'), ('longitude', '<f8'), ('altitude', '<f8'), ('speed', '<f8'), ('bearing', '<f8'), ('horizontal_accuracy', '<f8')])
+orientation_dtype = np.dtype([('time', '<i8'), ('yaw', '<f8'), ('pitch', '<f8'), ('roll', '<f8')])
+gyroscope_dtype = np.dtype([('time', '<i8'), ('x', '<f8'), ('y', '<f8'), ('z', '<f8')])
+heading_location_dtype = np.dtype([('time', '<i8'), ('latitude', '<f8'), ('longitude', '<f8'), ('magnetic_heading', '<f8')])
+yaw_rate_dtype = np.dtype([('time', '<i8'), ('yaw', '<f8'), ('yaw_derivative', '<f8')])
+
+
+def time_base(timezone_name='UTC', start=None):
+    """
+    Time base of a recording (JSON serializable).
+
+    Parameters:
+    - timezone_name: Timezone the local times were recorded in.
+    - start: Local start of the recording as a datetime (naive, local time), 1970-01-01 00:00 if None.
+    """
+    start = start or datetime(1970, 1, 1)
+    return {'timezone': timezone_name, 'date': start.date().isoformat(), 'start_of_day': start.hour * 3600 + start.minute * 60 + start.second}
+
+def recording_time_base(metadata_path=None, location_json_path=None):
+    """
+    Time base of a recording. The timezone is read from the Sensor Logger Metadata.csv if it exists, UTC
+    otherwise (MyApp does not record it; local times converted with the same time base stay consistent with each
+    other whatever its timezone). The start is the first entry of the MyApp locations JSON if it exists, as the
+    frame times are matched to it, otherwise the start of the Sensor Logger recording.
+    """
+    timezone_name, start = 'UTC', None
+    if metadata_path is not None and os.path.exists(metadata_path):
+        metadata = read_metadata(metadata_path)
+        timezone_name = metadata['timezone']
+        start = datetime.fromtimestamp(metadata['recording_time'] / ns_per_second, ZoneInfo(timezone_name)).replace(tzinfo=None)
+    if location_json_path is not None and os.path.exists(location_json_path):
+        with open(location_json_path, 'r') as file:
+            entries = json.load(file)
+        if entries:
+            start = datetime.strptime(min(entry['time'] for entry in entries)[:15], '%Y%m%d.%H%M%S')
+    return time_base(timezone_name, start)
+
+def local_midnight_ns(day, timezone_name):
+    """
+    Epoch nanoseconds of the local midnight starting a day.
+    """
+    return int(datetime.combine(day, time(0), tzinfo=ZoneInfo(timezone_name)).timestamp()) * ns_per_second
+
+def time_of_day_ns(timestamps):
+    """
+    Nanoseconds since midnight of local times of day: 'HHMMSS.ffffff' (frame timestamps), 'HH:MM:SS' or
+    'HH:MM:SS.ffffff'.
+    """
+    ns = np.empty(len(timestamps), dtype=np.int64)
+    for i, timestamp in enumerate(timestamps):
+        timestamp = timestamp.replace(':', '')
+        seconds, _, fraction = timestamp[4:].partition('.')
+        ns[i] = ((int(timestamp[:2]) * 60 + int(timestamp[2:4])) * 60 + int(seconds)) * ns_per_second + int((fraction + '000000000')[:9])
+    return ns
+
+def local_times_of_day_to_epoch_ns(ns_of_day, base):
+    """
+    Epoch nanoseconds of local times of day (nanoseconds since midnight) of the recording of a time base.
+    """
+    ns_of_day = np.asarray(ns_of_day, dtype=np.int64)
+    next_day = ns_of_day < (base['start_of_day'] - 12 * 3600) * ns_per_second
+    return local_midnight_ns(date.fromisoformat(base['date']), base['timezone']) + ns_of_day + next_day * np.int64(ns_per_day)
+
+def frame_times_ns(timestamps, base):
+    """
+    Epoch nanoseconds of frame timestamps ('HHMMSS.ffffff', as in timestamp_of_each_frame.json).
+    """
+    return local_times_of_day_to_epoch_ns(time_of_day_ns(list(timestamps)), base)
+
+def location_json_times_ns(timestamps, timezone_name):
+    """
+    Epoch nanoseconds of the MyApp location times ('YYYYMMDD.HHMMSS.ffffff', local time).
+    """
+    timestamps = list(timestamps)
+    ns = time_of_day_ns([timestamp[9:] for timestamp in timestamps])
+    midnights = {day: local_midnight_ns(datetime.strptime(day, '%Y%m%d').date(), timezone_name) for day in {timestamp[:8] for timestamp in timestamps}}
+    return ns + np.array([midnights[timestamp[:8]] for timestamp in timestamps], dtype=np.int64)
+
+def seconds_between(times_ns, origin_ns):
+    """
+    Seconds from origin_ns to each time, as float64 (exact to well below a microsecond for a day of recording,
+    unlike epoch seconds in float64).
+    """
+    return (np.asarray(times_ns, dtype=np.int64) - np.int64(origin_ns)) / ns_per_second
+
+
+def read_metadata(file_path):
+    """
+    Read the recording start (epoch nanoseconds) and timezone from the Sensor Logger 'Metadata.csv' file.
+    """
+    with open(file_path, 'r') as csvfile:
+        row = next(csv.DictReader(csvfile))
+    return {'recording_time': int(row['recording epoch time']) * 1_000_000, 'timezone': row['recording timezone']}
+
+def cached_array(source_path, kind, parse, params=None):
+    """
+    Array parsed from a log, memory-mapped from its cache next to the log, or parsed and cached if the cache is
+    missing or was made from a different version of the log, parser or parameters.
+
+    Parameters:
+    - source_path: Path of the log.
+    - kind: Name of the parser (part of the cache validity).
+    - parse: Function returning the array, only called when the cache is not valid.
+    - params: JSON serializable parameters of the parser (e.g. the time base).
+    """
+    stat = os.stat(source_path)
+    description = {'kind': kind, 'version': ingest_version, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'params': params}
+    array_path = source_path + '.ingest.npy'
+    meta_path = source_path + '.ingest.json'
+    if os.path.exists(array_path) and os.path.exists(meta_path):
+        with open(meta_path, 'r') as file:
+            if json.load(file) == description:
+                return np.load(array_path, mmap_mode='r')
+
+    array = parse()
+    with open(array_path + '.tmp', 'wb') as file:
+        np.save(file, array)
+    os.replace(array_path + '.tmp', array_path)
+    with open(meta_path, 'w') as file:
+        json.dump(description, file)
+    return np.load(array_path, mmap_mode='r')
+
+def iter_csv_columns(file_path, columns, dtype, chunk_size=1_000_000):
+    """
+    Columns of a CSV file as structured arrays (fields in the order of columns) of chunk_size rows at most, read
+    one chunk at a time. The first field is the integer 'time' column.
+    """
+    converters = {column: (np.int64 if i == 0 else np.float64) for i, column in enumerate(columns)}
+    for chunk in pd.read_csv(file_path, usecols=columns, dtype=converters, chunksize=chunk_size):
+        array = np.empty(len(chunk), dtype=dtype)
+        for field, column in zip(dtype.names, columns):
+            array[field] = chunk[column].to_numpy()
+        yield array
+
+def read_csv_columns(file_path, columns, dtype, chunk_size=1_000_000):
+    """
+    Columns of a CSV file into one structured array (see iter_csv_columns).
+    """
+    chunks = list(iter_csv_columns(file_path, columns, dtype, chunk_size))
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+
+def load_location_csv(file_path):
+    """
+    Sensor Logger 'Location.csv' (location_dtype), sorted by time.
+    """
+    def parse():
+        array = read_csv_columns(file_path, ['time', 'latitude', 'longitude', 'altitude', 'speed', 'bearing', 'horizontalAccuracy'], location_dtype)
+        return array[np.argsort(array['time'], kind='stable')]
+    return cached_array(file_path, 'location_csv', parse)
+
+def load_location_json(file_path, base):
+    """
+    MyApp locations and magnetic headings (heading_location_dtype), sorted by time.
+    """
+    def parse():
+        with open(file_path, 'r') as file:
+            entries = json.load(file)
+        array = np.empty(len(entries), dtype=heading_location_dtype)
+        array['time'] = location_json_times_ns([entry['time'] for entry in entries], base['timezone'])
+        array['latitude'] = [entry['latitude'] for entry in entries]
+        array['longitude'] = [entry['longitude'] for entry in entries]
+        array['magnetic_heading'] = [entry['magneticHeading'] for entry in entries]
+        return array[np.argsort(array['time'], kind='stable')]
+    return cached_array(file_path, 'location_json', parse, {'timezone': base['timezone']})
+
+def load_yaw_rate_csv(file_path, base):
+    """
+    Yaw and yaw derivative of 'Angular_Velocity.csv' (yaw_rate_dtype), sorted by time.
+    The file has the time of each sample as 'HH:MM:SS' (exact_time, truncated to whole seconds) and the seconds
+    elapsed since the start of the recording. The start of the recording is recovered from them as the latest
+    start that is consistent with every truncated time, so every sample keeps its own time.
+    """
+    def parse():
+        data = pd.read_csv(file_path, dtype={'exact_time': str, 'seconds_elapsed': np.float64, 'yaw': np.float64, 'yaw_derivative': np.float64})
+        array = np.empty(len(data), dtype=yaw_rate_dtype)
+        if len(data) == 0:
+            return array
+        exact_seconds = time_of_day_ns(data['exact_time'].tolist()) // ns_per_second
+        exact_seconds = np.unwrap(exact_seconds.astype(np.float64), period=86400)  # Recordings over midnight
+        seconds_elapsed = data['seconds_elapsed'].to_numpy()
+        start_of_day = np.max(exact_seconds - seconds_elapsed)
+        start = local_times_of_day_to_epoch_ns([int(np.floor(start_of_day)) * ns_per_second], base)[0]
+        array['time'] = start + np.round((start_of_day - np.floor(start_of_day) + seconds_elapsed) * ns_per_second).astype(np.int64)
+        array['yaw'] = data['yaw'].to_numpy()
+        array['yaw_derivative'] = data['yaw_derivative'].to_numpy()
+        return array[np.argsort(array['time'], kind='stable')]
+    return cached_array(file_path, 'yaw_rate_csv', parse, base)
+
+def load_yaw_rate(file_path, base):
+    """
+    Yaw and yaw derivative written by vehicle_angular_velocity.py (yaw_rate_dtype), from its binary output (.npy,
+    memory-mapped as is) or from its CSV output (see load_yaw_rate_csv).
+    """
+    if file_path.lower().endswith('.npy'):
+        yaw_rates = np.load(file_path, mmap_mode='r')
+        if yaw_rates.dtype != yaw_rate_dtype:
+            raise ValueError(f"{file_path} is not a yaw rate time series (dtype {yaw_rates.dtype})")
+        return yaw_rates
+    return load_yaw_rate_csv(file_path, base)
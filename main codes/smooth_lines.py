@@ -1,7 +1,11 @@
+import collections
 from tqdm import tqdm
-import simplekml
 import json
 import numpy as np
+from scipy.spatial import cKDTree
+from line_store import load_lines, lines_to_frames, iter_frames
+import kml_writer
+from kml_writer import KmlWriter
 
 
 '''
@@ -19,51 +23,49 @@ The results are saved into a KML file to visualize the smoothed lines.
 # lines in consecutive frames to be slightly apart, making the line not smooth.
 # The function takes a list of points with their respective variances and combines them into a single point 
 # with a new variance, effectively smoothing the line. 
+# Combining the distributions one after the other (Kalman updates) gives the inverse-variance weighted mean of
+# the points, with the inverse of the summed inverse variances as the new variance, so it is computed in closed form.
+# Points with zero variance (exactly at the vehicle) are certain, their mean is returned with zero variance.
 def combine_points_with_variance(points_with_variance):
-    if not points_with_variance:
+    if len(points_with_variance) == 0:
         return None
-    
-    # Extract latitudes, longitudes, and variances
-    latitudes = np.array([point[0] for point in points_with_variance])
-    longitudes = np.array([point[1] for point in points_with_variance])
-    variances = np.array([point[2] for point in points_with_variance])
-
-    # Initialize with the first distribution
-    mean_lat_new = latitudes[0]
-    mean_lon_new = longitudes[0]
-    var_new = variances[0]
-
-    # Combine distributions incrementally
-    for i in range(1, len(latitudes)):
-        lat = latitudes[i]
-        lon = longitudes[i]
-        var = variances[i]
-
-        # Calculate k and final variance for the new distribution
-        k = var_new / (var_new + var)
-
-        mean_lat_new = mean_lat_new + k * (lat - mean_lat_new)
-        mean_lon_new = mean_lon_new + k * (lon - mean_lon_new)
-
-        # Calculate final variance for the new distribution
-        var_new = var_new * (1 - k) 
-
-    return mean_lat_new, mean_lon_new, var_new
-
-
-# Function to generate 50 points along a line and calculate variance
-def generate_points_with_variance(start, end, frame_coord, num_points=50):
-    start = np.array(start)
-    end = np.array(end)
-    frame_coord = np.array(frame_coord)
-    t = np.linspace(0, 1, num_points)
-    points = []
-    for ti in t:
-        point = start + (end - start) * ti
-        distance = calculate_distance(point, frame_coord)
-        var = 0.1 * distance  # Variance depends on distance
-        points.append([point[0], point[1], var])
-    return points
+
+    # Latitudes, longitudes and variances
+    points = np.array([point[:3] for point in points_with_variance], dtype=np.float64)
+    latitudes, longitudes, variances = points[:, 0], points[:, 1], points[:, 2]
+
+    certain = variances == 0
+    if certain.any():
+        return latitudes[certain].mean(), longitudes[certain].mean(), np.float64(0)
+
+    weights = 1 / variances
+    total_weight = weights.sum()
+    return weights @ latitudes / total_weight, weights @ longitudes / total_weight, 1 / total_weight
+
+
+# Function to generate 50 points along each line and calculate their variance
+def generate_points_with_variance(starts, ends, frame_coords, num_points=50):
+    """
+    Sample points along lines, with a variance depending on their distance to the vehicle.
+
+    Parameters:
+    - starts, ends: Start and end points (latitude, longitude) of the lines, shape (number of lines, 2).
+    - frame_coords: Location of the vehicle when each line was seen, shape (number of lines, 2).
+    - num_points: Number of points sampled along each line.
+
+    Returns:
+    - Array of shape (number of lines, num_points, 3) of latitude, longitude and variance.
+    """
+    starts = np.asarray(starts, dtype=np.float64).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=np.float64).reshape(-1, 2)
+    frame_coords = np.asarray(frame_coords, dtype=np.float64).reshape(-1, 2)
+    t = np.linspace(0, 1, num_points)[np.newaxis, :, np.newaxis]
+
+    samples = np.empty((len(starts), num_points, 3))
+    samples[..., :2] = starts[:, np.newaxis] + (ends - starts)[:, np.newaxis] * t
+    distance = calculate_distance((samples[..., 0], samples[..., 1]), (frame_coords[:, np.newaxis, 0], frame_coords[:, np.newaxis, 1]))
+    samples[..., 2] = 0.1 * distance  # Variance depends on distance
+    return samples
 
 # Function to calculate variance for end_point and append it to end_point
 def add_variance_to_end_point(end_point, frame_coord):
@@ -72,7 +74,7 @@ def add_variance_to_end_point(end_point, frame_coord):
     var = 0.1 * distance  # Variance depends on distance
     return np.append(end_point, var)  # Append variance to end_point
 
-# Function to calculate distance in meters
+# Function to calculate distance in meters (of points or arrays of points)
 def calculate_distance(point1, point2):
     lat1, lon1 = point1
     lat2, lon2 = point2
@@ -82,63 +84,94 @@ def calculate_distance(point1, point2):
 
 # Function to extract points and calculate variance for each line from frames
 def extract_points_and_variance(sorted_data):
-    all_points = {}
-    for index, frame in enumerate(sorted_data):
-        frame_number = index  # Use sorted index as frame number
-        lines = frame['lines_pixel_on_top_view']
-        frame_coords = frame['coords']
-        # Create dictionary for current frame
-        all_points[frame_number] = {
-            'frame_coord': frame_coords,
-            'lines': {}
-        }
-        
-        for line_id, line in lines.items():
-            start_point = line['start']
-            end_point = line['end']
-            
-            # Generate 50 points along the line and calculate variance
-            points = generate_points_with_variance(start_point, end_point, frame_coords, num_points=50)
-            
-            # Store points for each line
-            all_points[frame_number]['lines'][line_id] = points
-    
-    return all_points
-
-# Function to find frames within 50 meters of end_point
-def find_nearby_frames(end_point, current_frame_index, sorted_data, distance_threshold=50):
-    nearby_frames = []
+    """
+    Sample 50 points along every line of every frame, in one array.
+
+    Returns:
+    - Dictionary with 'samples' (number of lines, 50, 3) of latitude, longitude and variance, and the sorted
+      index of the frame ('frames') and the id ('line_ids') of each line, in the order of sorted_data.
+    """
+    frames, line_ids, starts, ends, frame_coords = [], [], [], [], []
     for index, frame in enumerate(sorted_data):
-        if index <= current_frame_index:
-            continue  # Skip current frame
-        
-        frame_coord = frame['coords']
-        distance = calculate_distance(end_point[:2], frame_coord)
-        
-        if distance < distance_threshold:
-            nearby_frames.append(index)
-    
-    return nearby_frames
-
-# Function to find the closest point to end_point among the points in the identified frames
-def find_closest_points(end_point, nearby_frames, all_points):
+        for line_id, line in frame['lines_pixel_on_top_view'].items():
+            frames.append(index)  # Use sorted index as frame number
+            line_ids.append(line_id)
+            starts.append(line['start'])
+            ends.append(line['end'])
+            frame_coords.append(frame['coords'])
+
+    return {
+        'samples': generate_points_with_variance(starts, ends, frame_coords, num_points=50),
+        'frames': np.array(frames, dtype=np.intp),
+        'line_ids': line_ids
+    }
+
+
+# Radius of the sphere on which 1 degree is 111320 meters, as in calculate_distance
+earth_radius = 111320 * 180 / np.pi
+
+def to_cartesian(latitudes, longitudes):
+    """
+    Points on the sphere of radius earth_radius (meters), so the straight-line distance between two points is
+    their distance in meters. Unlike a projection, this holds everywhere on the survey.
+    """
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+    return earth_radius * np.column_stack([np.cos(latitudes) * np.cos(longitudes), np.cos(latitudes) * np.sin(longitudes), np.sin(latitudes)])
+
+def build_points_index(all_points):
+    """
+    KD-tree over all sampled points of all lines (flattened in the order of all_points['samples']), in metric coordinates.
+    """
+    points = all_points['samples'].reshape(-1, 3)
+    return cKDTree(to_cartesian(points[:, 0], points[:, 1]))
+
+def find_closest_points(end_point, current_frame_index, candidates, all_points, sorted_data, distance_threshold=50):
+    """
+    Find, in each later frame within distance_threshold meters of end_point, the sampled point closest to end_point,
+    and keep it if it is closer than lines_merge_distance_threshold.
+    Only the candidate points found near end_point in the points index are looked at. They are all sampled points
+    within (slightly more than) lines_merge_distance_threshold of end_point, so the closest point of a frame is
+    among them whenever it is close enough to be kept.
+
+    Parameters:
+    - end_point: End point (latitude, longitude, variance).
+    - current_frame_index: Index of the frame of end_point, only later frames are searched.
+    - candidates: Indices of the candidate points in the points index.
+    - all_points: Sampled points returned by extract_points_and_variance.
+    - sorted_data: List of frames sorted by frame number.
+    - distance_threshold: Only frames closer than this to end_point are searched (meters).
+
+    Returns:
+    - List of the closest point of each frame, with its frame index and line id appended.
+    """
+    samples_per_line = all_points['samples'].shape[1]
+    candidates = np.sort(np.asarray(candidates, dtype=np.intp))
+    candidate_lines = candidates // samples_per_line
+    candidate_frames = all_points['frames'][candidate_lines]
+    later = candidate_frames > current_frame_index
+    candidates, candidate_lines, candidate_frames = candidates[later], candidate_lines[later], candidate_frames[later]
+    if len(candidates) == 0:
+        return []
+
+    points = all_points['samples'].reshape(-1, 3)[candidates]
+    distances = calculate_distance((points[:, 0], points[:, 1]), end_point[:2])
+
+    # Closest candidate of each frame (the first one on ties, in the order of frames, lines and points)
+    frame_starts = np.flatnonzero(np.r_[True, candidate_frames[1:] != candidate_frames[:-1]])
+    frame_ends = np.r_[frame_starts[1:], len(candidates)]
+
     closest_points = []
-    for frame_number in nearby_frames:
-        min_distance = float('inf')
-        closest_point = None
-        
-        for line_id, line_points in all_points[frame_number]['lines'].items():
-            for point in line_points:
-                distance = calculate_distance(point[:2], end_point[:2])
-                if distance < min_distance:
-                    min_distance = distance
-                    closest_point = point + [frame_number, line_id]  # Add frame number and line ID to closest_point
-        
-        if closest_point is not None and calculate_distance(end_point[:2],closest_point[:2]) < lines_merge_distance_threshold:
-            closest_points.append(closest_point)
-    
-    return closest_points
+    for first, last in zip(frame_starts.tolist(), frame_ends.tolist()):
+        frame_number = int(candidate_frames[first])
+        if calculate_distance(end_point[:2], sorted_data[frame_number]['coords']) >= distance_threshold:
+            continue
+
+        closest = first + int(np.argmin(distances[first:last]))
+        if calculate_distance(end_point[:2], points[closest][:2]) < lines_merge_distance_threshold:
+            closest_points.append(points[closest].tolist() + [frame_number, all_points['line_ids'][candidate_lines[closest]]])
 
+    return closest_points
 
 
 def average_points(point1, point2):
@@ -148,40 +181,35 @@ def average_points(point1, point2):
 
 lines_merge_distance_threshold = 1.1  # Distance threshold in meters; if the end of one line and the start of another line are within this distance, they will be merged.
 
-with open('output_jsons/lines_coords.json', 'r') as f:
-    data = json.load(f)
+class LineAggregator:
+    """
+    Aggregated lines being built, and the aggregated line each line seen so far is mapped to. A line is
+    identified by (sorted index of its frame, line id).
+    """
+
+    def __init__(self):
+        # Create a dictionary to store aggregated lines
+        self.aggregated_lines = {}
+
+        # Dictionary to keep track of unique line IDs
+        self.to_which_aggregated_line = {}
+        self.aggregated_line_counter = 0
+
+    def add_line(self, i, line_id, line, end_point_with_var, closest_points):
+        """
+        Add a line of the frame with sorted index i to its aggregated line (a new one if no earlier line was
+        mapped to it), map the lines of closest_points (from find_closest_points) to it and append the combined
+        end point to it.
+        """
+        aggregated_lines = self.aggregated_lines
+        to_which_aggregated_line = self.to_which_aggregated_line
 
-# Sort data based on frame number
-sorted_data = sorted(data, key=lambda x: x['framenumber'])
-
-np.set_printoptions(precision=15) 
-
-# Extract points from each line in frames and calculate variance
-all_points = extract_points_and_variance(sorted_data)
-
-# Create a dictionary to store aggregated lines
-aggregated_lines = {}
-
-# Dictionary to keep track of unique line IDs
-to_which_aggregated_line = {}
-aggregated_line_counter = 0
-
-
-for i, frame in tqdm(enumerate(sorted_data), total=len(sorted_data), desc="Processing frames"):
-    lines = frame['lines_pixel_on_top_view']
-    for line_id, line in lines.items():
         unique_line_id = (i, line_id)
         if unique_line_id not in to_which_aggregated_line:
             start_point = tuple(line['start'])
-            aggregated_lines[aggregated_line_counter] = [start_point]
-            to_which_aggregated_line[unique_line_id] = aggregated_line_counter
-            aggregated_line_counter += 1
-        
-        end_point = tuple(line['end'])
-        end_point_with_var = add_variance_to_end_point(np.array(end_point), frame['coords'])
-
-        nearby_frames = find_nearby_frames(end_point_with_var, i, sorted_data, distance_threshold=50)
-        closest_points = find_closest_points(end_point_with_var, nearby_frames, all_points)
+            aggregated_lines[self.aggregated_line_counter] = [start_point]
+            to_which_aggregated_line[unique_line_id] = self.aggregated_line_counter
+            self.aggregated_line_counter += 1
 
         for cp in closest_points:
             cp_frame_index = cp[3]
@@ -194,30 +222,184 @@ for i, frame in tqdm(enumerate(sorted_data), total=len(sorted_data), desc="Proce
                 new_path_index = to_which_aggregated_line[unique_line_id]
                 if calculate_distance(aggregated_lines[new_path_index][-1][:2],cp[:2])<calculate_distance(aggregated_lines[current_path_index][-1][:2],cp[:2]):
                     to_which_aggregated_line[unique_cp_line_id] = new_path_index
-     
+
         all_points_to_combine = [end_point_with_var] + closest_points
         combined_point = combine_points_with_variance(all_points_to_combine)
 
         agg_line_index = to_which_aggregated_line[unique_line_id]
         if calculate_distance(aggregated_lines[agg_line_index][-1][:2],combined_point[:2]) >= 3.5:
             aggregated_lines[agg_line_index].append(combined_point)
-        
-    
-kml = simplekml.Kml()
 
-# calculate total length of aggregated lines. only lines with length of greater than 15m will write to kml file
-for line_id, points in aggregated_lines.items():
+
+def frame_end_points(frame):
+    """
+    End points of the lines of a frame with their variance (find_closest_points input).
+    """
+    return [add_variance_to_end_point(np.array(tuple(line['end'])), frame['coords']) for line in frame['lines_pixel_on_top_view'].values()]
+
+def query_end_point_candidates(points_index, end_points_with_var):
+    """
+    Sampled points near each end point, from one batched query of the points index. The search radius is
+    slightly larger than the merge distance, for the difference between the two distances.
+    """
+    end_point_coordinates = np.array([end_point[:2] for end_point in end_points_with_var], dtype=np.float64).reshape(-1, 2)
+    return points_index.query_ball_point(to_cartesian(end_point_coordinates[:, 0], end_point_coordinates[:, 1]), r=lines_merge_distance_threshold * 1.02 + 0.01)
+
+def aggregate_lines(sorted_data):
+    """
+    Merge the lines of consecutive frames into aggregated lines, combining the end point of each line with the
+    close points of the lines in the following frames.
+
+    Parameters:
+    - sorted_data: List of frames with the GPS coordinates of their lines, sorted by frame number.
+
+    Returns:
+    - Dictionary of aggregated lines, each a list of (latitude, longitude[, variance]) points.
+    """
+    # Extract points from each line in frames and calculate variance
+    all_points = extract_points_and_variance(sorted_data)
+
+    # Find the sampled points near the end point of every line at once
+    points_index = build_points_index(all_points)
+    end_points_with_var = [end_point for frame in sorted_data for end_point in frame_end_points(frame)]
+    end_point_candidates = query_end_point_candidates(points_index, end_points_with_var)
+    end_point_number = 0
+
+    aggregator = LineAggregator()
+    for i, frame in tqdm(enumerate(sorted_data), total=len(sorted_data), desc="Processing frames"):
+        for line_id, line in frame['lines_pixel_on_top_view'].items():
+            end_point_with_var = end_points_with_var[end_point_number]
+            closest_points = find_closest_points(end_point_with_var, i, end_point_candidates[end_point_number], all_points, sorted_data, distance_threshold=50)
+            end_point_number += 1
+            aggregator.add_line(i, line_id, line, end_point_with_var, closest_points)
+
+    return aggregator.aggregated_lines
+
+look_ahead_distance = 100  # Meters the vehicle moves past a frame before its lines are merged in streaming mode
+max_look_ahead_frames = 1000  # Frames read ahead at most in streaming mode, when the vehicle stops or turns around
+
+def aggregate_lines_streaming(frames, look_ahead_distance=look_ahead_distance, max_look_ahead_frames=max_look_ahead_frames):
+    """
+    Same as aggregate_lines, in a sliding window over the frames, so memory does not grow with the length of the
+    drive. A line is only merged with the lines of the frames read ahead until the vehicle is look_ahead_distance
+    meters away from its frame, or max_look_ahead_frames frames are read ahead (the vehicle stops, or loops back
+    within look_ahead_distance). With a look-ahead larger than the 50 m searched around each end point plus the
+    length of the lines, this only differs from aggregate_lines where the vehicle drives past the same lines
+    again later (aggregate_lines merges those passes, this does not).
+    Every frame gets its own points index when it is read, and the end points of a frame are only looked up in
+    the indexes of the frames of the window within the 50 m, so the work per frame does not grow with the window.
+    An aggregated line is finished once no line left in the window is mapped to it: only those lines can add
+    points to it, and later lines can only be mapped to it through them. Finished lines are yielded right away
+    and forgotten.
+
+    Parameters:
+    - frames: Iterable of frames with the GPS coordinates of their lines, sorted by frame number.
+    - look_ahead_distance: Distance (meters) the window extends past the frame being merged.
+    - max_look_ahead_frames: Maximum number of frames in the window.
+
+    Yields:
+    - Aggregated line id and its list of (latitude, longitude[, variance]) points, in the order they are finished.
+    """
+    aggregator = LineAggregator()
+    frames = enumerate(frames)
+    window = collections.deque()  # (sorted index, frame, sampled points, points index) of the frames read ahead
+    frames_left = True
+
+    with tqdm(desc="Processing frames") as progress:
+        while True:
+            # Read ahead until the last frame read is far enough from the first frame of the window
+            while frames_left and (len(window) == 0 or (len(window) < max_look_ahead_frames and calculate_distance(window[0][1]['coords'], window[-1][1]['coords']) < look_ahead_distance)):
+                next_frame = next(frames, None)
+                if next_frame is None:
+                    frames_left = False
+                else:
+                    i, frame = next_frame
+                    points = extract_points_and_variance([frame])
+                    window.append((i, frame, points, build_points_index(points) if len(points['line_ids']) else None))
+            if len(window) == 0:
+                break
+
+            i, frame, _, _ = window[0]
+            end_points_with_var = frame_end_points(frame)
+            if end_points_with_var:
+                # Later frames of the window within the 50 m searched around an end point, and the candidate points
+                # of each end point in their indexes, numbered as in the concatenation of their sampled points
+                end_point_coordinates = np.array([end_point[:2] for end_point in end_points_with_var])
+                near_frames = [(index, window_frame, points, points_index) for index, window_frame, points, points_index in list(window)[1:]
+                               if points_index is not None and np.any(calculate_distance((end_point_coordinates[:, 0], end_point_coordinates[:, 1]), window_frame['coords']) < 50)]
+                end_point_candidates = [[] for _ in end_points_with_var]
+                offset = 0
+                for _, _, points, points_index in near_frames:
+                    for candidates, frame_candidates in zip(end_point_candidates, query_end_point_candidates(points_index, end_points_with_var)):
+                        candidates.extend(offset + point for point in frame_candidates)
+                    offset += points['samples'].shape[0] * points['samples'].shape[1]
+                window_frames = {index: window_frame for index, window_frame, _, _ in near_frames}
+                all_points = {
+                    'samples': np.concatenate([points['samples'] for _, _, points, _ in near_frames]) if near_frames else np.empty((0, 50, 3)),
+                    'frames': np.concatenate([points['frames'] + index for index, _, points, _ in near_frames]) if near_frames else np.empty(0, dtype=np.intp),
+                    'line_ids': [line_id for _, _, points, _ in near_frames for line_id in points['line_ids']]
+                }
+
+                for (line_id, line), end_point_with_var, candidates in zip(frame['lines_pixel_on_top_view'].items(), end_points_with_var, end_point_candidates):
+                    closest_points = find_closest_points(end_point_with_var, i, candidates, all_points, window_frames, distance_threshold=50)
+                    aggregator.add_line(i, line_id, line, end_point_with_var, closest_points)
+
+            # The lines of the merged frame are not looked up again
+            window.popleft()
+            progress.update(1)
+            for line_id in frame['lines_pixel_on_top_view']:
+                del aggregator.to_which_aggregated_line[(i, line_id)]
+
+            open_lines = set(aggregator.to_which_aggregated_line.values())
+            for aggregated_line_id in [line_id for line_id in aggregator.aggregated_lines if line_id not in open_lines]:
+                yield aggregated_line_id, aggregator.aggregated_lines.pop(aggregated_line_id)
+
+def line_length(points):
+    """
+    Length of a line given as a list of (latitude, longitude[, variance]) points, in meters.
+    """
     total_length = 0
     for j in range(len(points) - 1):
         total_length += calculate_distance(points[j][:2], points[j + 1][:2])
-
-    if total_length >= 15: 
-        coords = [(point[1], point[0]) for point in points] 
-        linestring = kml.newlinestring(name=f"Line {line_id}")
-        linestring.coords = coords
-        linestring.style.linestyle.width = 2 
-        linestring.style.linestyle.color = simplekml.Color.red  
-
-
-kml.save("output_kmls/smoothed_lines(final_output)/final_smoothed_lines.kml")
-print("KML file has been saved successfully.")
+    return total_length
+
+def save_smoothed_lines_kml(aggregated_lines, output_file_path, min_length=15):
+    """
+    Write the aggregated lines longer than min_length meters to a KML (or KMZ) file, as red lines.
+    """
+    write_smoothed_lines_kml(aggregated_lines.items(), output_file_path, min_length)
+
+def write_smoothed_lines_kml(aggregated_lines, output_file_path, min_length=15):
+    """
+    Same as save_smoothed_lines_kml, writing each line as it comes from an iterable of (line id, points), e.g.
+    aggregate_lines_streaming, instead of keeping the whole document in memory.
+    """
+    with KmlWriter(output_file_path) as kml:
+        kml.add_line_style('smoothed_lines', color=kml_writer.red, width=2)
+        # calculate total length of aggregated lines. only lines with length of greater than 15m will write to kml file
+        for line_id, points in aggregated_lines:
+            if line_length(points) >= min_length:
+                kml.add_linestring(f"Line {line_id}", [(point[1], point[0]) for point in points], 'smoothed_lines')
+
+
+if __name__ == '__main__':
+    # The streaming mode reads the frames one after the other and writes the lines as they are finished, so its
+    # memory does not grow with the length of the drive
+    streaming = False
+    output_kml_path = "output_kmls/smoothed_lines(final_output)/final_smoothed_lines.kml"
+
+    np.set_printoptions(precision=15) 
+
+    lines = load_lines('output_jsons/lines_coords.lines')
+    if streaming:
+        write_smoothed_lines_kml(aggregate_lines_streaming(iter_frames(lines)), output_kml_path)
+    else:
+        data = lines_to_frames(lines)
+
+        # Sort data based on frame number
+        sorted_data = sorted(data, key=lambda x: x['framenumber'])
+
+        aggregated_lines = aggregate_lines(sorted_data)
+
+        save_smoothed_lines_kml(aggregated_lines, output_kml_path)
+    print("KML file has been saved successfully.")
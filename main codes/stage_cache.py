@@ -0,0 +1,130 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+
+'''
+A content-addressed cache for the outputs of the pipeline stages.
+The output of every stage is stored under a key which is the hash of everything it depends on:
+- the key of the stage it reads from (or the content of its input files),
+- its parameters (thresholds, ...),
+- the source code of the modules that compute it.
+A stage whose key is already in the cache is read back instead of being computed, and the stages before it are
+never run. Changing a threshold only changes the keys of its stage and of the stages after it, so only those
+recompute, and an output computed with different inputs or code can never be read back by mistake.
+
+Layout of the cache directory:
+- <stage>/<key>.jsonl: the per-frame records of a stage, one JSON object per line.
+- <stage>/<key>/: outputs that are directories (e.g. a mask store).
+- file_digests.json: content hashes of the input files, reused while their size and modification time do not change.
+'''
+
+
+def stage_key(stage, params=None, inputs=(), modules=()):
+    """
+    Key of a stage output.
+
+    Parameters:
+    - stage: Name of the stage.
+    - params: JSON serializable parameters of the stage.
+    - inputs: Keys of the upstream stages and digests of the input files.
+    - modules: Modules (or functions) whose source code computes the stage.
+
+    Returns:
+    - Hex digest identifying the output.
+    """
+    code = [hashlib.sha256(inspect.getsource(module).encode()).hexdigest() for module in modules]
+    description = json.dumps({'stage': stage, 'params': params, 'inputs': list(inputs), 'code': code}, sort_keys=True)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+class StageCache:
+    """
+    Cache of stage outputs in cache_dir.
+    """
+
+    def __init__(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.digests_path = os.path.join(cache_dir, 'file_digests.json')
+        if os.path.exists(self.digests_path):
+            with open(self.digests_path, 'r') as file:
+                self.digests = json.load(file)
+        else:
+            self.digests = {}
+
+    def file_digest(self, path):
+        """
+        Hash of the content of a file, or of all files of a directory. Hashing a video of a few GB takes a while,
+        so the digest is remembered and only recomputed when the size or modification time of a file changes.
+        """
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+            return hashlib.sha256(json.dumps([(os.path.relpath(f, path), self.file_digest(f)) for f in files]).encode()).hexdigest()
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.digests.get(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['digest']
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        self.digests[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest.hexdigest()}
+        with open(self.digests_path + '.tmp', 'w') as file:
+            json.dump(self.digests, file)
+        os.replace(self.digests_path + '.tmp', self.digests_path)
+        return digest.hexdigest()
+
+    def path(self, stage, key, suffix=''):
+        return os.path.join(self.cache_dir, stage, key + suffix)
+
+    def __contains__(self, stage_and_key):
+        stage, key = stage_and_key
+        return os.path.exists(self.path(stage, key, '.jsonl')) or os.path.isdir(self.path(stage, key))
+
+    def records(self, stage, key, compute):
+        """
+        Per-frame records of a stage, read from the cache or computed by compute() and cached as they are yielded.
+        The cached file only replaces the temporary one once every record has been written, so an interrupted
+        run never leaves a partial output in the cache.
+
+        Parameters:
+        - stage, key: Stage name and key of its output.
+        - compute: Function returning an iterable over the records, only called on a cache miss.
+
+        Yields:
+        - The records of the stage.
+        """
+        cached_path = self.path(stage, key, '.jsonl')
+        if os.path.exists(cached_path):
+            with open(cached_path, 'r') as file:
+                for line in file:
+                    yield json.loads(line)
+            return
+
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        temporary_path = cached_path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            for record in compute():
+                file.write(json.dumps(record) + '\n')
+                yield record
+        os.replace(temporary_path, cached_path)
+
+    def directory(self, stage, key):
+        """
+        Temporary directory to write a directory output of a stage to (e.g. a mask store), and the path it is
+        cached at once commit_directory is called.
+        """
+        cached_path = self.path(stage, key)
+        temporary_path = cached_path + '.tmp'
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        return temporary_path, cached_path
+
+    def commit_directory(self, stage, key):
+        cached_path = self.path(stage, key)
+        os.replace(cached_path + '.tmp', cached_path)
+        return cached_path
@@ -0,0 +1,267 @@
+import argparse
+import json
+import os
+from collections import defaultdict
+import numpy as np
+import kml_writer
+from kml_writer import KmlWriter, region
+from line_store import load_lines, iter_frames
+from line_map import LineMap
+from smooth_lines import aggregate_lines_streaming, line_length, look_ahead_distance
+
+'''
+Cuts line maps into z/x/y tiles (the web map tiling), so viewers only load the lines in view:
+- <output>/<z>/<x>/<y>.geojson: GeoJSON FeatureCollection of the lines of each layer in the tile, for web maps.
+- <output>/<z>/<x>/<y>.kml: the same lines as KML, with a Region and a NetworkLink to each child tile that has
+  lines (a KML super-overlay). Google Earth loads a tile when it becomes large enough on screen, shows its lines
+  until its children are loaded, and never loads the tiles out of view.
+- <output>/doc.kml: Links to the tiles of the lowest zoom level, to open in Google Earth.
+- <output>/tiles.json: Zoom levels, bounds and layers of the tiles, and the URL template of the GeoJSON tiles.
+
+Lines are simplified for each zoom level with the Douglas-Peucker algorithm, to a tolerance of one pixel of the
+tile (256 pixels wide), and cut at the tile borders. A layer can start at a higher zoom level than the others:
+the georeferenced lines of every frame (lines_coords), which make the initial output KML slow, are only worth
+showing when zoomed in.
+'''
+
+tile_pixels = 256
+earth_circumference = 40075016.686  # Meters, at the equator (web mercator)
+
+
+def lonlat_to_tile(longitudes, latitudes, zoom):
+    """
+    Fractional tile coordinates (x, y) of points at a zoom level.
+    """
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    n = 2 ** zoom
+    x = (np.asarray(longitudes, dtype=np.float64) + 180) / 360 * n
+    y = (1 - np.arcsinh(np.tan(latitudes)) / np.pi) / 2 * n
+    return x, y
+
+def tile_bounds(zoom, x, y):
+    """
+    (north, south, east, west) of a tile, in degrees.
+    """
+    n = 2 ** zoom
+    north = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n))))
+    south = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + 1) / n))))
+    return float(north), float(south), (x + 1) / n * 360 - 180, x / n * 360 - 180
+
+def meters_per_pixel(zoom, latitude):
+    return earth_circumference * np.cos(np.radians(latitude)) / (tile_pixels * 2 ** zoom)
+
+def simplify_line(points, tolerance):
+    """
+    Douglas-Peucker simplification of a line.
+
+    Parameters:
+    - points: (latitude, longitude) points of the line, shape (N, 2).
+    - tolerance: Largest distance (meters) of a removed point to the simplified line.
+
+    Returns:
+    - The kept points, always including the first and the last one.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) <= 2:
+        return points
+
+    # Meters, in the same local approximation as calculate_distance
+    xy = np.column_stack([(points[:, 1] - points[0, 1]) * 111320 * np.cos(np.radians(points[0, 0])), (points[:, 0] - points[0, 0]) * 111320])
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        direction = xy[last] - xy[first]
+        offsets = xy[first + 1:last] - xy[first]
+        length = np.hypot(*direction)
+        if length > 0:
+            distances = np.abs(direction[0] * offsets[:, 1] - direction[1] * offsets[:, 0]) / length
+        else:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack += [(first, middle), (middle, last)]
+    return points[keep]
+
+def clip_line(points, bounds):
+    """
+    Parts of a line inside a (north, south, east, west) box (Liang-Barsky clipping of each segment).
+
+    Returns:
+    - List of the parts, each a list of (latitude, longitude) points.
+    """
+    north, south, east, west = bounds
+    parts = []
+    part = []
+    for (lat1, lon1), (lat2, lon2) in zip(points[:-1], points[1:]):
+        t0, t1 = 0.0, 1.0
+        d_lat, d_lon = lat2 - lat1, lon2 - lon1
+        inside = True
+        for p, q in ((-d_lon, lon1 - west), (d_lon, east - lon1), (-d_lat, lat1 - south), (d_lat, north - lat1)):
+            if p == 0:
+                if q < 0:
+                    inside = False
+                    break
+            else:
+                t = q / p
+                if p < 0:
+                    t0 = max(t0, t)
+                else:
+                    t1 = min(t1, t)
+        if not inside or t0 > t1:
+            if part:
+                parts.append(part)
+                part = []
+            continue
+
+        start = (lat1 + t0 * d_lat, lon1 + t0 * d_lon)
+        end = (lat1 + t1 * d_lat, lon1 + t1 * d_lon)
+        if not part:
+            part = [start]
+        elif part[-1] != start:
+            parts.append(part)
+            part = [start]
+        part.append(end)
+        if t1 < 1:
+            parts.append(part)
+            part = []
+    if part:
+        parts.append(part)
+    return [part for part in parts if len(part) >= 2]
+
+def cut_into_tiles(lines, zoom, tiles):
+    """
+    Simplify lines for a zoom level and add their parts to the tiles they cross.
+
+    Parameters:
+    - lines: Iterable of (layer, line id, points), points as (latitude, longitude[, ...]).
+    - zoom: Zoom level.
+    - tiles: Dictionary of (zoom, x, y) to the list of (layer, line id, points) in the tile, updated in place.
+    """
+    for layer, line_id, points in lines:
+        points = np.array([point[:2] for point in points], dtype=np.float64)
+        points = simplify_line(points, meters_per_pixel(zoom, points[:, 0].mean()))
+        x, y = lonlat_to_tile(points[:, 1], points[:, 0], zoom)
+        for tile_x in range(int(x.min()), int(x.max()) + 1):
+            for tile_y in range(int(y.min()), int(y.max()) + 1):
+                for part in clip_line(points.tolist(), tile_bounds(zoom, tile_x, tile_y)):
+                    tiles[(zoom, tile_x, tile_y)].append((layer, line_id, part))
+
+def write_geojson_tile(path, features):
+    collection = {
+        "type": "FeatureCollection",
+        "features": [{"type": "Feature", "properties": {"layer": layer, "line_id": line_id},
+                      "geometry": {"type": "LineString", "coordinates": [[longitude, latitude] for latitude, longitude in part]}}
+                     for layer, line_id, part in features]
+    }
+    with open(path, 'w') as file:
+        json.dump(collection, file)
+
+def write_kml_tile(path, zoom, x, y, features, children, layer_styles, min_zoom):
+    """
+    KML of a tile: its lines, shown until its children are loaded, and links to its children.
+    """
+    bounds = tile_bounds(zoom, x, y)
+    # The children are active from 128 pixels, when this tile covers 256 pixels, so the lines are hidden from then on
+    max_lod_pixels = 256 if children else -1
+    with KmlWriter(path) as kml:
+        for layer, (color, width) in layer_styles.items():
+            kml.add_line_style(layer, color, width)
+        kml.begin_folder(f'{zoom}/{x}/{y}', region(bounds, 0 if zoom == min_zoom else 128, max_lod_pixels))
+        for layer, line_id, part in features:
+            kml.add_linestring(f"Line {line_id}", [(longitude, latitude) for latitude, longitude in part], layer)
+        kml.end_folder()
+        for child_x, child_y in children:
+            kml.add_network_link(f'{zoom + 1}/{child_x}/{child_y}', f'../../{zoom + 1}/{child_x}/{child_y}.kml', region(tile_bounds(zoom + 1, child_x, child_y)))
+
+def export_tiles(layers, output_dir, min_zoom=12, max_zoom=18):
+    """
+    Write the tiles of some layers of lines.
+
+    Parameters:
+    - layers: Dictionary of layer name to {'lines': list of (line id, points), 'min_zoom': lowest zoom level of
+      the layer, 'color', 'width': KML line style}.
+    - output_dir: Directory the tiles are written to.
+    - min_zoom, max_zoom: Zoom levels to write.
+
+    Returns:
+    - Number of tiles written.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    tiles = defaultdict(list)
+    for zoom in range(min_zoom, max_zoom + 1):
+        cut_into_tiles(((layer, line_id, points) for layer, spec in layers.items() if zoom >= spec.get('min_zoom', min_zoom)
+                        for line_id, points in spec['lines']), zoom, tiles)
+
+    # A tile is written if it or one of its descendants has lines, so every tile with lines can be reached from
+    # the lowest zoom level
+    written = set(tiles)
+    for zoom, x, y in sorted(tiles, reverse=True):
+        while zoom > min_zoom:
+            zoom, x, y = zoom - 1, x // 2, y // 2
+            written.add((zoom, x, y))
+    children = defaultdict(list)
+    for zoom, x, y in written:
+        if zoom > min_zoom:
+            children[(zoom - 1, x // 2, y // 2)].append((x, y))
+
+    layer_styles = {layer: (spec.get('color', kml_writer.red), spec.get('width', 2)) for layer, spec in layers.items()}
+    for zoom, x, y in sorted(written):
+        tile_dir = os.path.join(output_dir, str(zoom), str(x))
+        os.makedirs(tile_dir, exist_ok=True)
+        features = tiles.get((zoom, x, y), [])
+        write_geojson_tile(os.path.join(tile_dir, f'{y}.geojson'), features)
+        write_kml_tile(os.path.join(tile_dir, f'{y}.kml'), zoom, x, y, features, sorted(children[(zoom, x, y)]), layer_styles, min_zoom)
+
+    top_tiles = sorted((x, y) for zoom, x, y in written if zoom == min_zoom)
+    with KmlWriter(os.path.join(output_dir, 'doc.kml')) as kml:
+        for x, y in top_tiles:
+            kml.add_network_link(f'{min_zoom}/{x}/{y}', f'{min_zoom}/{x}/{y}.kml', region(tile_bounds(min_zoom, x, y), 0))
+
+    all_points = np.array([point[:2] for spec in layers.values() for _, points in spec['lines'] for point in points], dtype=np.float64).reshape(-1, 2)
+    with open(os.path.join(output_dir, 'tiles.json'), 'w') as file:
+        json.dump({
+            'tiles': ['{z}/{x}/{y}.geojson'],
+            'minzoom': min_zoom,
+            'maxzoom': max_zoom,
+            'bounds': [all_points[:, 1].min(), all_points[:, 0].min(), all_points[:, 1].max(), all_points[:, 0].max()] if len(all_points) else None,
+            'layers': {layer: {'minzoom': spec.get('min_zoom', min_zoom)} for layer, spec in layers.items()}
+        }, file, indent=4)
+    return len(written)
+
+def frame_lines(lines):
+    """
+    The georeferenced line of every frame of a line table, as (line id, [start, end]).
+    """
+    coords = np.column_stack([lines['start_latitude'], lines['start_longitude'], lines['end_latitude'], lines['end_longitude']]).reshape(-1, 2, 2)
+    return [(f"{frame}_{line_id}", line) for frame, line_id, line in zip(np.asarray(lines['frame']).tolist(), np.asarray(lines['line_id']).tolist(), coords.tolist())]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Cut the smoothed lines and the georeferenced lines of every frame into z/x/y tiles')
+    parser.add_argument('--lines', type=str, default='output_jsons/lines_coords.lines', help='georeferenced lines (line store), smoothed for the smoothed lines layer')
+    parser.add_argument('--line-map', type=str, default=None, help='take the smoothed lines from this line map (see line_map.py) instead')
+    parser.add_argument('--no-frame-lines', action='store_true', default=False, help='do not write the layer of the georeferenced lines of every frame')
+    parser.add_argument('--output-dir', type=str, default='output_tiles', help='directory to write the tiles to')
+    parser.add_argument('--min-zoom', type=int, default=12, help='lowest zoom level')
+    parser.add_argument('--max-zoom', type=int, default=18, help='highest zoom level')
+    parser.add_argument('--frame-lines-min-zoom', type=int, default=16, help='lowest zoom level of the georeferenced lines of every frame')
+    args = parser.parse_args()
+
+    lines = load_lines(args.lines)
+    if args.line_map is not None:
+        smoothed_lines = list(LineMap(args.line_map).lines().items())
+    else:
+        smoothed_lines = list(aggregate_lines_streaming(iter_frames(lines), look_ahead_distance))
+    # Same minimum length as the final output KML
+    layers = {'smoothed_lines': {'lines': [(line_id, points) for line_id, points in smoothed_lines if line_length(points) >= 15], 'color': kml_writer.red, 'width': 2}}
+    if not args.no_frame_lines:
+        layers['frame_lines'] = {'lines': frame_lines(lines), 'min_zoom': args.frame_lines_min_zoom, 'color': kml_writer.yellow, 'width': 1}
+
+    count = export_tiles(layers, args.output_dir, args.min_zoom, args.max_zoom)
+    print(f"{count} tiles have been saved to {args.output_dir}")
@@ -1,54 +1,147 @@
-import pandas as pd
+import argparse
+import os
 import numpy as np
-import matplotlib.pyplot as plt
+import pandas as pd
+from sensor_ingest import iter_csv_columns, load_yaw_rate, time_base, orientation_dtype, gyroscope_dtype, yaw_rate_dtype, read_metadata, ns_per_second
 
 # The purpose of this code is to calculate and store the angular velocity (yaw_derivative) from the orientation data.
 # The yaw_derivative helps in identifying and filtering out lines with low slopes that are considered outliers.
 # While filtering, we ensure that lines with low slopes are not removed if the vehicle is turning or on a curved road, as lines on curves naturally have lower slopes.
-
-def yaw_derivative(file_path: str, output_file_path: str):
-    df = pd.read_csv(file_path)
-
-    # Extract the columns 'seconds_elapsed' and 'yaw'
-    extracted_columns = df[['seconds_elapsed', 'yaw']].copy()
-
-    # Adjust yaw values to handle wrapping from +π to -π
-    yaw_values = extracted_columns['yaw'].values
-    for i in range(1, len(yaw_values)):
-        if yaw_values[i] - yaw_values[i - 1] > np.pi:
-            yaw_values[i] -= 2 * np.pi
-        elif yaw_values[i - 1] - yaw_values[i] > np.pi:
-            yaw_values[i] += 2 * np.pi
-    extracted_columns['yaw'] = yaw_values
-
-    # Compute the derivative of yaw with respect to seconds_elapsed
-    extracted_columns['yaw_derivative'] = np.gradient(extracted_columns['yaw'], extracted_columns['seconds_elapsed'])
-
-    # Filter out derivatives with absolute values greater than 10
-    extracted_columns.loc[np.abs(extracted_columns['yaw_derivative']) > 10, 'yaw_derivative'] = 0
-
-    # Set the start time
-    start_time_str = '09:23:13.364' # You need to change this based on the start time of your recorded video. The Timestamp Camera app records the time of the first frame in milliseconds.
-    start_time = pd.to_datetime(start_time_str, format='%H:%M:%S.%f')
-
-    # Convert seconds_elapsed to actual time and extract hours, minutes, and seconds
-    extracted_columns['exact_time'] = (start_time + pd.to_timedelta(extracted_columns['seconds_elapsed'], unit='s')).dt.strftime('%H:%M:%S')
-
-    # Select the relevant columns
-    final_columns = extracted_columns[['exact_time', 'seconds_elapsed', 'yaw', 'yaw_derivative']]
-
-    # Save to a CSV file
-    final_columns.to_csv(output_file_path, index=False)
-    print("Data has been successfully saved.")
-
-    return final_columns
-
-def plot_data(data: pd.DataFrame):
+# The Sensor Logger CSV is read in chunks, and the yaw is unwrapped and differentiated one chunk at a time (the last
+# samples of each chunk are carried over to the next one), so a drive of several hours at 100 Hz is processed in
+# constant memory. The yaw rate can also be taken directly from the gyroscope instead of the orientation.
+# The result is written as a binary time series (IMU_data/Angular_Velocity.npy, with the time of each sample in
+# epoch nanoseconds), or as the CSV of older versions if the output path ends with .csv.
+
+max_yaw_derivative = 10  # Derivatives with absolute values greater than this (rad/s) are glitches of the yaw and set to 0
+
+
+def yaw_rates_from_orientation(chunks):
+    """
+    Unwrap the yaw of the orientation chunks and compute its derivative, giving the same result as np.unwrap and
+    np.gradient over the whole recording. The derivative of a sample needs the next sample, so the last sample of
+    each chunk is yielded with the next chunk.
+
+    Parameters:
+    - chunks: Orientation samples (orientation_dtype) sorted by time, in chunks.
+
+    Yields:
+    - Chunks of yaw rates (yaw_rate_dtype): time, unwrapped yaw (rad) and yaw derivative (rad/s).
+    """
+    carried = np.empty(0, dtype=yaw_rate_dtype)  # Last two samples, the yaw already unwrapped
+    carried_yielded = 0  # Number of the carried samples already yielded
+    origin = None
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        if origin is None:
+            origin = chunk['time'][0]
+        samples = np.empty(len(carried) + len(chunk), dtype=yaw_rate_dtype)
+        samples['time'] = np.r_[carried['time'], chunk['time']]
+        # The carried samples are already unwrapped, so unwrapping keeps them and continues from them
+        samples['yaw'] = np.unwrap(np.r_[carried['yaw'], chunk['yaw']])
+        if len(samples) >= 2:
+            samples['yaw_derivative'] = yaw_derivative(samples, origin)
+            yield samples[carried_yielded:-1]
+            carried, carried_yielded = samples[-2:].copy(), 1
+        else:
+            carried, carried_yielded = samples, 0
+
+    if len(carried) > carried_yielded:
+        carried['yaw_derivative'] = yaw_derivative(carried, origin) if len(carried) >= 2 else 0
+        yield carried[carried_yielded:]
+
+def yaw_derivative(samples, origin):
+    """
+    Derivative of the yaw of the samples (rad/s), 0 where it is larger than max_yaw_derivative.
+    """
+    derivatives = np.gradient(samples['yaw'], (samples['time'] - origin) / ns_per_second)
+    derivatives[~(np.abs(derivatives) <= max_yaw_derivative)] = 0
+    return derivatives
+
+def vertical_axis(chunks):
+    """
+    Axis of the phone that the vehicle turns around, as the principal axis of the angular velocities of the
+    gyroscope: the phone is fixed in the vehicle and the vehicle mostly turns around the vertical. Its sign is
+    arbitrary (the filters only use the absolute yaw derivative).
+    """
+    moments = np.zeros((3, 3))
+    for chunk in chunks:
+        rates = np.column_stack([chunk['x'], chunk['y'], chunk['z']])
+        moments += rates.T @ rates
+    return np.linalg.eigh(moments)[1][:, -1]
+
+def yaw_rates_from_gyroscope(chunks, axis):
+    """
+    Yaw rate as the angular velocity of the gyroscope around an axis of the phone, and the yaw as its integral
+    (trapezoidal, from 0 at the first sample), carried over from chunk to chunk.
+
+    Parameters:
+    - chunks: Gyroscope samples (gyroscope_dtype) sorted by time, in chunks.
+    - axis: Unit vector of the vertical axis in the frame of the phone (see vertical_axis).
+
+    Yields:
+    - Chunks of yaw rates (yaw_rate_dtype).
+    """
+    last = None  # Time, yaw and yaw derivative of the last sample of the previous chunk
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        yaw_rates = np.empty(len(chunk), dtype=yaw_rate_dtype)
+        yaw_rates['time'] = chunk['time']
+        yaw_rates['yaw_derivative'] = chunk['x'] * axis[0] + chunk['y'] * axis[1] + chunk['z'] * axis[2]
+        yaw_rates['yaw_derivative'][~(np.abs(yaw_rates['yaw_derivative']) <= max_yaw_derivative)] = 0
+        times = np.r_[last[0] if last else chunk['time'][0], chunk['time']]
+        derivatives = np.r_[last[2] if last else yaw_rates['yaw_derivative'][0], yaw_rates['yaw_derivative']]
+        steps = np.diff(times) / ns_per_second * (derivatives[1:] + derivatives[:-1]) / 2
+        yaw_rates['yaw'] = (last[1] if last else 0) + np.cumsum(steps)
+        last = (yaw_rates['time'][-1], yaw_rates['yaw'][-1], derivatives[-1])
+        yield yaw_rates
+
+def write_yaw_rates(yaw_rates, output_file_path, metadata_file_path=None):
+    """
+    Write chunks of yaw rates to a binary time series (.npy of yaw_rate_dtype), one chunk at a time. A path ending
+    with .csv is written in the format of the older versions (exact_time, seconds_elapsed, yaw, yaw_derivative),
+    with the times of day in the timezone and the seconds elapsed from the start of the Sensor Logger recording.
+
+    Returns:
+    - Number of samples written.
+    """
+    count = 0
+    if output_file_path.lower().endswith('.csv'):
+        metadata = read_metadata(metadata_file_path)
+        header = True
+        for chunk in yaw_rates:
+            local_times = pd.to_datetime(chunk['time'], unit='ns', utc=True).tz_convert(metadata['timezone'])
+            pd.DataFrame({
+                'exact_time': local_times.strftime('%H:%M:%S'),
+                'seconds_elapsed': (chunk['time'] - metadata['recording_time']) / ns_per_second,
+                'yaw': chunk['yaw'],
+                'yaw_derivative': chunk['yaw_derivative'],
+            }).to_csv(output_file_path, mode='w' if header else 'a', header=header, index=False)
+            header = False
+            count += len(chunk)
+        return count
+
+    # The samples are appended to a raw file, which becomes the .npy once their number is known
+    raw_path = output_file_path + '.tmp'
+    with open(raw_path, 'wb') as file:
+        for chunk in yaw_rates:
+            chunk.tofile(file)
+            count += len(chunk)
+    np.save(output_file_path, np.memmap(raw_path, dtype=yaw_rate_dtype, mode='r') if count else np.empty(0, dtype=yaw_rate_dtype))
+    os.remove(raw_path)
+    return count
+
+def plot_data(data):
+    import matplotlib.pyplot as plt
+
+    seconds_elapsed = (data['time'] - data['time'][0]) / ns_per_second
     plt.figure(figsize=(14, 8))
 
     # Plot yaw
     plt.subplot(2, 1, 1)
-    plt.plot(data['seconds_elapsed'], data['yaw'], label='Yaw', color='blue')
+    plt.plot(seconds_elapsed, data['yaw'], label='Yaw', color='blue')
     plt.xlabel('Seconds Elapsed')
     plt.ylabel('Yaw')
     plt.title('Yaw vs. Seconds Elapsed')
@@ -57,7 +150,7 @@ def plot_data(data: pd.DataFrame):
 
     # Plot yaw derivative
     plt.subplot(2, 1, 2)
-    plt.plot(data['seconds_elapsed'], data['yaw_derivative'], label='Yaw Derivative', color='red')
+    plt.plot(seconds_elapsed, data['yaw_derivative'], label='Yaw Derivative', color='red')
     plt.xlabel('Seconds Elapsed')
     plt.ylabel('Yaw Derivative')
     plt.title('Yaw Derivative vs. Seconds Elapsed')
@@ -68,11 +161,30 @@ def plot_data(data: pd.DataFrame):
     plt.tight_layout()
     plt.show()
 
-file_path = 'IMU_data/Orientation.csv'
-output_file_path = 'IMU_data/Angular_Velocity.csv'
-
-# Extract data and save it
-data = yaw_derivative(file_path, output_file_path)
 
-# plot data as needed
-plot_data(data)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Calculate the yaw derivative (angular velocity) of the vehicle from the orientation or the gyroscope of the phone')
+    parser.add_argument('--orientation', type=str, default='IMU_data/Orientation.csv', help='Sensor Logger Orientation.csv')
+    parser.add_argument('--gyroscope', type=str, default=None, help='Sensor Logger Gyroscope.csv, to take the yaw rate from the gyroscope instead of the orientation')
+    parser.add_argument('--gyroscope-axis', type=str, default='auto', choices=['auto', 'x', 'y', 'z'], help='axis of the phone the vehicle turns around, found from the gyroscope data if auto')
+    parser.add_argument('--output', type=str, default='IMU_data/Angular_Velocity.npy', help='binary time series (.npy), or CSV in the format of older versions (.csv)')
+    parser.add_argument('--metadata', type=str, default='motion_data/Metadata.csv', help='Sensor Logger Metadata.csv, for the times of day of the CSV output')
+    parser.add_argument('--chunk-size', type=int, default=1000000, help='number of samples read at a time')
+    parser.add_argument('--plot', action='store_true', default=False, help='plot the yaw and yaw derivative once written')
+    args = parser.parse_args()
+
+    if args.gyroscope is not None:
+        def gyroscope_chunks():
+            return iter_csv_columns(args.gyroscope, ['time', 'x', 'y', 'z'], gyroscope_dtype, args.chunk_size)
+        # The vertical axis is found in a first pass over the file, and the yaw rates are written in a second
+        axis = vertical_axis(gyroscope_chunks()) if args.gyroscope_axis == 'auto' else np.eye(3)['xyz'.index(args.gyroscope_axis)]
+        yaw_rates = yaw_rates_from_gyroscope(gyroscope_chunks(), axis)
+    else:
+        yaw_rates = yaw_rates_from_orientation(iter_csv_columns(args.orientation, ['time', 'yaw', 'pitch', 'roll'], orientation_dtype, args.chunk_size))
+
+    count = write_yaw_rates(yaw_rates, args.output, args.metadata)
+    print(f"{count} samples saved to {args.output}")
+
+    # plot data as needed
+    if args.plot:
+        plot_data(load_yaw_rate(args.output, time_base()))